@@ -33,9 +33,9 @@ def t_config(config_file: str = Option(None, "--config", "-c", help="配置文
 @app.command("test-ignore")
 def t_ignore(path, match):
     """测试ignore"""
-    from fnmatch import fnmatchcase
+    from alist_sync.matcher import PathMatcher
 
-    echo(fnmatchcase(path, match))
+    echo(PathMatcher([match]).is_ignore(path))
 
 
 @app.command("sync")
@@ -82,16 +82,40 @@ def check(
 @app.command("get-info")
 def cli_get(path: str):
     """"""
-    from alist_sdk import login_server, AlistPath
+    from alist_sdk import AlistPath
     from alist_sync.config import create_config
+    from alist_sync.session import get_session
 
     sync_config = create_config()
 
     for s in sync_config.alist_servers:
-        login_server(**s.dump_for_alist_path())
+        get_session().client(s)
 
     echo(AlistPath(path).re_stat(retry=5, timeout=3).model_dump_json(indent=2))
 
 
+@app.command("breakers")
+def cli_breakers(
+    config_file: str = Option(None, "--config", "-c", help="配置文件路径"),
+):
+    """查看各个服务器的熔断器状态"""
+    import json
+    from alist_sync.config import create_config
+
+    if config_file and Path(config_file).exists():
+        os.environ["ALIST_SYNC_CONFIG"] = str(Path(config_file).resolve().absolute())
+        os.environ["_ALIST_SYNC_CONFIG"] = str(Path(config_file).resolve().absolute())
+    _file = create_config().cache_dir.joinpath("circuit_breakers.json")
+    if not _file.exists():
+        return echo("没有熔断器的记录.")
+
+    for _b in json.loads(_file.read_text()).values():
+        echo(
+            f"{_b['server']}: {_b['state']}, 连续失败: {_b['failures']}, "
+            f"总失败: {_b['total_failures']}, 熔断至: {_b['open_until']}, "
+            f"最后的错误: {_b['last_error']}"
+        )
+
+
 if __name__ == "__main__":
     app()
@@ -1,19 +1,30 @@
 import asyncio
 import builtins
 import logging
+import re
 import time
 from typing import Literal
 
 from alist_sdk import AsyncClient as _AsyncClient, Task, Client
 from async_lru import alru_cache as lru_cache
 
-from alist_sync.common import get_alist_client
+from alist_sync.common import get_alist_client, record_retry_after
 from alist_sync.config import create_config
+from alist_sync.session import get_session
 
 logger = logging.getLogger("alist-sync.client")
 sync_config = create_config()
 
-__all__ = ["AlistClient", "get_status", "create_async_client"]
+__all__ = [
+    "AlistClient",
+    "get_status",
+    "get_copy_tasks",
+    "find_tasks",
+    "parse_copy_task",
+    "parse_transfer_task",
+    "find_transfer_tasks",
+    "create_async_client",
+]
 
 CopyStatusModify = Literal[
     "init",
@@ -62,7 +73,9 @@ class AlistClient(_AsyncClient):
 
     async def request(self, *args, **kwargs):
         async with self._max_connect:
-            return await super().request(*args, **kwargs)
+            _res = await super().request(*args, **kwargs)
+        record_retry_after(_res)
+        return _res
 
     @staticmethod
     def _task_rtype(rtype, data):
@@ -70,7 +83,7 @@ class AlistClient(_AsyncClient):
             return data or []
         return {i.name: i for i in data or []}
 
-    @lru_cache(maxsize=1)
+    @lru_cache(maxsize=4)
     async def cached_task_done(
         self, task_type, rtype: object = list, timestamp=0
     ) -> tuple[int, list[Task] | dict[str, Task]]:
@@ -80,7 +93,7 @@ class AlistClient(_AsyncClient):
             return timestamp * 5, self._task_rtype(rtype, res.data)
         raise ValueError(f"获取已完成的任务失败: {res.code = } {res.message = }")
 
-    @lru_cache(maxsize=1)
+    @lru_cache(maxsize=4)
     async def cached_task_undone(
         self, task_type, rtype: object = list, timestamp=0
     ) -> tuple[int, list[Task] | dict[str, Task]]:
@@ -113,15 +126,115 @@ async def get_status(
         raise ValueError(f"任务不存在: {task_name}")
 
 
+_COPY_TASK_NAME = re.compile(r"^copy \[(.*?)]\((.*)\) to \[(.*?)]\((.*)\)$")
+# 新版本: transfer [/src_mount](/path/file) to [/dst_mount](/path)
+# 旧版本: transfer /tmp/path/file to [/dst_mount](/path)
+_TRANSFER_TASK_NAME = re.compile(
+    r"^transfer (?:\[(.*?)]\((.*)\)|(.*)) to \[(.*?)]\((.*)\)$"
+)
+
+
+def _join_mount(mount: str, path: str) -> str:
+    return "/" + f"{mount.strip('/')}/{path.strip('/')}".strip("/")
+
+
+def parse_copy_task(task_name: str) -> tuple[str, str] | None:
+    """从复制任务的名称中解析出 (源文件路径, 目标目录)
+
+    任务名称: copy [/src_mount](/path/file) to [/dst_mount](/path)
+    """
+    _m = _COPY_TASK_NAME.match(task_name)
+    if _m is None:
+        return None
+    return _join_mount(_m[1], _m[2]), _join_mount(_m[3], _m[4])
+
+
+def parse_transfer_task(task_name: str) -> tuple[str, str] | None:
+    """从离线下载转存任务的名称中解析出 (临时文件路径, 目标目录)"""
+    _m = _TRANSFER_TASK_NAME.match(task_name)
+    if _m is None:
+        return None
+    _src = _join_mount(_m[1], _m[2]) if _m[3] is None else _m[3]
+    return _src, _join_mount(_m[4], _m[5])
+
+
+async def get_copy_tasks(
+    dst_dir: str, client: AlistClient = None
+) -> tuple[dict[str, Task], dict[str, Task]]:
+    """获取复制到dst_dir的任务
+
+    :return: (已完成的任务, 未完成的任务), 均为 {源文件路径: Task}
+    """
+    client = client or get_alist_client()
+    dst_dir = _join_mount("/", dst_dir)
+    (_, _task_done), (_, _task_undone) = await asyncio.gather(
+        client.cached_task_done("copy", dict, int(time.time()) // 5),
+        client.cached_task_undone("copy", dict, int(time.time()) // 5),
+    )
+
+    def _filter(tasks: dict[str, Task]) -> dict[str, Task]:
+        _res = {}
+        for _name, _task in tasks.items():
+            _parsed = parse_copy_task(_name)
+            if _parsed is not None and _parsed[1] == dst_dir:
+                _res[_parsed[0]] = _task
+        return _res
+
+    return _filter(_task_done), _filter(_task_undone)
+
+
+async def find_tasks(
+    task_type, keyword: str, client: AlistClient = None
+) -> tuple[list[Task], list[Task]]:
+    """获取名称中包含keyword的任务
+
+    :return: (已完成的任务, 未完成的任务)
+    """
+    client = client or get_alist_client()
+    (_, _task_done), (_, _task_undone) = await asyncio.gather(
+        client.cached_task_done(task_type, list, int(time.time()) // 5),
+        client.cached_task_undone(task_type, list, int(time.time()) // 5),
+    )
+    return (
+        [t for t in _task_done if keyword in t.name],
+        [t for t in _task_undone if keyword in t.name],
+    )
+
+
+async def find_transfer_tasks(
+    target: str, client: AlistClient = None
+) -> tuple[list[Task], list[Task]]:
+    """获取转存到target的离线下载任务, 按目标目录与文件名匹配完整的路径
+
+    :return: (已完成的任务, 未完成的任务)
+    """
+    client = client or get_alist_client()
+    target = _join_mount("/", target)
+    _dir, _, _name = target.rpartition("/")
+    _done, _undone = await find_tasks("offline_download_transfer", _name, client)
+
+    def _filter(tasks: list[Task]) -> list[Task]:
+        _res = []
+        for _task in tasks:
+            _parsed = parse_transfer_task(_task.name)
+            if (
+                _parsed is not None
+                and _parsed[1] == (_dir or "/")
+                and _parsed[0].rpartition("/")[2] == _name
+            ):
+                _res.append(_task)
+        return _res
+
+    return _filter(_done), _filter(_undone)
+
+
 def create_async_client(client: Client) -> AlistClient:
-    """创建AsyncClient"""
+    """创建AsyncClient, 使用会话管理器中已经登陆的请求头与连接池参数, 不再重复登陆"""
 
     _server = sync_config.get_server(client.base_url)
-    _server.token = client.headers.get("authorization")
-
-    _ac = AlistClient(**_server.dump_for_alist_client())
-    _ac.headers = client.headers
-    _ac.cookies = client.cookies
+    _session = get_session()
+    _ac = AlistClient(_server.base_url, **_session.client_kwargs(_server))
+    _ac.headers.update(_session.headers(_server))
     return _ac
 
 
@@ -133,3 +246,4 @@ if __name__ == "__main__":
         verify=False,
     )
     asyncio.run(_c.me())
+
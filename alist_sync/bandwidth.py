@@ -0,0 +1,130 @@
+# coding: utf8
+"""带宽限制
+
+令牌桶: 每秒加入 rate 个令牌, 最多积累1秒的令牌;
+传输的数据块先预约令牌, 令牌不足时记为欠款, 然后等待欠款还清,
+多个线程共享一个桶时, 总的速度接近 rate, 每个传输也不会被饿死。
+
+一个全局的桶限制全部传输的总带宽, 每个服务器一个桶限制与该服务器之间的传输,
+下载使用源服务器的桶, 上传使用目标服务器的桶。
+
+带宽可以按时间段配置(bandwidth_profiles), 每次获取令牌时按当前时间选择,
+daemon 模式下时间段切换时不需要重启。
+"""
+import logging
+import threading
+import time
+from typing import Callable
+
+from alist_sync.config import create_config, active_rate
+from alist_sync.downloader import Throttle
+
+logger = logging.getLogger("alist-sync.bandwidth")
+sync_config = create_config()
+
+__all__ = ["TokenBucket", "BandwidthLimiter", "get_bandwidth"]
+
+
+class TokenBucket:
+    """令牌桶
+
+    :param name: 名称, 用于日志
+    :param rate_func: 返回当前的速率(每秒的令牌数, 带宽为字节数, QPS为请求数),
+        None 不限制, 每秒最多调用一次
+    """
+
+    def __init__(self, name: str, rate_func: Callable[[], float | None]):
+        self.name = name
+        self.rate_func = rate_func
+        self.rate: float | None = None
+        self.tokens = 0.0
+        self._last = time.monotonic()
+        self._next_refresh = 0.0
+        self._lock = threading.Lock()
+
+    def _refresh_rate(self, now: float):
+        if now < self._next_refresh:
+            return
+        self._next_refresh = now + 1
+        rate = self.rate_func()
+        if rate != self.rate:
+            logger.info(f"限速 [{self.name}]: {self.rate} -> {rate} /s")
+            self.rate = rate
+            self.tokens = min(self.tokens, rate or 0)
+
+    def reserve(self, size: int) -> float:
+        """预约size个令牌, 返回需要等待的秒数"""
+        with self._lock:
+            now = time.monotonic()
+            self._refresh_rate(now)
+            if not self.rate:
+                self._last = now
+                return 0
+            self.tokens = min(self.tokens + (now - self._last) * self.rate, self.rate)
+            self._last = now
+            self.tokens -= size
+            return -self.tokens / self.rate if self.tokens < 0 else 0
+
+
+class BandwidthLimiter:
+    """全局与每个服务器的带宽限制"""
+
+    def __init__(self):
+        self._global = TokenBucket(
+            "global",
+            lambda: active_rate(
+                sync_config.bandwidth_limit, sync_config.bandwidth_profiles
+            ),
+        )
+        self._servers: dict[str, TokenBucket] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def is_limited(limit, profiles) -> bool:
+        return bool(limit) or bool(profiles)
+
+    def _bucket(self, server: str) -> TokenBucket | None:
+        _server = sync_config.get_server(server)
+        if not self.is_limited(_server.bandwidth_limit, _server.bandwidth_profiles):
+            return None
+        with self._lock:
+            if _server.base_url not in self._servers:
+                self._servers[_server.base_url] = TokenBucket(
+                    _server.base_url,
+                    lambda: active_rate(
+                        _server.bandwidth_limit, _server.bandwidth_profiles
+                    ),
+                )
+            return self._servers[_server.base_url]
+
+    def throttle(self, server: str) -> Throttle | None:
+        """与server之间传输时使用的限速函数, 没有任何限制时返回None
+
+        限速函数接收数据块的字节数, 在全局与服务器的桶中预约令牌, 等待其中最长的时间。
+        """
+        buckets = [self._bucket(server)]
+        if self.is_limited(sync_config.bandwidth_limit, sync_config.bandwidth_profiles):
+            buckets.append(self._global)
+        buckets = [b for b in buckets if b is not None]
+        if not buckets:
+            return None
+
+        def _throttle(size: int):
+            _wait = max(b.reserve(size) for b in buckets)
+            if _wait > 0:
+                time.sleep(_wait)
+
+        return _throttle
+
+
+_bandwidth: BandwidthLimiter | None = None
+_bandwidth_lock = threading.Lock()
+
+
+def get_bandwidth() -> BandwidthLimiter:
+    """全局唯一的BandwidthLimiter"""
+    global _bandwidth
+    with _bandwidth_lock:
+        if _bandwidth is None:
+            _bandwidth = BandwidthLimiter()
+        return _bandwidth
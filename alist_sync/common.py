@@ -3,11 +3,18 @@ import builtins
 import datetime
 import hashlib
 import logging
+import re
 import selectors
 import sys
 import threading
+import time
+from email.utils import parsedate_to_datetime
 from pathlib import Path
-from typing import Iterable
+from typing import Iterable, Iterator, Callable, TypeVar
+
+import httpx
+
+from alist_sync.err import ServerBusyError
 
 
 logger = logging.getLogger("alist-sync.common")
@@ -23,8 +30,20 @@ __all__ = [
     "all_thread_name",
     "prefix_in_threads",
     "transfer_speed",
+    "merge_join",
+    "parse_retry_after",
+    "parse_rate",
+    "longest_prefix",
+    "check_response",
+    "record_retry_after",
+    "retry_after_of",
+    "is_not_found",
+    "busy_error",
 ]
 
+_L = TypeVar("_L")
+_R = TypeVar("_R")
+
 
 # noinspection PyUnresolvedReferences
 def get_alist_client() -> "AlistClient":
@@ -108,12 +127,144 @@ def beautify_size(byte_size: float):
     return f"{byte_size:.2f}GB"
 
 
+def longest_prefix(path: str, prefixes: Iterable[str]) -> str | None:
+    """prefixes中包含path的最长的目录前缀, 如 /baidu 包含 /baidu 与 /baidu/a"""
+    for _prefix in sorted(prefixes, key=len, reverse=True):
+        if path == _prefix or path.startswith(_prefix.rstrip("/") + "/"):
+            return _prefix
+    return None
+
+
+_RATE_UNITS = {"": 1, "k": 1000, "m": 1000**2, "g": 1000**3}
+
+
+def parse_rate(value: int | float | str | None) -> float | None:
+    """带宽转换为 字节/秒, None 与 0 表示不限制
+
+    数字为 字节/秒; 字符串: 20Mbit、20Mbps、2.5MB/s、512KiB/s,
+    bit/bps/小写b 为比特, 大写B 为字节, 带 i 时以1024为单位。
+    """
+    if value is None or value == "":
+        return None
+    if isinstance(value, (int, float)):
+        return float(value) or None
+    _m = re.fullmatch(
+        r"\s*([\d.]+)\s*([kKmMgG]?)(i?)(bit|bps|b|B)?(?:/s)?\s*", value
+    )
+    if _m is None:
+        raise ValueError(f"无法解析的带宽: {value}")
+    number, prefix, binary, unit = _m.groups()
+    _rate = float(number) * (
+        1024 ** " kmg".index(prefix.lower()) if binary else _RATE_UNITS[prefix.lower()]
+    )
+    if unit in ("bit", "bps", "b"):
+        _rate /= 8
+    return _rate or None
+
+
 def transfer_speed(size, start: datetime.datetime, end: datetime.datetime) -> str:
     """转换速度"""
     speed = (size * 2) / (end - start).seconds
     return beautify_size(speed) + '/s'
 
 
+def merge_join(
+    left: Iterable[_L],
+    right: Iterable[_R],
+    key: Callable[[_L | _R], str],
+) -> Iterator[tuple[_L | None, _R | None]]:
+    """排序合并连接: 按key排序后逐一配对, 只存在于一侧的项目, 另一侧为None"""
+    left = sorted(left, key=key)
+    right = sorted(right, key=key)
+    i = j = 0
+    while i < len(left) and j < len(right):
+        lk, rk = key(left[i]), key(right[j])
+        if lk == rk:
+            yield left[i], right[j]
+            i += 1
+            j += 1
+        elif lk < rk:
+            yield left[i], None
+            i += 1
+        else:
+            yield None, right[j]
+            j += 1
+    for _l in left[i:]:
+        yield _l, None
+    for _r in right[j:]:
+        yield None, _r
+
+
+# 需要退避重试的HTTP状态码
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+
+def parse_retry_after(value: str | None) -> float | None:
+    """Retry-After: 秒数或HTTP日期"""
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        _date = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max((_date - datetime.datetime.now(_date.tzinfo)).total_seconds(), 0)
+
+
+def check_response(res: httpx.Response):
+    """429/5xx 时抛出ServerBusyError, 携带Retry-After"""
+    if res.status_code in RETRY_STATUS:
+        raise ServerBusyError(
+            f"服务器繁忙: {res.request.url.host} [{res.status_code}]",
+            status_code=res.status_code,
+            retry_after=parse_retry_after(res.headers.get("Retry-After")),
+        )
+
+
+# {主机: time.monotonic()的时间, 在此之前不要重试}
+_retry_after: dict[str, float] = {}
+
+
+def record_retry_after(res: httpx.Response):
+    """记录429/5xx响应中的Retry-After, 可以作为httpx的response事件钩子
+
+    alist_sdk 只返回 Resp, 列目录时从这里取得服务器要求的等待时间。
+    """
+    if res.status_code in RETRY_STATUS and (
+        _after := parse_retry_after(res.headers.get("Retry-After"))
+    ):
+        _retry_after[res.request.url.host] = time.monotonic() + _after
+
+
+def retry_after_of(host: str) -> float | None:
+    """host最近一次要求的剩余等待时间"""
+    if (_until := _retry_after.get(host)) is None:
+        return None
+    return max(_until - time.monotonic(), 0) or None
+
+
+def is_not_found(res) -> bool:
+    """列目录时, 目录或存储不存在"""
+    return res.code == 500 and (
+        "object not found" in res.message or "storage not found" in res.message
+    )
+
+
+def busy_error(res, url: str) -> ServerBusyError | None:
+    """alist_sdk的Resp的code为429/5xx时, 返回ServerBusyError, 目录不存在不是错误"""
+    if res.code not in RETRY_STATUS or is_not_found(res):
+        return None
+    host = httpx.URL(url).host
+    return ServerBusyError(
+        f"服务器繁忙: {host} [{res.code}]{res.message}",
+        status_code=res.code,
+        retry_after=retry_after_of(host),
+    )
+
+
 if __name__ == "__main__":
     from pydantic import BaseModel
 
@@ -0,0 +1,258 @@
+# coding: utf8
+"""自适应并发 (AIMD)
+
+每个服务器的每个阶段 (scan: 扫描列目录, check: 检查列目录, worker: 传输) 一个并发限制器:
+
+1. 请求成功且延迟正常时, 每完成约 limit 个请求, 并发数加 1 (加性增加);
+2. 出现超时、429/5xx, 或短期平均延迟超过长期平均延迟的 tolerance 倍时,
+   并发数乘以 decrease (乘性减少), 每个窗口最多减少一次;
+3. 并发数在 [min_connect, 阶段上限] 之间调整, 阶段上限为
+   max_scan、max_check 与 max_connect。
+
+局域网的NAS可以很快增加到上限, 限流的网盘会停留在较低的并发数。
+"""
+import asyncio
+import contextlib
+import logging
+import threading
+import time
+from typing import Literal
+
+from httpx import TimeoutException
+
+from alist_sync.config import create_config, AlistServer
+from alist_sync.err import ServerBusyError
+
+logger = logging.getLogger("alist-sync.concurrency")
+sync_config = create_config()
+
+__all__ = ["AIMDLimiter", "ConcurrencyManager", "get_concurrency", "is_overload"]
+
+Stage = Literal["scan", "check", "worker"]
+
+
+def is_overload(error: BaseException | None) -> bool:
+    """服务器过载的信号: 超时与429/5xx"""
+    return isinstance(error, (TimeoutException, ServerBusyError))
+
+
+class AIMDLimiter:
+    """加性增加、乘性减少的并发限制器, 同时支持线程与协程
+
+    :param name: 名称, 用于日志
+    :param min_limit: 并发数的下限
+    :param max_limit: 并发数的上限
+    :param initial: 初始并发数, 默认为上下限的中间值
+    :param decrease: 乘性减少的系数
+    :param tolerance: 短期平均延迟超过长期平均延迟的倍数时减少并发
+    """
+
+    def __init__(
+        self,
+        name: str,
+        min_limit: int,
+        max_limit: int,
+        initial: int | None = None,
+        decrease: float = 0.7,
+        tolerance: float = 2.0,
+    ):
+        self.name = name
+        self.max_limit = max(max_limit, 1)
+        self.min_limit = max(min(min_limit, self.max_limit), 1)
+        self.decrease = decrease
+        self.tolerance = tolerance
+        self.limit = float(
+            initial
+            if initial is not None
+            else max(self.min_limit, (self.min_limit + self.max_limit) // 2)
+        )
+
+        self.inflight = 0
+        self.successes = 0
+        self.overloads = 0
+        self._short: float | None = None  # 短期平均延迟
+        self._long: float | None = None  # 长期平均延迟
+        self._last_decrease = 0.0
+        self._cond = threading.Condition()
+        self._waiters: list[tuple[asyncio.AbstractEventLoop, asyncio.Future]] = []
+
+    @property
+    def current(self) -> int:
+        """当前允许的并发数"""
+        return int(self.limit)
+
+    def _notify(self):
+        """在锁中调用: 唤醒等待中的线程与协程"""
+        self._cond.notify_all()
+        for _loop, _future in self._waiters:
+            _loop.call_soon_threadsafe(
+                lambda f=_future: f.done() or f.set_result(None)
+            )
+        self._waiters.clear()
+
+    def _decrease(self, reason: str):
+        now = time.time()
+        # 每个窗口最多减少一次, 窗口为短期平均延迟, 至少1秒
+        if now - self._last_decrease < max(self._short or 0, 1):
+            return
+        self._last_decrease = now
+        _old = self.current
+        self.limit = max(self.limit * self.decrease, self.min_limit)
+        if self.current != _old:
+            logger.info(f"并发 [{self.name}]: {_old} -> {self.current}, {reason}")
+
+    def record(self, latency: float | None = None, error: BaseException | None = None):
+        """记录一次请求的结果, latency为None时只根据error调整"""
+        with self._cond:
+            if is_overload(error):
+                self.overloads += 1
+                self._decrease(f"{type(error).__name__}: {error}")
+                return
+            if error is not None:
+                return
+
+            self.successes += 1
+            if latency is not None:
+                self._short = (
+                    latency if self._short is None else self._short * 0.7 + latency * 0.3
+                )
+                self._long = (
+                    latency if self._long is None else self._long * 0.98 + latency * 0.02
+                )
+                if self._short > self._long * self.tolerance:
+                    return self._decrease(
+                        f"延迟增加: {self._short:.2f}s > {self._long:.2f}s * {self.tolerance}"
+                    )
+
+            _old = self.current
+            self.limit = min(self.limit + 1 / self.limit, self.max_limit)
+            if self.current != _old:
+                logger.debug(f"并发 [{self.name}]: {_old} -> {self.current}")
+                self._notify()
+
+    def try_acquire(self) -> bool:
+        with self._cond:
+            if self.inflight < self.current:
+                self.inflight += 1
+                return True
+            return False
+
+    def acquire(self):
+        with self._cond:
+            self._cond.wait_for(lambda: self.inflight < self.current)
+            self.inflight += 1
+
+    async def acquire_async(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            with self._cond:
+                if self.inflight < self.current:
+                    self.inflight += 1
+                    return
+                _future = loop.create_future()
+                self._waiters.append((loop, _future))
+            await _future
+
+    def release(self):
+        with self._cond:
+            self.inflight -= 1
+            self._notify()
+
+    @contextlib.contextmanager
+    def slot(self):
+        """占用一个并发位置, 并记录延迟与错误"""
+        self.acquire()
+        _start = time.time()
+        try:
+            yield
+        except BaseException as _e:
+            self.record(error=_e)
+            raise
+        else:
+            self.record(time.time() - _start)
+        finally:
+            self.release()
+
+    @contextlib.asynccontextmanager
+    async def async_slot(self):
+        """协程中占用一个并发位置, 并记录延迟与错误"""
+        await self.acquire_async()
+        _start = time.time()
+        try:
+            yield
+        except BaseException as _e:
+            self.record(error=_e)
+            raise
+        else:
+            self.record(time.time() - _start)
+        finally:
+            self.release()
+
+    def to_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "limit": self.current,
+            "min": self.min_limit,
+            "max": self.max_limit,
+            "inflight": self.inflight,
+            "successes": self.successes,
+            "overloads": self.overloads,
+        }
+
+
+class ConcurrencyManager:
+    """管理每个服务器每个阶段的AIMDLimiter"""
+
+    def __init__(self):
+        self._limiters: dict[tuple[str, Stage], AIMDLimiter] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def stage_max(server: AlistServer, stage: Stage) -> int:
+        if stage == "scan":
+            _max = server.max_scan
+            if sync_config.thread_pool_max_size.scanner:
+                _max = min(_max, sync_config.thread_pool_max_size.scanner)
+            return _max
+        if stage == "check":
+            return server.max_check
+        return server.max_connect
+
+    def limiter(self, server: str, stage: Stage) -> AIMDLimiter:
+        """server: 服务器的base_url或其中的路径"""
+        _server = sync_config.get_server(server)
+        key = (_server.base_url, stage)
+        with self._lock:
+            if key not in self._limiters:
+                _max = self.stage_max(_server, stage)
+                # 不使用自适应并发时, 并发数固定为阶段上限
+                self._limiters[key] = AIMDLimiter(
+                    f"{_server.base_url} {stage}",
+                    _server.min_connect if _server.adaptive_concurrency else _max,
+                    _max,
+                    initial=None if _server.adaptive_concurrency else _max,
+                )
+            return self._limiters[key]
+
+    def overloaded(self, server: str, error: BaseException):
+        """服务器过载时, 该服务器的全部阶段都减少并发"""
+        base_url = sync_config.get_server(server).base_url
+        for (_url, _), _limiter in list(self._limiters.items()):
+            if _url == base_url:
+                _limiter.record(error=error)
+
+    def states(self) -> list[dict]:
+        return [v.to_dict() for v in self._limiters.values()]
+
+
+_concurrency: ConcurrencyManager | None = None
+_concurrency_lock = threading.Lock()
+
+
+def get_concurrency() -> ConcurrencyManager:
+    """全局唯一的ConcurrencyManager"""
+    global _concurrency
+    with _concurrency_lock:
+        if _concurrency is None:
+            _concurrency = ConcurrencyManager()
+        return _concurrency
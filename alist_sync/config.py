@@ -2,10 +2,10 @@ import builtins
 import logging
 import os
 import time
-from datetime import datetime
+from datetime import datetime, time as day_time
 from pathlib import Path
 from functools import cached_property, lru_cache
-from typing import Optional, Literal, TYPE_CHECKING, Any, Annotated
+from typing import Optional, Literal, TYPE_CHECKING, Any, Annotated, ClassVar
 
 from alist_sdk import AlistPathType, AlistPath
 from alist_sdk.path_lib import AlistPathPydanticAnnotation
@@ -14,8 +14,11 @@ from pydantic import Field, BaseModel, BeforeValidator
 from pymongo.database import Database
 
 
+from alist_sync.common import parse_rate
+from alist_sync.matcher import PathMatcher
+
 if TYPE_CHECKING:
-    from alist_sync.data_handle import ShelveHandle, MongoHandle
+    from alist_sync.data_handle import HandleBase
 
 logger = logging.getLogger("alist-sync.config")
 
@@ -54,6 +57,32 @@ def create_config():
     return _sync_config
 
 
+# 带宽, 字节/秒, None 不限制; 配置中可以使用 20Mbit、2.5MB/s 等
+RateType = Annotated[float | None, BeforeValidator(parse_rate)]
+
+
+class BandwidthProfile(BaseModel):
+    """按时间段的带宽限制, end 小于 start 时跨过午夜, 如 22:00 - 07:00"""
+
+    start: day_time
+    end: day_time
+    limit: RateType = None
+
+    def contains(self, now: day_time) -> bool:
+        if self.start <= self.end:
+            return self.start <= now < self.end
+        return now >= self.start or now < self.end
+
+
+def active_rate(limit: float | None, profiles: list[BandwidthProfile]) -> float | None:
+    """当前时间的带宽限制: 第一个包含当前时间的时间段, 没有时使用limit"""
+    now = datetime.now().time()
+    for _profile in profiles:
+        if _profile.contains(now):
+            return _profile.limit
+    return limit
+
+
 class AlistServer(BaseModel):
     """"""
 
@@ -64,18 +93,55 @@ class AlistServer(BaseModel):
     has_opt: Optional[bool] = False
 
     max_connect: int = 30  # 最大同时连接数
+    # 每个挂载点同时执行的Worker数量, 未配置的挂载点使用max_connect, 如: {"/baidu": 2}
+    mount_max_connect: dict[str, int] = {}
+    max_scan: int = 10  # 扫描时同时进行的列目录请求数
+    max_check: int = 4  # 检查时同时进行的列目录请求数
+    # 元数据请求(列目录)的QPS, 扫描、检查与复查共享, None 不限制
+    max_qps: float | None = None
+    # 每个挂载点的QPS, 使用最长匹配的前缀, 与 max_qps 同时生效, 如: {"/baidu": 2}
+    mount_max_qps: dict[str, float] = {}
+    # 自适应并发(AIMD): 扫描、检查与传输的并发数在 [min_connect, 各自的上限] 之间调整,
+    # 延迟与错误率正常时增加, 超时、429/5xx 或延迟增加时减少; False 时固定为上限
+    adaptive_concurrency: bool = True
+    min_connect: int = 1
     storage_config: Optional[Path] = None
 
+    # 分段下载: 大于 segment_threshold 的文件, 使用 segment_count 个连接并行下载
+    segment_threshold: int = 128 * 1024 * 1024
+    segment_count: int = 4
+
+    # 离线下载: 从其他服务器复制到本服务器时, 由本服务器的离线下载工具拉取源文件
+    # 例如 SimpleHttp、aria2、qBittorrent, None 不使用离线下载
+    offline_download_tool: str | None = None
+
     # httpx 的参数
     verify: Optional[bool] = True
     headers: Optional[dict] = None
+    http2: bool = False  # 使用HTTP/2, 需要安装 h2
+
+    # 与该服务器之间的传输带宽, 不在 bandwidth_profiles 的时间段内时使用 bandwidth_limit
+    bandwidth_limit: RateType = None
+    bandwidth_profiles: list[BandwidthProfile] = []
+
+    # 传递给 AlistClient 的参数, 其他字段只在 alist-sync 中使用
+    _client_fields: ClassVar[set[str]] = {
+        "base_url",
+        "username",
+        "password",
+        "token",
+        "has_opt",
+        "max_connect",
+        "verify",
+        "headers",
+    }
 
     def dump_for_alist_client(self):
-        return self.model_dump(exclude={"storage_config"})
+        return self.model_dump(include=self._client_fields)
 
     def dump_for_alist_path(self):
         _data = self.model_dump(
-            exclude={"storage_config", "max_connect"},
+            include=self._client_fields - {"max_connect"},
             by_alias=True,
         )
         _data["server"] = _data.pop("base_url")
@@ -99,9 +165,38 @@ class SyncGroup(BaseModel):
     need_backup: bool = False
     backup_dir: str = ".alist-sync-backup"
     blacklist: Annotated[list[str], BeforeValidator(lambda x: set_add(x))] = []
-    whitelist: Annotated[list[str], BeforeValidator(lambda x: set_add(x))] = []
+    # 白名单不为空时, 只同步匹配白名单的文件
+    whitelist: list[str] = []
+    # dir: 按目录对比, 每个目录每一侧只列出一次; file: 逐个文件获取stat
+    check_mode: Literal["dir", "file"] = "dir"
     group: list[PAlistPathType] = Field(min_length=2)
 
+    @cached_property
+    def matcher(self) -> PathMatcher:
+        """编译后的黑名单/白名单"""
+        return PathMatcher(self.blacklist, self.whitelist)
+
+    @cached_property
+    def _group_uris(self) -> list[tuple[AlistPath, str]]:
+        return sorted(
+            ((sr, sr.as_uri().rstrip("/")) for sr in self.group),
+            key=lambda x: len(x[1]),
+            reverse=True,
+        )
+
+    def split_path(self, path: AlistPath) -> tuple[AlistPath, str]:
+        """将Path切割为sync_dir和相对路径"""
+        _uri = path.as_uri()
+        for sr, sr_uri in self._group_uris:
+            if _uri == sr_uri:
+                return sr, "."
+            if _uri.startswith(sr_uri + "/"):
+                return sr, _uri[len(sr_uri) + 1 :]
+        raise ValueError(f"{path} 不在同步组 {self.name} 中")
+
+    def is_ignore(self, path: AlistPath, is_dir: bool = False) -> bool:
+        return self.matcher.is_ignore(self.split_path(path)[1], is_dir)
+
 
 NotifyType = Literal["email", "webhook"]
 
@@ -123,6 +218,14 @@ class WebHookNotify(BaseModel):
     headers: dict[str, str]
 
 
+class ThreadPoolMaxSize(BaseModel):
+    """线程数量"""
+
+    workers: int = 0  # 执行Worker的线程数, 0 为全部服务器的 max_connect 之和
+    scanner: int = 0  # 每个扫描器同时列目录的协程数上限, 0 为服务器的 max_scan
+    checker: int = 10  # Checker对比目录的线程数
+
+
 class Config(BaseModel):
     """配置"""
 
@@ -140,6 +243,63 @@ class Config(BaseModel):
     )
 
     timeout: int = Field(10)
+
+    thread_pool_max_size: ThreadPoolMaxSize = Field(default_factory=ThreadPoolMaxSize)
+
+    # 全部传输(下载与上传)的总带宽, 不在 bandwidth_profiles 的时间段内时使用 bandwidth_limit
+    bandwidth_limit: RateType = Field(None)
+    bandwidth_profiles: list[BandwidthProfile] = []
+
+    # 按服务器的退避重试: 最多重试 retry_max 次, 等待时间从 retry_base_delay 开始翻倍,
+    # 不超过 retry_max_delay, 并加入随机抖动; 服务器返回的 Retry-After 优先
+    retry_max: int = Field(5)
+    retry_base_delay: float = Field(1)
+    retry_max_delay: float = Field(60)
+    # 熔断: 一个服务器连续失败 breaker_threshold 次后, breaker_cooldown 秒内不再调度新的Worker
+    breaker_threshold: int = Field(5)
+    breaker_cooldown: int = Field(60)
+
+    # 小于 small_file_size 的文件使用小文件通道, 每个挂载点保留 small_file_slots 个位置,
+    # 挂载点的位置不多于 small_file_slots 时, 只保留 位置数-1 个, 只有1个位置时不保留
+    small_file_size: int = Field(1024 * 1024)
+    small_file_slots: int = Field(2)
+    # 预算模式(非daemon): 在 timeout 截止之前完成尽可能多的 files(文件数量) 或 bytes(字节数)
+    schedule_budget: Literal["", "files", "bytes"] = Field("")
+
+    # 流式复制: 下载的同时上传, 不使用临时文件; 失败的目标使用临时文件重试
+    stream_copy: bool = Field(False)
+    # 流式复制时, 每个目标最多缓存的数据块数量, 每块 1MiB
+    stream_buffer: int = Field(8)
+
+    # 内存传输: 不大于 memory_copy_size 的文件下载到内存中直接上传, 不使用临时文件, 0 不使用
+    memory_copy_size: int = Field(4 * 1024 * 1024)
+    # 全部的内存传输同时占用的内存上限, 不能小于 memory_copy_size
+    memory_budget: int = Field(256 * 1024 * 1024)
+
+    # Worker状态的写入: strict 每次更新立即写入; normal 合并同一个Worker的更新,
+    # 每 state_flush_interval 秒或达到 state_flush_size 个时批量写入, Worker结束时立即写入;
+    # fast 与 normal 相同, 但Worker结束时不等待写入完成
+    state_durability: Literal["strict", "normal", "fast"] = Field("normal")
+    state_flush_interval: float = Field(1)
+    state_flush_size: int = Field(500)
+    # 传输日志的保存时间(秒), MongoDB 使用TTL索引自动删除, SQLite 启动时删除, 0 永久保存
+    log_ttl: int = Field(30 * 86400)
+
+    # 断点续传: 每下载多少字节, 保存一次下载进度
+    download_checkpoint: int = Field(64 * 1024 * 1024)
+
+    # 列目录缓存: 扫描器、检查器与复查共享, 结果的有效期(秒), 0 不缓存, 只合并同时的请求
+    listing_cache_ttl: float = Field(60)
+    # 列目录缓存占用内存的上限(字节, 估算值), 超过时淘汰最久没有使用的目录
+    listing_cache_size: int = Field(64 * 1024 * 1024)
+
+    # 目录快照的有效期(秒), 0 不使用快照, 只在 check_mode 为 dir 时使用
+    # 目录的修改时间与快照一致时使用快照中的列表, 不再列出该目录;
+    # 目标目录的修改时间也与快照中记录的一致时, 跳过该目录的对比
+    snapshot_ttl: int = Field(0)
+
+    # 服务端复制: 源文件与目标在同一个Alist服务器时, 由服务器完成复制, 不经过本机
+    server_copy: bool = Field(True)
     ua: str = None
 
     daemon: bool = getenv("ALIST_SYNC_DAEMON", "false").lower() in TrueValues
@@ -162,6 +322,12 @@ class Config(BaseModel):
         super().__init__(**data)
         import logging.config
 
+        if self.memory_copy_size > self.memory_budget:
+            raise ValueError(
+                f"memory_copy_size({self.memory_copy_size}) "
+                f"不能大于 memory_budget({self.memory_budget})"
+            )
+
         _ = self.start_time
         if self.logs:
             Path("logs").mkdir(exist_ok=True, parents=True)
@@ -188,6 +354,10 @@ class Config(BaseModel):
                 return server
         raise ModuleNotFoundError()
 
+    def is_same_server(self, path_a, path_b) -> bool:
+        """两个路径是否在同一个Alist服务器上"""
+        return self.get_server(path_a) is self.get_server(path_b)
+
     @cached_property
     def mongodb(self) -> "Database|None":
         from pymongo import MongoClient
@@ -207,12 +377,21 @@ class Config(BaseModel):
         return db
 
     @cached_property
-    def handle(self) -> "ShelveHandle|MongoHandle":
-        from alist_sync.data_handle import ShelveHandle, MongoHandle
+    def handle(self) -> "HandleBase":
+        from alist_sync.data_handle import SQLiteHandle, MongoHandle, WriteBehindHandle
 
         if self.mongodb is None:
-            return ShelveHandle(self.cache_dir)
-        return MongoHandle(self.mongodb)
+            _handle = SQLiteHandle(self.cache_dir, log_ttl=self.log_ttl)
+        else:
+            _handle = MongoHandle(self.mongodb, log_ttl=self.log_ttl)
+        if self.state_durability == "strict":
+            return _handle
+        return WriteBehindHandle(
+            _handle,
+            interval=self.state_flush_interval,
+            max_pending=self.state_flush_size,
+            durability=self.state_durability,
+        )
 
     @classmethod
     def load_from_yaml(cls, file: Path) -> "Config":
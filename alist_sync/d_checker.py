@@ -7,21 +7,25 @@
 
 """
 import datetime
-import fnmatch
 import logging
 import threading
 import time
 from queue import Queue, Empty
-from typing import Iterator
-from functools import lru_cache
+from typing import Iterator, Iterable
 
 from alist_sdk import AlistPath, RawItem, AlistPathType, Item
 from pydantic import BaseModel
 
+from alist_sync.concurrency import get_concurrency
 from alist_sync.config import create_config, SyncGroup
-from alist_sync.d_worker import Worker
+from alist_sync.d_worker import Worker, item_meta
+from alist_sync.listing_cache import get_listing_cache
+from alist_sync.qps import get_qps
+from alist_sync.err import CheckerError
+from alist_sync.scanner import ScanDir
 from alist_sync.thread_pool import MyThreadPoolExecutor
-from alist_sync.common import prefix_in_threads
+from alist_sync.common import prefix_in_threads, merge_join, busy_error, is_not_found
+from alist_sync.retry import get_retry_policy
 
 
 logger = logging.getLogger("alist-sync.d_checker")
@@ -47,31 +51,32 @@ class Checker:
     def __init__(self, sync_group: SyncGroup, scaner_queue: Queue, worker_queue: Queue):
         self.sync_group: SyncGroup = sync_group
         self.worker_queue = worker_queue
-        self.scaner_queue: Queue[AlistPath] = scaner_queue
+        self.scaner_queue: Queue[AlistPath | ScanDir] = scaner_queue
 
         self.conflict: set = set()
-        self.pool = MyThreadPoolExecutor(10)
-        self.stat_sq = threading.Semaphore(4)
+        self.pool = MyThreadPoolExecutor(sync_config.thread_pool_max_size.checker)
         self.main_thread = threading.Thread(
             target=self.main,
             name=f"checker_main[{self.sync_group.name}-{self.__class__.__name__}]",
         )
 
-    @lru_cache(64)
     def split_path(self, path: AlistPath) -> tuple[AlistPath, str]:
         """将Path切割为sync_dir和相对路径"""
-        for sr in self.sync_group.group:
-            try:
-                return sr, path.relative_to(sr)
-            except ValueError:
-                pass
-        raise ValueError()
+        return self.sync_group.split_path(path)
 
     def get_backup_dir(self, path) -> AlistPath:
         return self.split_path(path)[0].joinpath(self.sync_group.backup_dir)
 
-    def create_worker(self, type_: str, source_path: AlistPath, target_path: AlistPath):
+    def create_worker(
+        self,
+        type_: str,
+        source_path: AlistPath,
+        target_path: AlistPath,
+        source_stat: Item | None = None,
+    ):
+        """source_stat为列目录得到的源文件信息, Worker不再重复获取"""
         return Worker(
+            **(item_meta(source_stat) if source_stat is not None else {}),
             type=type_,
             group_name=self.sync_group.name,
             need_backup=self.sync_group.need_backup,
@@ -83,19 +88,41 @@ class Checker:
 
     _stat_get_times = 0
 
-    @lru_cache(40_000)
     def get_stat(self, path: AlistPath) -> SyncRawItem:
-        # BUGFIX  控制QPS而不时并发
-        with self.stat_sq:
+        """从父目录的列表中取得path的信息, 同一个目录的文件共享一次列目录"""
+        stat = next(
+            (i for i in self.list_dir(path.parent) if i.name == path.name), None
+        )
+        return SyncRawItem(path=path, stat=stat)
+
+    def list_dir(self, path: AlistPath, since: float | None = None) -> list[Item]:
+        """列出目录中的全部项目, 目录不存在时返回空列表, 结果由共享的缓存保存
+
+        服务器繁忙时按服务器退避重试, 遵守Retry-After。
+        :param since: time.monotonic() 的时间, 只使用在此之后开始的列表
+        """
+        return get_listing_cache().get(
+            path,
+            lambda: get_retry_policy().call(
+                sync_config.get_server(path.as_uri()).base_url, self._list_dir, path
+            ),
+            since=since,
+        )
+
+    def _list_dir(self, path: AlistPath) -> list[Item]:
+        # 控制QPS, 同时限制并发; 429/5xx 在并发位置中抛出, 计入自适应并发
+        get_qps().acquire(path)
+        with get_concurrency().limiter(path.as_uri(), "check").slot():
             self._stat_get_times += 1
-            logger.debug("get_stat: %s, times: %d", path, self._stat_get_times)
-            try:
-                stat = path.client.dict_files_items(
-                    path.parent.as_posix(), cache_empty=True
-                ).get(path.name)
-            except FileNotFoundError:
-                stat = None
-            return SyncRawItem(path=path, stat=stat)
+            logger.debug("list_dir: %s, times: %d", path, self._stat_get_times)
+            _res = path.client.list_files(path.as_posix(), refresh=True)
+            if (_e := busy_error(_res, path.as_uri())) is not None:
+                raise _e
+        if _res.code == 200:
+            return _res.data.content or []
+        if is_not_found(_res):
+            return []
+        raise CheckerError(f"列出目录失败: {path} [{_res.code}]{_res.message}")
 
     def checker(
         self,
@@ -104,12 +131,8 @@ class Checker:
     ) -> "Worker|None":
         raise NotImplementedError
 
-    def ignore(self, relative_path) -> bool:
-        for _i in self.sync_group.blacklist:
-            if fnmatch.fnmatchcase(relative_path, _i):
-                logger.debug("Ignore: %s, [matched: %s]", relative_path, _i)
-                return True
-        return False
+    def ignore(self, relative_path, is_dir=False) -> bool:
+        return self.sync_group.matcher.is_ignore(relative_path, is_dir)
 
     def checker_every_dir(self, path) -> Iterator[Worker | None]:
         _sync_dir, _relative_path = self.split_path(path)
@@ -121,11 +144,164 @@ class Checker:
             target_path = _sd.joinpath(_relative_path)
             yield self.checker(self.get_stat(path), self.get_stat(target_path))
 
-    def _t_checker(self, path):
+    def checker_dir(self, scan_dir: ScanDir) -> list[Worker]:
+        """对比整个目录: 每一侧只列出一次目录, 使用排序合并连接配对文件"""
+        _sync_dir, _relative_path = self.split_path(scan_dir.path)
+        _source_files = [i for i in scan_dir.items if not i.is_dir]
+        logger.debug(f"Checking Dir [{_relative_path}] in {self.sync_group.group}")
+
+        workers = []
+        for _sd in self.sync_group.group:
+            _sd: AlistPath
+            if _sd == _sync_dir:
+                continue
+            target_dir = _sd.joinpath(_relative_path)
+            for _s, _t in merge_join(
+                _source_files,
+                self.list_dir(target_dir),
+                key=lambda x: x.name,
+            ):
+                if _t is not None and _t.is_dir:
+                    if _s is not None:
+                        logger.warning(f"Checked: [CONFLICT] {target_dir / _t.name}")
+                    continue
+                _name = (_s or _t).name
+                if _s is None and self.ignore(
+                    _name if _relative_path == "." else f"{_relative_path}/{_name}"
+                ):
+                    continue
+                _source_path = scan_dir.path.joinpath(_name)
+                if _s is not None:
+                    _source_path.set_stat(_s)
+                _worker = self.checker(
+                    SyncRawItem(path=_source_path, stat=_s),
+                    SyncRawItem(path=target_dir.joinpath(_name), stat=_t),
+                )
+                if _worker is not None:
+                    workers.append(_worker)
+        return workers
+
+    @staticmethod
+    def fanout(workers: Iterable[Worker | None]) -> list[Worker]:
+        """相同源文件的copy Worker合并为一个, 源文件只下载一次, 然后上传到全部目标"""
+        _copies: dict[str, Worker] = {}
+        _workers = []
+        for _w in workers:
+            if _w is None:
+                continue
+            if _w.type != "copy":
+                _workers.append(_w)
+                continue
+            _key = _w.source_path.as_uri()
+            if _key in _copies:
+                _copies[_key].add_target(_w.target_path)
+                continue
+            _copies[_key] = _w
+            _workers.append(_w)
+        return _workers
+
+    def target_dirs(self, scan_dir: ScanDir) -> list[AlistPath]:
+        """与scan_dir对应的其他同步目录中的目录"""
+        _sync_dir, _relative_path = self.split_path(scan_dir.path)
+        return [
+            _sd.joinpath(_relative_path)
+            for _sd in self.sync_group.group
+            if _sd != _sync_dir
+        ]
+
+    def target_modified(
+        self, target_dirs: list[AlistPath], since: float | None = None
+    ) -> dict[str, datetime.datetime]:
+        """目标目录自身的修改时间, 从父目录的列表中取得, 同级目录共享一次列目录;
+        不存在或没有修改时间的目录不记录"""
+        _modified = {}
+        for _dir in target_dirs:
+            _stat = next(
+                (
+                    i
+                    for i in self.list_dir(_dir.parent, since)
+                    if i.name == _dir.name and i.is_dir
+                ),
+                None,
+            )
+            if _stat is not None and _stat.modified is not None:
+                _modified[_dir.as_uri()] = _stat.modified
+        return _modified
+
+    def targets_unchanged(
+        self, scan_dir: ScanDir, targets: dict[str, datetime.datetime]
+    ) -> bool:
+        """源目录使用了快照, 并且全部目标目录的修改时间与快照中记录的一致"""
+        if not scan_dir.reused or scan_dir.snapshot is None:
+            return False
+        _expected = scan_dir.snapshot.targets
+        return (
+            bool(_expected)
+            and len(targets) == len(self.target_dirs(scan_dir))
+            and targets == _expected
+        )
+
+    def save_snapshot(self, scan_dir: ScanDir, targets: dict[str, datetime.datetime]):
+        logger.debug(f"Snapshot: 目录已经同步, 保存快照: {scan_dir.path}")
+        sync_config.handle.update_file_item(
+            scan_dir.path, scan_dir.snapshot.model_copy(update={"targets": targets})
+        )
+
+    def confirm_snapshot(
+        self,
+        scan_dir: ScanDir,
+        workers: list[Worker],
+        targets: dict[str, datetime.datetime],
+    ):
+        """目录与目标一致后才保存快照: 没有Worker时立即保存, 目标目录的修改时间使用对比之前取得的targets;
+        否则在全部Worker完成后重新取得目标目录的修改时间并保存, 任一Worker失败或没有被执行时不保存"""
+        if scan_dir.snapshot is None:
+            return
+        if not workers:
+            self.save_snapshot(scan_dir, targets)
+            return
+
+        lock = threading.Lock()
+        pending, failed = {w.id for w in workers}, set()
+
+        def _finish(worker: Worker):
+            with lock:
+                pending.discard(worker.id)
+                if worker.status != "done":
+                    failed.add(worker.id)
+                if pending or failed:
+                    return
+            try:
+                # Worker修改了目标目录, 只接受现在之后的列表
+                _targets = self.target_modified(
+                    self.target_dirs(scan_dir), since=time.monotonic()
+                )
+            except Exception as _e:
+                logger.warning(f"Snapshot: 取得目标目录失败, 不保存快照: {_e}")
+                return
+            self.save_snapshot(scan_dir, _targets)
+
+        for _w in workers:
+            _w.on_finish = _finish
+
+    def _t_checker(self, path: AlistPath | ScanDir):
         try:
-            for _c in self.checker_every_dir(path):
-                if _c:
-                    self.worker_queue.put(_c)
+            if isinstance(path, ScanDir):
+                # 在对比之前取得目标目录的修改时间, 对比期间目标的变化留给下一次检查
+                _targets = (
+                    {}
+                    if path.snapshot is None
+                    else self.target_modified(self.target_dirs(path))
+                )
+                if self.targets_unchanged(path, _targets):
+                    logger.debug(f"Snapshot: 源和目标都未变化, 跳过: {path.path}")
+                    return
+                _workers = self.fanout(self.checker_dir(path))
+                self.confirm_snapshot(path, _workers, _targets)
+            else:
+                _workers = self.fanout(self.checker_every_dir(path))
+            for _c in _workers:
+                self.worker_queue.put(_c)
         except Exception as _e:
             logger.error("Checker Error: ", exc_info=_e)
 
@@ -172,6 +348,9 @@ class CheckerCopy(Checker):
     def checker(
         self, source_stat: SyncRawItem, target_stat: SyncRawItem
     ) -> "Worker|None":
+        if not source_stat.exists():
+            return None
+
         if not target_stat.exists():
             logger.info(
                 f"Checked: [COPY] {source_stat.path.as_uri()} -> {target_stat.path.as_uri()}"
@@ -180,6 +359,7 @@ class CheckerCopy(Checker):
                 type_="copy",
                 source_path=source_stat.path,
                 target_path=target_stat.path,
+                source_stat=source_stat.stat,
             )
 
         logger.info(f"Checked: [JUMP] {source_stat.path.as_uri()}")
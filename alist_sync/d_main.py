@@ -2,95 +2,82 @@
 """
 
 """
+import asyncio
 import collections
-import fnmatch
 import logging
 import threading
 import time
-from functools import lru_cache
-from queue import Queue
+from queue import Queue, Full
 from typing import Callable
 
-import alist_sdk
-
-from alist_sdk import AlistPath, login_server
+from alist_sdk import AlistPath
 
+from alist_sync.alist_client import create_async_client
+from alist_sync.concurrency import get_concurrency
+from alist_sync.listing_cache import get_listing_cache
+from alist_sync.qps import get_qps
 from alist_sync.d_worker import Workers
-from alist_sync.thread_pool import MyThreadPoolExecutor
 from alist_sync.config import SyncGroup, create_config, AlistServer
-from alist_sync.common import beautify_size, all_thread_name
+from alist_sync.common import beautify_size
 from alist_sync.d_checker import get_checker
+from alist_sync.matcher import PathMatcher
+from alist_sync.scanner import Scanner
+from alist_sync.session import get_session
 
 sync_config = create_config()
 logger = logging.getLogger("alist-sync.main")
 
 
 def login_alist(server: AlistServer):
-    """"""
-    _c = login_server(**server.dump_for_alist_path())
-    logger.info("Login: %s[%s] Success.", _c.base_url, _c.login_username)
+    """登陆服务器, 同一个服务器只登陆一次, 全部的组共享同一个客户端"""
+    get_session().client(server)
 
 
-def _make_ignore(_sync_group):
-    @lru_cache(64)
-    def split_path(_sync_group, path: AlistPath) -> tuple[AlistPath, str]:
-        """将Path切割为sync_dir和相对路径"""
-        for sr in _sync_group.group:
-            try:
-                re_path = path.relative_to(sr).rstrip("./")
-                if re_path.startswith("./"):
-                    re_path = re_path[2:]
-                return sr, re_path
-            except ValueError:
-                pass
-        raise ValueError()
-
-    def __ignore(relative_path) -> bool:
-        _, relative_path = split_path(_sync_group, relative_path)
-        for _i in _sync_group.blacklist:
-            if fnmatch.fnmatchcase(relative_path, _i):
-                logger.debug("Ignore: %s, [matched: %s]", relative_path, _i)
-                return True
-        return False
-
-    return __ignore
-
-
-def scaner(url: AlistPath, _queue, i_func: Callable[[str | AlistPath], bool] = None):
-    def _scaner(_url: AlistPath, _s_num):
-        """ """
-        if i_func is not None and i_func(_url):
-            return
-        logger.debug(f"Scaner: {_url}")
+def scaner(
+    url: AlistPath,
+    _queue,
+    matcher: PathMatcher = None,
+    by_dir: bool = False,
+):
+    """使用异步扫描器扫描url, 扫描到的文件(by_dir时为目录)放入_queue, 扫描完成后返回"""
+
+    async def _put(_item):
         try:
-            _s_num.append(1)
-            for item in _url.iterdir():
-                if item.is_file():
-                    logger.debug(f"Find File: {item}")
-                    _queue.put(item)
-                elif item.is_dir():
-                    pool.submit(_scaner, item, _s_num)
-        except alist_sdk.AlistError:
-            pass
-        except Exception as _e:
-            logger.error("Scaner Error: %s", _e, exc_info=_e)
-        finally:
-            _s_num.pop()
+            _queue.put_nowait(_item)
+        except Full:
+            await asyncio.to_thread(_queue.put, _item)
+
+    async def _scaner():
+        _client = create_async_client(url.client)
+        _limiter = get_concurrency().limiter(url.as_uri(), "scan")
+        _scanner = Scanner(
+            _client,
+            max_listing=_limiter.max_limit,
+            limiter=_limiter,
+            qps=get_qps(),
+            cache=get_listing_cache(),
+            matcher=matcher,
+            # 快照按目录确认, 只用于按目录检查
+            snapshot=sync_config.handle if by_dir else None,
+            snapshot_ttl=sync_config.snapshot_ttl,
+        )
+        async with _client:
+            if by_dir:
+                async for _dir in _scanner.iter_dirs(url):
+                    await _put(_dir)
+            else:
+                async for _file in _scanner.iter_files(url):
+                    await _put(_file)
 
     assert url.exists(), f"目录不存在{url.as_uri()}"
 
-    s_sum = []
-    with MyThreadPoolExecutor(5, thread_name_prefix=f"scaner_{url.as_uri()}") as pool:
-        pool.submit(_scaner, url, s_sum)
-        time.sleep(5)
-        while s_sum:
-            time.sleep(2)
-            logger.debug(
-                "Scaner Size: %s, %d, Threads[%s]",
-                url,
-                len(s_sum),
-                all_thread_name(),
-            )
+    _t = threading.Thread(
+        target=asyncio.run,
+        args=(_scaner(),),
+        name=f"scaner_{url.as_uri()}",
+    )
+    _t.start()
+    _t.join()
 
 
 def checker(sync_group: SyncGroup, _queue_worker: Queue) -> threading.Thread | None:
@@ -105,18 +92,17 @@ def checker(sync_group: SyncGroup, _queue_worker: Queue) -> threading.Thread | N
         login_alist(sync_config.get_server(uri.as_uri()))
 
     _queue_scaner = Queue(30)
-    _scaner_pool = MyThreadPoolExecutor(5, "scaner_")
 
     _ct = get_checker(sync_group.type)(sync_group, _queue_scaner, _queue_worker).start()
 
     _sign = ["copy"]
-    __ignore = _make_ignore(sync_group)
+    _by_dir = sync_group.check_mode == "dir"
     if sync_group.type in _sign:
         logger.debug(f"Copy 只需要扫描 {sync_group.group[0].as_uri() = }")
-        scaner(sync_group.group[0], _queue_scaner, __ignore)
+        scaner(sync_group.group[0], _queue_scaner, sync_group.matcher, _by_dir)
     else:
         for uri in sync_group.group:
-            scaner(uri, _queue_scaner, __ignore)
+            scaner(uri, _queue_scaner, sync_group.matcher, _by_dir)
 
     return _ct
 
@@ -130,6 +116,7 @@ def main():
         checker(sync_group, _queue_worker)
 
     _tw.join()
+    logger.info(f"列目录缓存: {get_listing_cache().stats()}")
 
 
 def main_check():
@@ -193,8 +180,8 @@ def main_debug():
 
     _tw = Workers()
 
-    def iter_file(url, i_func: Callable[[str], bool] | None = None):
-        if i_func is not None and i_func(url):
+    def iter_file(url, i_func: Callable[[AlistPath, bool], bool] | None = None):
+        if i_func is not None and i_func(url, url.is_dir()):
             return
 
         if url.is_file():
@@ -207,14 +194,13 @@ def main_debug():
 
     for sync_group in sync_config.sync_groups:
         _check = get_checker(sync_group.type)(sync_group, Queue(1), Queue(1))
-        _ignore = _make_ignore(sync_group)
         if sync_group.enable is False:
             logger.warning("Checker: %s is disable", sync_group.name)
             continue
         for uri in sync_group.group:
             login_alist(sync_config.get_server(uri.as_uri()))
 
-        for _file in iter_file(sync_group.group[0], _ignore):
+        for _file in iter_file(sync_group.group[0], sync_group.is_ignore):
             logger.debug(f"find file: {_file}")
             for _worker in _check.checker_every_dir(_file):
                 if _worker is None:
@@ -4,20 +4,39 @@ import logging
 import threading
 import time
 import traceback
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 from queue import Queue, Empty
-from typing import Literal, Any, Type
+from typing import Literal, Any, Callable
 
 from pydantic import BaseModel, computed_field, Field
 from pymongo.collection import Collection
-from httpx import Client, TimeoutException, Timeout
+from httpx import TimeoutException
+from alist_sdk import Item
 from alist_sdk.path_lib import AbsAlistPathType, AlistPath
 
+from alist_sync.bandwidth import get_bandwidth
 from alist_sync.config import create_config
-from alist_sync.common import sha1, prefix_in_threads, transfer_speed
-from alist_sync.err import WorkerError, RetryError
-from alist_sync.thread_pool import MyThreadPoolExecutor
-from alist_sync.version import __version__
+from alist_sync.common import sha1, prefix_in_threads, transfer_speed, check_response
+from alist_sync.listing_cache import get_listing_cache
+from alist_sync.downloader import (
+    MemoryBudget,
+    download_bytes,
+    put_stream,
+    upload_stream,
+    split_ranges,
+    download_ranges,
+    RangeNotSupported,
+    Throttle,
+    iter_file,
+    iter_throttled,
+)
+from alist_sync.err import WorkerError, UploadError, ServerBusyError
+from alist_sync.server_copy import get_server_copier
+from alist_sync.session import get_session
+from alist_sync.verifier import get_verifier
+from alist_sync.retry import get_retry_policy
+from alist_sync.scheduler import Scheduler
 
 sync_config = create_config()
 
@@ -41,17 +60,32 @@ WorkerStatusModify = Literal[*WorkerStatus]
 
 logger = logging.getLogger("alist-sync.worker")
 
-downloader_client = Client(
-    headers={"User-Agent": sync_config.ua or f"alist-sync/{__version__}"}
-)
+# 未完成的临时文件在最后一次修改后的保留时间
+TMP_FILE_KEEP = 7 * 24 * 3600
+
+
+def item_meta(item: Item) -> dict[str, Any]:
+    """从列目录的结果中取出Worker需要的源文件元数据"""
+    return {
+        "file_size": item.size,
+        "file_modified": item.modified,
+        "file_hash": (
+            item.hash_info.model_dump(exclude_none=True) if item.hash_info else None
+        ),
+    }
+
+
+memory_budget = MemoryBudget(sync_config.memory_budget)
+
+downloader_client = get_session().download_client()
 
 
 # noinspection PyTypeHints
 class Worker(BaseModel):
     owner: str = sync_config.name
-    group_name: str = None
+    group_name: str | None = None
 
-    created_at: datetime.datetime = datetime.datetime.now()
+    created_at: datetime.datetime = Field(default_factory=datetime.datetime.now)
     done_at: datetime.datetime | None = None
     type: WorkerTypeModify
     need_backup: bool
@@ -60,38 +94,57 @@ class Worker(BaseModel):
     relative_path: str | None = None
     source_path: AbsAlistPathType | None = None
     target_path: AbsAlistPathType  # 永远只操作Target文件，删除也是作为Target
+    # 源文件的元数据, 由Checker从列目录的结果中传入, 之后不再重复获取
+    file_size: int | None = None
+    file_modified: datetime.datetime | None = None
+    file_hash: dict[str, str] | None = None
+    # 扇出: 下载一次, 上传到target_path和extra_targets中的全部目标
+    extra_targets: list[AbsAlistPathType] = []
+    targets_status: dict[str, WorkerStatusModify] = {}
+    download_offset: int = 0  # 已经下载到临时文件中的字节数, 用于断点续传
+    download_segments: list[int] = []  # 分段下载时, 每一段已经下载的字节数
     status: WorkerStatusModify = "init"
     error_info: str | None = None
 
     # 私有属性
     workers: "Workers | None" = Field(None, exclude=True)
     collection: Collection | None = Field(None, exclude=True)
+    # 结束(done/failed)时调用一次, Checker用于确认目录快照
+    on_finish: Callable[["Worker"], None] | None = Field(None, exclude=True)
 
     model_config = {
         "arbitrary_types_allowed": True,
-        "excludes": {"workers", "collection", "tmp_file"},
+        "excludes": {"workers", "collection", "tmp_file", "on_finish"},
     }
 
     def __init__(self, **data: Any):
         super().__init__(**data)
+        if self.source_path is not None and self.file_size is None:
+            self.__dict__.update(item_meta(self.source_path.stat()))
         logger.info(
             f"Worker[{self.short_id}] Created: " f"{self.model_dump_json(indent=2)}"
         )
 
     def __repr__(self):
-        return f"<Worker {self.type}: {self.source_path} -> {self.target_path}>"
+        return f"<Worker {self.type}: {self.source_path} -> {self.all_targets}>"
 
-    @computed_field()
     @property
-    def file_size(self) -> int | None:
-        if self.source_path is None:
-            return None
-        return self.source_path.stat().size
+    def all_targets(self) -> list[AlistPath]:
+        return [self.target_path, *self.extra_targets]
+
+    def add_target(self, target_path: AlistPath):
+        """添加一个扇出目标"""
+        if target_path not in self.all_targets:
+            self.extra_targets.append(target_path)
 
     @computed_field(return_type=str, alias="_id")
     @property
     def id(self) -> str:
-        return sha1(f"{self.type}{self.source_path}{self.created_at}")
+        """由任务的内容决定, 同一个源文件版本到同一个目标的任务, 重启后的id不变"""
+        return sha1(
+            f"{self.type}{self.source_path}{self.target_path}"
+            f"{self.file_size}{self.file_modified}"
+        )
 
     @property
     def short_id(self) -> str:
@@ -100,7 +153,16 @@ class Worker(BaseModel):
     @computed_field()
     @property
     def tmp_file(self) -> Path:
-        return sync_config.cache_dir.joinpath(f"download_tmp_{sha1(self.source_path)}")
+        """临时文件, 与源文件的路径、大小、修改时间绑定, 重启后可以继续下载"""
+        return sync_config.cache_dir.joinpath(
+            "download_tmp_"
+            f"{sha1(f'{self.source_path}{self.file_size}{self.file_modified}')}"
+        )
+
+    @property
+    def modified_ms(self) -> int:
+        """源文件的修改时间, 毫秒时间戳, 用于上传时的Last-Modified"""
+        return int(self.file_modified.timestamp() * 1000)
 
     def update(self, **field: Any):
         if (status := field.get("status", "init")) not in WorkerStatus:
@@ -117,12 +179,21 @@ class Worker(BaseModel):
             if self.status == "done":
                 logger.info(
                     f"Worker[{self.short_id}] "
-                    f"{self.source_path} -> {self.target_path} "
+                    f"{self.source_path} -> {self.all_targets} "
                     f"平均传输速度: "
                     f"{transfer_speed(self.file_size, self.done_at, self.created_at)}"
                 )
-            self.tmp_file.unlink(missing_ok=True)
-            return sync_config.handle.delete_worker(self.id)
+            if self.status == "done":
+                self.tmp_file.unlink(missing_ok=True)
+            # 目标所在目录的内容已经改变
+            get_listing_cache().invalidate(*{t.parent for t in self.all_targets})
+            if self.workers is not None:
+                self.workers.release_lock(self.source_path, *self.all_targets)
+            _res = sync_config.handle.delete_worker(self.id)
+            if (_on_finish := self.on_finish) is not None:
+                self.on_finish = None
+                _on_finish(self)
+            return _res
 
         return sync_config.handle.update_worker(self, *field.keys())
 
@@ -151,96 +222,339 @@ class Worker(BaseModel):
         self.update(status="back-upped")
         logger.info(f"Worker[{self.short_id}] Backup Success.")
 
-    def __retry(
-        self,
-        retry: int,
-        excepts: tuple[Type[Exception], ...],
-        func,
-        *args,
-        **kwargs,
-    ):
-        while retry > 0:
-            try:
-                return func(*args, **kwargs)
-            except excepts as _e:
-                if retry <= 0:
-                    logger.error(
-                        f"Worker[{self.short_id}] Retry Error [{func.__name__}]: "
-                        f"{type(_e)} - {_e}"
-                    )
-                    raise RetryError(f"Retry {func.__name__} Error.") from _e
-                logger.warning(
-                    f"Worker[{self.short_id}] {retry = } [{func.__name__}]: "
-                    f"{type(_e)} - {_e}"
-                )
-                retry -= 1
-                continue
+    @staticmethod
+    def server_of(path: AlistPath) -> str:
+        """path所在的服务器, 用于按服务器重试与熔断"""
+        return sync_config.get_server(path.as_uri()).base_url
+
+    @staticmethod
+    def server_of_request(error: TimeoutException) -> str | None:
+        """超时的请求所在的服务器; 请求的不是Alist服务器(如下载重定向到的存储)时为None"""
+        try:
+            return sync_config.get_server(str(error.request.url)).base_url
+        except (RuntimeError, ModuleNotFoundError):
+            return None
+
+    @staticmethod
+    def throttle(path: AlistPath) -> Throttle | None:
+        """与path所在服务器之间传输时的限速函数"""
+        return get_bandwidth().throttle(path.as_uri())
 
     def downloader(self):
-        """HTTP多线程下载"""
-        # download
-        with self.tmp_file.open("wb") as _tmp:
-            with downloader_client.stream(
-                "GET",
-                self.source_path.get_download_uri(),
-                follow_redirects=True,
-            ) as _res:
-                logger.debug(
-                    f"Worker[{self.short_id}] Downloading from {self.source_path}"
-                )
-                for i in _res.iter_bytes(chunk_size=1024 * 1024):
+        """HTTP下载, 临时文件已经存在时, 使用Range从其末尾继续下载"""
+        size = self.file_size
+        offset = self.tmp_file.stat().st_size if self.tmp_file.exists() else 0
+        if offset > size:
+            offset = 0
+        if offset == size and self.tmp_file.exists():
+            logger.info(f"Worker[{self.short_id}] 临时文件已经下载完成.")
+            return self.update(status="downloaded", download_offset=offset)
+
+        with downloader_client.stream(
+            "GET",
+            self.source_path.get_download_uri(),
+            headers={"Range": f"bytes={offset}-"} if offset else None,
+            follow_redirects=True,
+        ) as _res:
+            check_response(_res)
+            if _res.status_code == 416:
+                self.tmp_file.unlink(missing_ok=True)
+            assert _res.status_code in (200, 206), f"下载失败: {_res.status_code}"
+            if _res.status_code == 200:
+                offset = 0
+            logger.debug(
+                f"Worker[{self.short_id}] Downloading from {self.source_path}, "
+                f"offset: {offset}"
+            )
+
+            _checkpoint = offset
+            with self.tmp_file.open("ab" if offset else "wb") as _tmp:
+                _chunks = _res.iter_bytes(chunk_size=1024 * 1024)
+                if (_throttle := self.throttle(self.source_path)) is not None:
+                    _chunks = iter_throttled(_chunks, _throttle)
+                for i in _chunks:
                     _tmp.write(i)
+                    offset += len(i)
+                    if offset - _checkpoint >= sync_config.download_checkpoint:
+                        _tmp.flush()
+                        _checkpoint = offset
+                        self.update(download_offset=offset)
         assert (
             self.tmp_file.exists()
-            and self.tmp_file.stat().st_size == self.source_path.stat().size
+            and self.tmp_file.stat().st_size == self.file_size
         ), "下载后文件大小不一致"
-        self.update(status="downloaded")
+        self.update(status="downloaded", download_offset=offset)
 
-    def uploader(self):
-        import urllib.parse
+    def use_segments(self) -> bool:
+        server = sync_config.get_server(self.source_path.as_uri())
+        return server.segment_count > 1 and self.file_size >= server.segment_threshold
 
-        # upload
-        with self.tmp_file.open("rb") as fs:
-            res = self.target_path.client.verify_request(
-                "PUT",
-                "/api/fs/put",
-                headers={
-                    "As-Task": "false",
-                    "Content-Type": "application/octet-stream",
-                    "Last-Modified": str(
-                        int(self.source_path.stat().modified.timestamp() * 1000)
-                    ),
-                    "File-Path": urllib.parse.quote(str(self.target_path.as_posix())),
-                },
-                content=fs,
-                timeout=Timeout(300, read=300, write=300, connect=300),
-            )
+    def segment_downloader(self):
+        """分段下载: 多个连接并行下载到预分配的文件, 完成后重命名为tmp_file"""
+        size = self.file_size
+        server = sync_config.get_server(self.source_path.as_uri())
+        ranges = split_ranges(size, server.segment_count)
+        seg_file = self.tmp_file.with_name(self.tmp_file.name + ".seg")
+
+        if seg_file.exists() and len(self.download_segments) == len(ranges):
+            progress = list(self.download_segments)
+        else:
+            progress = [0] * len(ranges)
+            with seg_file.open("wb") as _f:
+                _f.truncate(size)
 
-        assert res.code == 200
+        logger.debug(
+            f"Worker[{self.short_id}] Segment Downloading from {self.source_path}, "
+            f"segments: {len(ranges)}, progress: {progress}"
+        )
+        try:
+            download_ranges(
+                self.source_path.get_download_uri(),
+                seg_file,
+                ranges,
+                downloader_client,
+                progress,
+                checkpoint=lambda p: self.update(download_segments=p),
+                checkpoint_size=sync_config.download_checkpoint,
+                throttle=self.throttle(self.source_path),
+            )
+        except RangeNotSupported:
+            # 已经下载的分段作废, 不能再写回进度
+            logger.warning(f"Worker[{self.short_id}] 服务端不支持Range, 使用单连接下载.")
+            seg_file.unlink(missing_ok=True)
+            self.update(download_segments=[])
+            return self.downloader()
+        except BaseException:
+            # 保存中断时的进度, 下次从中断的位置继续
+            if self.download_segments != progress:
+                self.update(download_segments=progress)
+            raise
+
+        # 文件已经预分配为完整的大小, 只能按每一段下载的字节数确认完整
+        assert all(
+            p == end - start for p, (start, end) in zip(progress, ranges)
+        ), f"分段下载不完整: {progress}"
+        seg_file.replace(self.tmp_file)
+        self.update(status="downloaded", download_offset=size, download_segments=[])
+
+    def uploader(self, target_path: AlistPath = None):
+        target_path = target_path or self.target_path
+        # upload
+        res = put_stream(
+            target_path,
+            iter_file(self.tmp_file),
+            self.tmp_file.stat().st_size,
+            self.modified_ms,
+            throttle=self.throttle(target_path),
+        )
         logger.info(
             f"Worker[{self.short_id}] Upload File "
-            f"[{self.target_path}] [{res.code}]{res.message}."
+            f"[{target_path}] [{res.code}]{res.message}."
+        )
+
+    def pending_targets(self) -> list[AlistPath]:
+        """尚未上传完成的目标"""
+        return [
+            t
+            for t in self.all_targets
+            if self.targets_status.get(t.as_uri()) != "uploaded"
+        ]
+
+    def stream_copy(self):
+        """流式复制: 下载的同时上传到全部目标, 失败的目标之后使用临时文件重试"""
+        targets = self.pending_targets()
+        for _target in targets:
+            self.prepare_target(_target)
+
+        logger.debug(f"Worker[{self.short_id}] Streaming from {self.source_path}")
+        results = upload_stream(
+            self.source_path.get_download_uri(),
+            targets,
+            size=self.file_size,
+            modified=self.modified_ms,
+            client=downloader_client,
+            max_chunks=sync_config.stream_buffer,
+            throttle=self.throttle(self.source_path),
+            target_throttle=self.throttle,
         )
+        for _target in targets:
+            if (_e := results.get(_target.as_uri())) is not None:
+                logger.warning(
+                    f"Worker[{self.short_id}] Stream Error [{_target}]: "
+                    f"{type(_e)} - {_e}, 将使用临时文件重试."
+                )
+                self.forget_target_dir(_target)
+        self.update(
+            targets_status={
+                **self.targets_status,
+                **{k: "uploaded" if e is None else "failed" for k, e in results.items()},
+            }
+        )
+        if not self.pending_targets():
+            self.update(status="uploaded")
+
+    def _server_transfer(self, target_path: AlistPath):
+        """由服务器完成复制的方式, 返回Future, None 表示只能使用本机复制"""
+        if sync_config.is_same_server(self.source_path, target_path):
+            if sync_config.server_copy:
+                return get_server_copier().copy(
+                    self.source_path, target_path, self.file_size
+                )
+            return None
+        if sync_config.get_server(target_path.as_uri()).offline_download_tool:
+            return get_server_copier().fetch(self.source_path, target_path)
+        return None
+
+    def prepare_target(self, target_path: AlistPath):
+        """准备上传的目标
+
+        Checker已经确认目标不存在, 只有之前尝试过的目标才可能残留文件, 需要删除;
+        不再获取目标的信息, 删除与创建目录都是幂等的请求。
+        """
+        if target_path.as_uri() in self.targets_status:
+            target_path.client.remove(target_path.parent.as_posix(), target_path.name)
+        _parent = target_path.parent.as_uri()
+        if self.workers is not None and self.workers.is_dir_made(_parent):
+            return
+        if target_path.client.mkdir(target_path.parent.as_posix()).code == 200:
+            if self.workers is not None:
+                self.workers.add_made_dir(_parent)
+
+    def forget_target_dir(self, target_path: AlistPath):
+        """上传失败时目标目录可能已经被删除, 下次上传前重新创建"""
+        if self.workers is not None:
+            self.workers.forget_made_dir(target_path.parent.as_uri())
+
+    def server_copy(self):
+        """服务端复制: 同一个服务器上的目标使用复制任务, 其他服务器上的目标使用离线下载,
+        数据不经过本机; 失败的目标之后使用本机复制"""
+        futures = {}
+        for _target in self.pending_targets():
+            self.prepare_target(_target)
+            if (_future := self._server_transfer(_target)) is not None:
+                futures[_future] = _target
+        if not futures:
+            return
+
+        _status = {}
+        for future in as_completed(futures):
+            _target = futures[future]
+            try:
+                future.result()
+                _status[_target.as_uri()] = "uploaded"
+                logger.info(f"Worker[{self.short_id}] Server Copy [{_target}].")
+            except Exception as _e:
+                logger.warning(
+                    f"Worker[{self.short_id}] Server Copy Error [{_target}]: "
+                    f"{type(_e)} - {_e}, 将使用本机复制."
+                )
+                self.forget_target_dir(_target)
+                _status[_target.as_uri()] = "failed"
+        self.update(targets_status={**self.targets_status, **_status})
+        if not self.pending_targets():
+            self.update(status="uploaded")
+
+    def memory_copy(self):
+        """内存传输: 小文件下载到内存中, 然后上传到全部目标; 失败的目标之后使用临时文件重试"""
+        with memory_budget.reserve(self.file_size):
+            try:
+                data = download_bytes(
+                    self.source_path.get_download_uri(),
+                    self.file_size,
+                    downloader_client,
+                    throttle=self.throttle(self.source_path),
+                )
+            except (TimeoutException, AssertionError, ServerBusyError) as _e:
+                get_retry_policy().record_failure(self.server_of(self.source_path), _e)
+                logger.warning(
+                    f"Worker[{self.short_id}] Memory Download Error: "
+                    f"{type(_e)} - {_e}, 将使用临时文件重试."
+                )
+                return
+
+            _status = {}
+            for _target in self.pending_targets():
+                try:
+                    self.prepare_target(_target)
+                    put_stream(
+                        _target,
+                        data,
+                        self.file_size,
+                        self.modified_ms,
+                        throttle=self.throttle(_target),
+                    )
+                    _status[_target.as_uri()] = "uploaded"
+                except Exception as _e:
+                    logger.warning(
+                        f"Worker[{self.short_id}] Memory Upload Error [{_target}]: "
+                        f"{type(_e)} - {_e}, 将使用临时文件重试."
+                    )
+                    self.forget_target_dir(_target)
+                    _status[_target.as_uri()] = "failed"
+        self.update(targets_status={**self.targets_status, **_status})
+        if not self.pending_targets():
+            self.update(status="uploaded")
+
+    def upload_target(self, target_path: AlistPath):
+        """上传到一个目标"""
+        self.prepare_target(target_path)
+        get_retry_policy().call(self.server_of(target_path), self.uploader, target_path)
+
+    def upload_all(self):
+        """上传到全部尚未完成的目标, 多个目标时并行上传"""
+        targets = self.pending_targets()
+        with ThreadPoolExecutor(
+            max(len(targets), 1), f"worker_upload_{self.short_id}"
+        ) as pool:
+            futures = {pool.submit(self.upload_target, t): t for t in targets}
+            for future in as_completed(futures):
+                _target = futures[future]
+                try:
+                    future.result()
+                    _status = "uploaded"
+                except Exception as _e:
+                    logger.error(
+                        f"Worker[{self.short_id}] Upload Error [{_target}]: "
+                        f"{type(_e)} - {_e}"
+                    )
+                    self.forget_target_dir(_target)
+                    _status = "failed"
+                self.update(
+                    targets_status={**self.targets_status, _target.as_uri(): _status}
+                )
+
+        _failed = [k for k, v in self.targets_status.items() if v != "uploaded"]
+        if _failed:
+            raise UploadError(f"上传失败的目标: {_failed}")
         self.update(status="uploaded")
 
     def copy_type(self):
         """复制任务"""
         logger.debug(f"Worker[{self.short_id}] Start Copping")
+        if self.status in ["init", "back-upped"]:
+            self.server_copy()
+
+        if (
+            self.status in ["init", "back-upped"]
+            and sync_config.memory_copy_size
+            and self.file_size <= sync_config.memory_copy_size
+        ):
+            self.memory_copy()
+        elif (
+            sync_config.stream_copy
+            and self.file_size
+            and self.status in ["init", "back-upped"]
+        ):
+            self.stream_copy()
+
         if self.status not in ["downloaded", "uploaded"]:
-            self.__retry(
-                3,
-                (TimeoutException, AssertionError),
-                self.downloader,
+            get_retry_policy().call(
+                self.server_of(self.source_path),
+                self.segment_downloader if self.use_segments() else self.downloader,
             )
 
         if self.status != "uploaded":
-            self.target_path.unlink(missing_ok=True)
-            self.target_path.parent.mkdir(parents=True, exist_ok=True)
-            self.__retry(
-                3,
-                (TimeoutException, AssertionError),
-                self.uploader,
-            )
+            self.upload_all()
 
         return self.update(status="copied")
 
@@ -250,28 +564,29 @@ class Worker(BaseModel):
         assert not self.target_path.exists()
         self.update(status="deleted")
 
-    def recheck_copy(self, retry=5, re_time=2):
-        """再次检查当前Worker的结果是否符合预期。"""
-        try:
-            return (
-                self.target_path.re_stat(retry=retry, timeout=re_time).size
-                == self.source_path.re_stat().size
-            )
-        except FileNotFoundError:
-            if retry > 0:
-                return self.recheck_copy(retry=retry - 1, re_time=re_time)
-            logger.error(
-                f"Worker[{self.short_id}] Recheck Error: 文件不存在.({retry=})"
-            )
+    def match_source(self, item: Item | None) -> bool:
+        """目标文件与源文件的大小一致, 两者都有相同类型的Hash时, Hash也必须一致"""
+        if item is None or item.size != self.file_size:
             return False
+        if self.file_hash and item.hash_info:
+            _hash = item.hash_info.model_dump(exclude_none=True)
+            return all(v == _hash[k] for k, v in self.file_hash.items() if k in _hash)
+        return True
+
+    def recheck_copy(self) -> bool:
+        """再次检查当前Worker的结果是否符合预期, 全部目标由Verifier按目录批量检查。"""
+        futures = [get_verifier().verify(t, self.match_source) for t in self.all_targets]
+        if all(f.result() for f in futures):
+            return True
+        logger.error(f"Worker[{self.short_id}] Recheck Error: 目标文件不存在或不一致.")
+        return False
 
     def recheck(self) -> bool:
         """再次检查当前Worker的结果是否符合预期。"""
         if self.type == "copy":
-            return self.recheck_copy(retry=3, re_time=3)
+            return self.recheck_copy()
         elif self.type == "delete":
-            self.target_path.re_stat(retry=5, timeout=2)
-            return not self.target_path.exists()
+            return get_verifier().verify(self.target_path, lambda i: i is None).result()
         else:
             raise ValueError(f"Unknown Worker Type {self.type}.")
 
@@ -305,13 +620,11 @@ class Worker(BaseModel):
         except TimeoutException as _e:
             if is_retry:
                 return self.__error_exec(_e)
-            time.sleep(2)
-            return self.__retry(
-                3,
-                (TimeoutException, AssertionError),
-                self.run,
-                True,
-            )
+            _policy = get_retry_policy()
+            if (_server := self.server_of_request(_e)) is not None:
+                _policy.record_failure(_server, _e)
+            time.sleep(_policy.delay(1))
+            return self.run(is_retry=True)
         except Exception as _e:
             return self.__error_exec(_e)
 
@@ -331,43 +644,101 @@ class Worker(BaseModel):
 
 class Workers:
     def __init__(self):
-        self.thread_pool = MyThreadPoolExecutor(
-            20,
-            "worker_",
-        )
+        self.scheduler = Scheduler()
 
         self.lockers: set[AlistPath] = set()
+        self._lock = threading.Lock()
+        # 已经创建的目录 {目录uri: 创建的时间}, 有效期内同一个目录只请求一次mkdir;
+        # 目标目录可能在两次同步之间被删除, 有效期为同步组中最短的interval
+        self.made_dirs: dict[str, float] = {}
+        self.made_dir_ttl = min(
+            (g.interval for g in sync_config.sync_groups), default=300
+        )
+        self._made_dirs_purged = time.monotonic()
 
         atexit.register(self.__del__)
 
     def __del__(self):
+        """保留未完成的临时文件用于断点续传, 只清理长时间没有更新的临时文件"""
         for i in sync_config.cache_dir.iterdir():
-            if i.name.startswith("download_tmp_"):
+            if (
+                i.name.startswith("download_tmp_")
+                and time.time() - i.stat().st_mtime > TMP_FILE_KEEP
+            ):
                 i.unlink(missing_ok=True)
 
-    def release_lock(self, *items: AlistPath):
-        for p in items:
-            self.lockers.remove(p)
+    def is_dir_made(self, uri: str) -> bool:
+        """目录在有效期内已经创建过"""
+        _made = self.made_dirs.get(uri)
+        return _made is not None and time.monotonic() - _made < self.made_dir_ttl
+
+    def add_made_dir(self, uri: str):
+        """记录创建的目录, 每个有效期清理一次过期的记录"""
+        _now = time.monotonic()
+        with self._lock:
+            if _now - self._made_dirs_purged >= self.made_dir_ttl:
+                self.made_dirs = {
+                    k: v
+                    for k, v in self.made_dirs.items()
+                    if _now - v < self.made_dir_ttl
+                }
+                self._made_dirs_purged = _now
+            self.made_dirs[uri] = _now
+
+    def forget_made_dir(self, uri: str):
+        self.made_dirs.pop(uri, None)
 
-    def add_worker(self, worker: Worker, is_loader=False):
-        if not is_loader and (
-            worker.source_path in self.lockers or worker.target_path in self.lockers
-        ):
-            logger.warning(f"Worker[{worker.id}]中有路径被锁定.")
-            return
-
-        self.lockers.add(worker.source_path)
-        self.lockers.add(worker.target_path)
+    def release_lock(self, *items: AlistPath):
+        with self._lock:
+            self.lockers.difference_update(items)
+
+    def lock(self, worker: Worker) -> bool:
+        """锁定Worker的全部路径, 有路径已经被执行中的Worker锁定时返回False"""
+        paths = {p for p in (worker.source_path, *worker.all_targets) if p is not None}
+        with self._lock:
+            if not paths.isdisjoint(self.lockers):
+                return False
+            self.lockers.update(paths)
+            return True
+
+    def add_worker(self, worker: Worker) -> bool:
+        if not self.lock(worker):
+            logger.warning(f"Worker[{worker.short_id}]中有路径被锁定, 跳过.")
+            return False
 
         worker.workers = self
-        self.thread_pool.submit_wait(worker.run)
-        logger.info(f"Worker[{worker.id}] added to ThreadPool.")
+        self.scheduler.submit(worker)
+        logger.info(f"Worker[{worker.short_id}] added to Scheduler.")
+        return True
+
+    def load(self):
+        """加载上一次运行中未完成的Worker, 从保存的状态继续执行
+
+        结束的Worker已经从handle中删除, 保存的都是未完成的;
+        id不同(旧版本的id)或者路径重复的记录只保留第一个。
+        """
+        _handle = sync_config.handle
+        _loaded: set[str] = set()
+        for _doc in list(_handle.get_workers({"owner": sync_config.name})):
+            _doc_id = _doc.get("id") or _doc.get("_id")
+            try:
+                worker = Worker.model_validate(_doc)
+            except Exception as _e:
+                logger.warning(f"无法加载Worker[{_doc_id}]: {_e}")
+                _handle.delete_worker(_doc_id)
+                continue
+            if _doc_id != worker.id:
+                _handle.delete_worker(_doc_id)
+            if worker.status == "downloaded" and not worker.tmp_file.exists():
+                worker.status = "init"
+            if self.add_worker(worker):
+                _loaded.add(worker.id)
+            elif worker.id not in _loaded:
+                _handle.delete_worker(worker.id)
+        logger.info(f"从上一次运行中恢复了 {len(_loaded)} 个Worker.")
 
     def run(self, queue: Queue):
         """"""
-        # self.lockers |= sync_config.handle.load_locker()
-        # for i in sync_config.handle.get_workers():
-        #     self.add_worker(Worker(**i), is_loader=True)
         _started = False
         while True:
             if (
@@ -377,9 +748,10 @@ class Workers:
                 and time.time() - sync_config.start_time > sync_config.timeout
             ):
                 logger.info(
-                    f"等待Worker执行完成, 排队中的数量: {self.thread_pool.work_qsize()}"
+                    f"等待Worker执行完成, 排队中的数量: {self.scheduler.qsize()}"
                 )
-                self.thread_pool.shutdown(wait=True, cancel_futures=False)
+                self.scheduler.join()
+                sync_config.handle.flush()
                 logger.info(f"循环线程退出 - {threading.current_thread().name}")
                 return
 
@@ -396,6 +768,8 @@ class Workers:
                 )
 
     def start(self, queue: Queue) -> threading.Thread:
+        """先恢复未完成的Worker, 再开始处理Checker的输出, 重复的任务会被锁跳过"""
+        self.load()
         _t = threading.Thread(
             target=self.run,
             args=(queue,),
@@ -407,7 +781,7 @@ class Workers:
 
 
 if __name__ == "__main__":
-    from alist_sdk import AlistPath, login_server
+    from alist_sdk import AlistPath
 
     _w = Worker.model_validate(
         {
@@ -426,7 +800,7 @@ if __name__ == "__main__":
     )
 
     for s in sync_config.alist_servers:
-        login_server(**s.dump_for_alist_path())
+        get_session().client(s)
 
     print(_w.tmp_file, type(_w.source_path), _w.target_path)
     _w.run()
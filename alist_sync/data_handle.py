@@ -7,10 +7,14 @@
 
 """
 import abc
+import atexit
 import datetime
 import json
 import logging
 import shelve
+import sqlite3
+import threading
+import time
 from pathlib import Path
 from typing import TYPE_CHECKING, Iterable
 
@@ -64,40 +68,140 @@ class HandleBase(metaclass=abc.ABCMeta):
         """更新或创建FileItem"""
         raise NotImplementedError
 
+    def update_file_items(self, items: dict["AlistPath", object]):
+        """批量写入完整的FileItem, 默认逐个调用, 后端可以覆盖为一次批量操作"""
+        for path, item in items.items():
+            self.update_file_item(path, item)
+
     @abc.abstractmethod
     def get_file_item(self, item_id: "AlistPath"):
         """获取FileItem"""
         raise NotImplementedError
 
+    def get_file_items(self, item_ids: Iterable["AlistPath"]) -> dict[str, object]:
+        """批量获取FileItem, 返回 {uri: item}, 不存在的不返回"""
+        return {
+            _id.as_uri(): _item
+            for _id in item_ids
+            if (_item := self.get_file_item(_id)) is not None
+        }
+
     @abc.abstractmethod
     def create_log(self, worker: "Worker"):
         """"""
 
+    def flush(self):
+        """写入缓冲中的修改, 没有缓冲时什么也不做"""
+
+    def write_batch(
+        self,
+        updates: list[tuple["Worker", tuple[str, ...]]],
+        deletes: list[str],
+        logs: list["Worker"],
+    ):
+        """批量写入: 先删除, 再更新, 最后写入日志
+
+        默认逐个调用, 后端可以覆盖为一次批量操作。
+        updates中的field为空时写入完整的Worker。
+        """
+        for _id in deletes:
+            self.delete_worker(_id)
+        for worker, field in updates:
+            self.update_worker(worker, *field)
+        for worker in logs:
+            self.create_log(worker)
+
 
 class MongoHandle(HandleBase):
-    def __init__(self, mongodb: "Database"):
+    """MongoDB 保存状态
+
+    启动时创建需要的索引, 其中 logs.done_at 为TTL索引, 日志在 log_ttl 秒后自动删除;
+    批量写入使用无序的 bulk_write, 查询只返回需要的字段。
+    """
+
+    # 锁使用的路径字段
+    _path_fields = ("source_path", "target_path", "extra_targets")
+
+    def __init__(self, mongodb: "Database", log_ttl: int = 0):
+        self._db = mongodb
         self._workers: "Collection" = mongodb.workers
         self._items: "Collection" = mongodb.items
         self._logs: "Collection" = mongodb.logs
+        self.log_ttl = log_ttl
+        self.create_indexes()
+
+    def create_indexes(self):
+        from pymongo import ASCENDING
+        from pymongo.errors import OperationFailure
+
+        for _field in self._path_fields:
+            self._workers.create_index(_field)
+        self._workers.create_index([("owner", ASCENDING), ("status", ASCENDING)])
+        self._logs.create_index([("owner", ASCENDING), ("status", ASCENDING)])
+        if not self.log_ttl:
+            return
+        try:
+            self._logs.create_index(
+                "done_at", name="done_at_ttl", expireAfterSeconds=self.log_ttl
+            )
+        except OperationFailure:
+            # 已经存在不同有效期的TTL索引时, 修改其有效期
+            self._db.command(
+                "collMod",
+                self._logs.name,
+                index={"name": "done_at_ttl", "expireAfterSeconds": self.log_ttl},
+            )
+        logger.info(f"MongoDB 索引已创建, 日志保存 {self.log_ttl} 秒.")
+
+    @staticmethod
+    def _log_doc(worker: "Worker") -> dict:
+        """TTL索引需要日期类型的 done_at"""
+        doc = worker.model_dump(mode="json")
+        doc["done_at"] = worker.done_at or datetime.datetime.now()
+        doc["created_at"] = worker.created_at
+        return doc
 
     def create_log(self, worker: "Worker"):
         logger.info(f"create log {worker.id} {worker.status}")
-        self._logs.insert_one(worker.model_dump(mode="json"))
+        self._logs.insert_one(self._log_doc(worker))
 
-    def update_worker(self, worker: "Worker", *field):
+    @staticmethod
+    def _worker_update(worker: "Worker", field: tuple[str, ...]) -> tuple[dict, dict]:
+        """update_one的参数: (filter, update)"""
         if field == ():
             data = worker.model_dump(mode="json")
         else:
             data = {k: worker.__dict__.get(k) for k in field}
+        return {"_id": worker.id}, {"$set": data}
 
+    def update_worker(self, worker: "Worker", *field):
+        _filter, _update = self._worker_update(worker, field)
         logger.debug(
-            f"Worker[{worker.id}]: Update: {json.dumps(data, indent=2, ensure_ascii=False)}"
+            f"Worker[{worker.id}]: Update: "
+            f"{json.dumps(_update['$set'], indent=2, ensure_ascii=False, default=str)}"
         )
-        return self._workers.update_one(
-            {"_id": worker.id},
-            {"$set": data},
-            True if field == () else False,
+        return self._workers.update_one(_filter, _update, True if field == () else False)
+
+    def write_batch(
+        self,
+        updates: list[tuple["Worker", tuple[str, ...]]],
+        deletes: list[str],
+        logs: list["Worker"],
+    ):
+        """一个Worker在一次批量写入中只出现一次, 可以使用无序写入"""
+        from pymongo import DeleteOne, UpdateOne
+
+        ops = [DeleteOne({"_id": _id}) for _id in deletes] + [
+            UpdateOne(*self._worker_update(w, field), upsert=field == ())
+            for w, field in updates
+        ]
+        logger.debug(
+            f"MongoDB 批量写入: 删除 {len(deletes)}, 更新 {len(updates)}, 日志 {len(logs)}"
         )
+        if ops:
+            self._workers.bulk_write(ops, ordered=False)
+        if logs:
+            self._logs.insert_many([self._log_doc(w) for w in logs], ordered=False)
 
     def delete_worker(self, worker_id: str):
         logger.debug("删除Worker: %s", worker_id)
@@ -115,45 +219,325 @@ class MongoHandle(HandleBase):
 
     def load_locker(self) -> set["AlistPath"]:
         logger.info("正在加载MongoDB中保存的锁。")
-        return {
-            AlistPath(p)
-            for doc in self._workers.find(
-                {},
-                {"source_path": True, "target_path": True},
+        _paths = set()
+        for doc in self._workers.find(
+            {}, {"_id": False, **{k: True for k in self._path_fields}}
+        ):
+            _paths.update(
+                _p
+                for _v in doc.values()
+                for _p in (_v if isinstance(_v, list) else [_v])
+                if _p
             )
-            for p in doc.values()
-            if not None
-        }
+        return {AlistPath(p) for p in _paths}
 
     def path_in_workers(self, path: "AlistPath") -> bool:
         return bool(
             self._workers.find_one(
-                {"$or": [{"source_path": str(path)}, {"target_path": str(path)}]},
+                {"$or": [{k: str(path)} for k in self._path_fields]},
                 {"_id": True},
             )
         )
 
-    def update_file_item(self, path: "AlistPath", item, *field):
+    @staticmethod
+    def _item_update(path: "AlistPath", item, field: tuple[str, ...]) -> tuple:
         if field == ():
             data = item.model_dump(mode="json")
         else:
             data = {k: item.__getattr__(k) for k in field}
+        return (
+            {"_id": path.as_uri()},
+            {"$set": {"update_time": datetime.datetime.now(), "item": data}},
+        )
 
-        logger.debug("更新FileItem: %s", data)
+    def update_file_item(self, path: "AlistPath", item, *field):
+        logger.debug("更新FileItem: %s", path)
         return self._items.update_one(
-            {"_id": path.as_uri()},
-            {
-                "$set": {
-                    "_id": item.id,
-                    "update_time": datetime.datetime.now(),
-                    "item": data,
-                },
-            },
+            *self._item_update(path, item, field),
             True if field == () else False,
         )
 
+    def update_file_items(self, items: dict["AlistPath", object]):
+        """目录快照是最频繁的单个文档写入, 合并为一次无序的 bulk_write"""
+        from pymongo import UpdateOne
+
+        if items:
+            self._items.bulk_write(
+                [
+                    UpdateOne(*self._item_update(path, item, ()), upsert=True)
+                    for path, item in items.items()
+                ],
+                ordered=False,
+            )
+
     def get_file_item(self, item_id: AlistPath):
-        return self._items.find_one({"_id": item_id.as_uri()})["item"]
+        doc = self._items.find_one(
+            {"_id": item_id.as_uri()}, {"_id": False, "item": True}
+        )
+        return doc["item"] if doc else None
+
+    def get_file_items(self, item_ids: Iterable[AlistPath]) -> dict[str, object]:
+        return {
+            doc["_id"]: doc["item"]
+            for doc in self._items.find(
+                {"_id": {"$in": [_id.as_uri() for _id in item_ids]}},
+                {"item": True},
+            )
+        }
+
+
+def _to_json(item) -> str:
+    if hasattr(item, "model_dump_json"):
+        return item.model_dump_json()
+    return json.dumps(item, default=str, ensure_ascii=False)
+
+
+class SQLiteHandle(HandleBase):
+    """SQLite (WAL模式) 保存状态
+
+    1. Worker保存为一行, source_path、target_path、status为带索引的列,
+       每次更新只写入一行, 不需要重写整个数据库;
+    2. Worker的全部路径(源文件与全部目标)保存在 worker_paths 中,
+       检查路径是否被锁定为一次索引查询;
+    3. 每个线程一个连接, WAL模式下读写互不阻塞, 写入冲突时等待 busy_timeout。
+    """
+
+    # 一次查询中IN的最大参数数量
+    _MAX_VARS = 500
+
+    def __init__(self, save_dir: Path, busy_timeout: int = 30_000, log_ttl: int = 0):
+        self.db_file = save_dir.joinpath("alist_sync.sqlite")
+        self.busy_timeout = busy_timeout
+        self._local = threading.local()
+        self._create_tables()
+        if log_ttl:
+            self.purge_logs(log_ttl)
+
+    @property
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(
+                self.db_file, timeout=self.busy_timeout / 1000, isolation_level=None
+            )
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(f"PRAGMA busy_timeout={self.busy_timeout}")
+            self._local.conn = conn
+        return conn
+
+    def _create_tables(self):
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS workers (
+                id TEXT PRIMARY KEY,
+                type TEXT,
+                group_name TEXT,
+                source_path TEXT,
+                target_path TEXT,
+                status TEXT,
+                update_time REAL,
+                data TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_workers_source ON workers (source_path);
+            CREATE INDEX IF NOT EXISTS idx_workers_target ON workers (target_path);
+            CREATE INDEX IF NOT EXISTS idx_workers_status ON workers (status);
+
+            CREATE TABLE IF NOT EXISTS worker_paths (
+                path TEXT NOT NULL,
+                worker_id TEXT NOT NULL,
+                PRIMARY KEY (path, worker_id)
+            );
+            CREATE INDEX IF NOT EXISTS idx_worker_paths_worker
+                ON worker_paths (worker_id);
+
+            CREATE TABLE IF NOT EXISTS items (
+                id TEXT PRIMARY KEY,
+                update_time REAL,
+                item TEXT
+            );
+
+            CREATE TABLE IF NOT EXISTS logs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                worker_id TEXT,
+                status TEXT,
+                create_time REAL,
+                data TEXT
+            );
+            CREATE INDEX IF NOT EXISTS idx_logs_worker ON logs (worker_id);
+            CREATE INDEX IF NOT EXISTS idx_logs_create_time ON logs (create_time);
+            """
+        )
+
+    def purge_logs(self, ttl: int):
+        """删除ttl秒之前的日志"""
+        with self._conn as conn:
+            _count = conn.execute(
+                "DELETE FROM logs WHERE create_time < ?", (time.time() - ttl,)
+            ).rowcount
+        if _count:
+            logger.info(f"SQLite: 删除了 {_count} 条过期的日志.")
+
+    @staticmethod
+    def _insert_log(conn: sqlite3.Connection, worker: "Worker"):
+        conn.execute(
+            "INSERT INTO logs (worker_id, status, create_time, data) VALUES (?,?,?,?)",
+            (worker.id, worker.status, time.time(), worker.model_dump_json()),
+        )
+
+    @staticmethod
+    def _upsert_worker(conn: sqlite3.Connection, worker: "Worker"):
+        data = worker.model_dump(mode="json")
+        paths = {
+            str(p)
+            for p in (worker.source_path, *worker.all_targets)
+            if p is not None
+        }
+        conn.execute(
+            "INSERT INTO workers "
+            "(id, type, group_name, source_path, target_path, status, "
+            "update_time, data) VALUES (?,?,?,?,?,?,?,?) "
+            "ON CONFLICT (id) DO UPDATE SET status=excluded.status, "
+            "update_time=excluded.update_time, data=excluded.data",
+            (
+                worker.id,
+                worker.type,
+                worker.group_name,
+                data["source_path"],
+                data["target_path"],
+                worker.status,
+                time.time(),
+                json.dumps(data, ensure_ascii=False),
+            ),
+        )
+        conn.executemany(
+            "INSERT OR IGNORE INTO worker_paths (path, worker_id) VALUES (?,?)",
+            [(p, worker.id) for p in paths],
+        )
+
+    @staticmethod
+    def _delete_worker(conn: sqlite3.Connection, worker_id: str):
+        conn.execute("DELETE FROM workers WHERE id = ?", (worker_id,))
+        conn.execute("DELETE FROM worker_paths WHERE worker_id = ?", (worker_id,))
+
+    def create_log(self, worker: "Worker"):
+        logger.debug(f"create log for: {worker.id}")
+        self._insert_log(self._conn, worker)
+
+    def update_worker(self, worker: "Worker", *field):
+        logger.debug(f"SQLite[{worker.id}] update to workers")
+        with self._conn as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            self._upsert_worker(conn, worker)
+
+    def delete_worker(self, worker_id: str):
+        logger.debug(f"Worker[{worker_id}] remove from workers")
+        with self._conn as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            self._delete_worker(conn, worker_id)
+
+    def write_batch(
+        self,
+        updates: list[tuple["Worker", tuple[str, ...]]],
+        deletes: list[str],
+        logs: list["Worker"],
+    ):
+        """一个事务写入全部的修改"""
+        logger.debug(
+            f"SQLite 批量写入: 删除 {len(deletes)}, 更新 {len(updates)}, 日志 {len(logs)}"
+        )
+        with self._conn as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            for _id in deletes:
+                self._delete_worker(conn, _id)
+            for worker, _ in updates:
+                self._upsert_worker(conn, worker)
+            for worker in logs:
+                self._insert_log(conn, worker)
+
+    def get_worker(self, worker_id: str):
+        logger.debug(f"get Worker[{worker_id}] from workers")
+        row = self._conn.execute(
+            "SELECT data FROM workers WHERE id = ?", (worker_id,)
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    # 可以查询的字段与对应的列
+    _query_columns = {
+        "type": "type",
+        "group_name": "group_name",
+        "source_path": "source_path",
+        "target_path": "target_path",
+        "status": "status",
+        "owner": "json_extract(data, '$.owner')",
+    }
+
+    def get_workers(self, query: dict | None = None) -> Iterable[dict]:
+        """query: {字段: 值}, 可用的字段见 _query_columns"""
+        logger.debug(f"get Workers from workers: {query}")
+        query = query or {}
+        if not query.keys() <= self._query_columns.keys():
+            raise KeyError(f"不支持的查询: {query}")
+        where = " AND ".join(f"{self._query_columns[k]} = ?" for k in query) or "1"
+        for (_data,) in self._conn.execute(
+            f"SELECT data FROM workers WHERE {where}", tuple(query.values())
+        ):
+            yield json.loads(_data)
+
+    def load_locker(self) -> set[AlistPath]:
+        logger.debug("正在加载SQLite中保存的锁。")
+        return {
+            AlistPath(p)
+            for (p,) in self._conn.execute("SELECT DISTINCT path FROM worker_paths")
+        }
+
+    def path_in_workers(self, path: AlistPath) -> bool:
+        return (
+            self._conn.execute(
+                "SELECT 1 FROM worker_paths WHERE path = ? LIMIT 1", (str(path),)
+            ).fetchone()
+            is not None
+        )
+
+    def update_file_item(self, path: AlistPath, item, *field):
+        logger.debug(f"FileItem[{path}] update to items")
+        self._conn.execute(
+            "INSERT OR REPLACE INTO items (id, update_time, item) VALUES (?,?,?)",
+            (path.as_uri(), time.time(), _to_json(item)),
+        )
+
+    def update_file_items(self, items: dict[AlistPath, object]):
+        """一个事务写入全部的FileItem"""
+        with self._conn as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.executemany(
+                "INSERT OR REPLACE INTO items (id, update_time, item) VALUES (?,?,?)",
+                [
+                    (path.as_uri(), time.time(), _to_json(item))
+                    for path, item in items.items()
+                ],
+            )
+
+    def get_file_item(self, item_id: AlistPath):
+        row = self._conn.execute(
+            "SELECT item FROM items WHERE id = ?", (item_id.as_uri(),)
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def get_file_items(self, item_ids: Iterable[AlistPath]) -> dict[str, object]:
+        ids = [_id.as_uri() for _id in item_ids]
+        result = {}
+        for i in range(0, len(ids), self._MAX_VARS):
+            _ids = ids[i : i + self._MAX_VARS]
+            result.update(
+                (_id, json.loads(_item))
+                for _id, _item in self._conn.execute(
+                    f"SELECT id, item FROM items WHERE id IN "
+                    f"({','.join('?' * len(_ids))})",
+                    _ids,
+                )
+            )
+        return result
 
 
 class ShelveHandle(HandleBase):
@@ -161,9 +545,7 @@ class ShelveHandle(HandleBase):
         self._workers = shelve.open(
             str(save_dir.joinpath("alist_cache_workers.shelve")), writeback=True
         )
-        self._items = shelve.open(
-            str(save_dir.joinpath("alist_cache_items.shelve")), writeback=True
-        )
+        self._items = shelve.open(str(save_dir.joinpath("alist_cache_items.shelve")))
         self._logs = save_dir.joinpath(
             "alist-sync-files.log",
         ).open("a+")
@@ -189,6 +571,21 @@ class ShelveHandle(HandleBase):
         except KeyError:
             pass
 
+    def write_batch(
+        self,
+        updates: list[tuple["Worker", tuple[str, ...]]],
+        deletes: list[str],
+        logs: list["Worker"],
+    ):
+        """全部修改之后只sync一次"""
+        for _id in deletes:
+            self._workers.pop(_id, None)
+        for worker, _ in updates:
+            self._workers[worker.id] = worker.model_dump(mode="json")
+        for worker in logs:
+            self.create_log(worker)
+        self._workers.sync()
+
     def get_worker(self, worker_id: str):
         logger.debug(f"get Worker[{worker_id}] from workers")
         return self._workers.get(worker_id)
@@ -221,3 +618,180 @@ class ShelveHandle(HandleBase):
     def get_file_item(self, item_id: AlistPath):
         logger.debug(f"get FileItem[{item_id}] from items")
         return self._items.get(item_id.as_uri(), {}).get("item")
+
+
+class WriteBehindHandle(HandleBase):
+    """延迟写入: 合并同一个Worker的多次更新, 在后台批量写入到handle
+
+    1. 每 interval 秒, 或等待写入的Worker达到 max_pending 个时, 调用一次 handle.write_batch;
+    2. Worker结束(done/failed)时立即写入: durability 为 normal 时等待写入完成,
+       为 fast 时只唤醒后台线程, 不阻塞Worker;
+    3. 读取Worker与锁之前先写入, 读到的总是最新的状态;
+       完整的FileItem(目录快照)也在缓冲中合并, 批量写入, 读取时先查找缓冲;
+    4. 程序退出时写入全部的修改。
+    """
+
+    def __init__(
+        self,
+        handle: HandleBase,
+        interval: float = 1,
+        max_pending: int = 500,
+        durability: str = "normal",
+    ):
+        self.handle = handle
+        self.interval = interval
+        self.max_pending = max_pending
+        self.durability = durability
+
+        # {worker_id: (Worker, 需要更新的字段, 空集合表示完整的Worker)}
+        self._updates: dict[str, tuple["Worker", set[str] | None]] = {}
+        self._deletes: dict[str, None] = {}
+        self._logs: list["Worker"] = []
+        # {uri: (path, FileItem)}
+        self._items: dict[str, tuple["AlistPath", object]] = {}
+        self.flushed = 0  # 批量写入的次数
+
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._urgent = False
+        self._thread = threading.Thread(
+            target=self._run, name="write_behind", daemon=True
+        )
+        self._thread.start()
+        atexit.register(self.flush)
+
+    def pending(self) -> int:
+        return (
+            len(self._updates) + len(self._deletes) + len(self._logs) + len(self._items)
+        )
+
+    def _wakeup(self, urgent: bool = False):
+        """在锁中调用"""
+        self._urgent = self._urgent or urgent
+        if urgent or self.pending() >= self.max_pending:
+            self._cond.notify_all()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(
+                    lambda: self._urgent or self.pending() >= self.max_pending,
+                    timeout=self.interval,
+                )
+            try:
+                self.flush()
+            except Exception as _e:
+                logger.error(f"WriteBehind: 批量写入失败: {_e}", exc_info=_e)
+
+    def flush(self):
+        """立即写入全部的修改"""
+        with self._flush_lock:
+            with self._cond:
+                updates, self._updates = self._updates, {}
+                deletes, self._deletes = self._deletes, {}
+                logs, self._logs = self._logs, []
+                items, self._items = self._items, {}
+                self._urgent = False
+            if not (updates or deletes or logs or items):
+                return
+            try:
+                if updates or deletes or logs:
+                    self.handle.write_batch(
+                        [(w, () if f is None else tuple(f)) for w, f in updates.values()],
+                        list(deletes),
+                        logs,
+                    )
+                    updates, deletes, logs = {}, {}, []
+                if items:
+                    self.handle.update_file_items(dict(items.values()))
+                self.flushed += 1
+            except Exception:
+                # 写入失败时放回没有写入的部分, 下一次重试, 期间的新修改优先
+                with self._cond:
+                    for _id, _update in updates.items():
+                        if _id not in self._deletes:
+                            self._updates.setdefault(_id, _update)
+                    self._deletes = {**deletes, **self._deletes}
+                    self._logs = logs + self._logs
+                    self._items = {**items, **self._items}
+                raise
+
+    def create_log(self, worker: "Worker"):
+        with self._cond:
+            self._logs.append(worker)
+            self._wakeup()
+
+    def update_worker(self, worker: "Worker", *field):
+        with self._cond:
+            self._deletes.pop(worker.id, None)
+            _, _fields = self._updates.get(worker.id, (worker, set()))
+            if field == () or _fields is None:
+                _fields = None
+            else:
+                _fields = _fields | set(field)
+            self._updates[worker.id] = (worker, _fields)
+            self._wakeup()
+
+    def delete_worker(self, worker_id: str):
+        """Worker结束时调用, 立即写入"""
+        with self._cond:
+            self._updates.pop(worker_id, None)
+            self._deletes[worker_id] = None
+            self._wakeup(urgent=True)
+        if self.durability != "fast":
+            self.flush()
+
+    def get_worker(self, worker_id: str):
+        self.flush()
+        return self.handle.get_worker(worker_id)
+
+    def get_workers(self, query=None) -> Iterable["Worker"]:
+        self.flush()
+        return self.handle.get_workers(query)
+
+    def load_locker(self) -> set["AlistPath"]:
+        self.flush()
+        return self.handle.load_locker()
+
+    def path_in_workers(self, path: "AlistPath") -> bool:
+        self.flush()
+        return self.handle.path_in_workers(path)
+
+    def update_file_item(self, path: "AlistPath", item, *field):
+        if field:
+            # 部分字段的更新不缓冲, 先写入缓冲中的完整FileItem
+            self.flush()
+            return self.handle.update_file_item(path, item, *field)
+        with self._cond:
+            self._items[path.as_uri()] = (path, item)
+            self._wakeup()
+
+    def update_file_items(self, items: dict["AlistPath", object]):
+        with self._cond:
+            self._items.update((p.as_uri(), (p, i)) for p, i in items.items())
+            self._wakeup()
+
+    @staticmethod
+    def _item_json(item):
+        """与从handle中读取的结果相同的格式"""
+        return item.model_dump(mode="json") if hasattr(item, "model_dump") else item
+
+    def get_file_item(self, item_id: "AlistPath"):
+        with self._cond:
+            _buffered = self._items.get(item_id.as_uri())
+        if _buffered is not None:
+            return self._item_json(_buffered[1])
+        return self.handle.get_file_item(item_id)
+
+    def get_file_items(self, item_ids: Iterable["AlistPath"]) -> dict[str, object]:
+        item_ids = list(item_ids)
+        with self._cond:
+            result = {
+                _id.as_uri(): self._item_json(self._items[_id.as_uri()][1])
+                for _id in item_ids
+                if _id.as_uri() in self._items
+            }
+        result.update(
+            self.handle.get_file_items([i for i in item_ids if i.as_uri() not in result])
+        )
+        return result
@@ -5,140 +5,347 @@
 @Author     : LeeCQ
 @Date-Time  : 2024/2/25 21:17
 
-下载器使用一个单独线程启动，它创建一个事件循环并在其内部保持同步。
+流式传输: 下载到的数据块通过有界的管道直接作为上传请求的body,
+下载与上传同时进行, 不需要临时文件, 也不需要与文件一样大的本地磁盘。
+
+分段下载: 大文件被切分为多个字节范围, 使用多个连接并行下载到预分配文件的对应位置。
+
+内存传输: 小文件下载到内存中直接上传, 全部的内存传输共享一个全局的内存预算。
+
+限速: 传输函数接收可选的throttle, 每个数据块传输之前使用其字节数调用一次。
 """
-import queue
-import time
+import collections
+import contextlib
+import logging
+import threading
 import urllib.parse
-from typing import TYPE_CHECKING
+from pathlib import Path
+from typing import Iterable, Iterator, Callable
 
 from alist_sdk import AlistPath
+from httpx import Client, Timeout
 
-from alist_sync.alist_client import create_async_client, AlistClient
+from alist_sync.common import check_response
 
-if TYPE_CHECKING:
-    ...
+logger = logging.getLogger("alist-sync.downloader")
 
+__all__ = [
+    "ChunkPipe",
+    "put_stream",
+    "upload_stream",
+    "split_ranges",
+    "download_ranges",
+    "RangeNotSupported",
+    "MemoryBudget",
+    "download_bytes",
+    "iter_throttled",
+    "iter_file",
+]
 
-def upload_stream(source_path: AlistPath, target_path: AlistPath):
-    import asyncio
+# 限速函数, 接收数据块的字节数, 需要时等待
+Throttle = Callable[[int], None]
 
-    _queue = asyncio.Queue()
 
-    # noinspection PyArgumentList
-    async def put_stream():
-        _c: AlistClient = create_async_client(source_path.client)
-        async with _c.stream(
-            "GET",
-            source_path.as_download_uri(),
-            follow_redirects=True,
-        ) as stream_resp:
-            async for chunk in stream_resp.aiter_bytes():
-                print("Put Chunk size:", len(chunk), "bytes.")
-                await _queue.put(chunk)
-            else:
-                await _queue.put(None)
+class PipeAborted(Exception):
+    """消费者已经放弃读取"""
 
-    async def put_test():
-        a = open("/Users/lcq/Downloads/drunbility.pdf", "rb")
-        while True:
-            chunk = a.read(1024)
-            if not chunk:
-                await _queue.put(None)
-                break
-            await _queue.put(chunk)
 
-    async def get_chunk():
-        while True:
-            chunk = await _queue.get()
-            if chunk is None:
-                break
-            yield chunk
+class RangeNotSupported(Exception):
+    """服务端不支持Range请求"""
 
-    # noinspection PyAsyncCall
-    async def main():
-
-        asyncio.create_task(put_test())
-        return await create_async_client(target_path.client).put(
-            "/api/fs/put",
-            headers={
-                "As-Task": "false",
-                "Content-Type": "application/octet-stream",
-                "Last-Modified": str(int(time.time() * 1000)),
-                "File-Path": urllib.parse.quote_plus(str(target_path.as_posix())),
-            },
-            content=get_chunk(),
-        )
-
-    return asyncio.run(main())
-
-
-def upload_stream_thread(source_path: AlistPath, target_path: AlistPath):
-    """"""
-
-    def put_stream():
-        with source_path.client.stream(
-            "GET", source_path.as_download_uri(), follow_redirects=True
-        ) as stream_resp:
-            total = 0
-            for i in stream_resp.iter_bytes():
-                total += len(i)
-                print("Download Chunk size:", total, "bytes.")
-                _queue.put(i)
-
-            print("None Putted")
-            _queue.put(None)
-
-    def get_chunk():
-        total = 0
+
+class ChunkPipe:
+    """有界的分块管道
+
+    生产者使用 put 写入, 缓存的块达到 max_chunks 时阻塞(背压);
+    消费者迭代读取, 直到生产者 close; 生产者出错时, 消费者在读取时得到该异常。
+    """
+
+    def __init__(self, max_chunks: int = 8):
+        self.max_chunks = max(1, max_chunks)
+        self._chunks = collections.deque()
+        self._cond = threading.Condition()
+        self._closed = False
+        self._error: BaseException | None = None
+        self.aborted: BaseException | None = None
+
+    def put(self, chunk: bytes):
+        with self._cond:
+            self._cond.wait_for(
+                lambda: len(self._chunks) < self.max_chunks or self.aborted
+            )
+            if self.aborted is not None:
+                raise PipeAborted() from self.aborted
+            self._chunks.append(chunk)
+            self._cond.notify_all()
+
+    def close(self, error: BaseException | None = None):
+        """生产者结束写入, error不为空时消费者将得到该异常"""
+        with self._cond:
+            self._closed = True
+            self._error = error
+            self._cond.notify_all()
+
+    def abort(self, error: BaseException):
+        """消费者放弃读取, 生产者的下一次写入将抛出PipeAborted"""
+        with self._cond:
+            self.aborted = error
+            self._chunks.clear()
+            self._cond.notify_all()
+
+    def __iter__(self) -> Iterator[bytes]:
         while True:
-            chunk = _queue.get()
-            if chunk is None:
-                print("None Got")
-                break
-            total += len(chunk)
-            print(f"\rupload Chunk size: {total} bytes. [{time.time()}]", end="")
+            with self._cond:
+                self._cond.wait_for(lambda: self._chunks or self._closed)
+                if self._chunks:
+                    chunk = self._chunks.popleft()
+                    self._cond.notify_all()
+                elif self._error is not None:
+                    raise self._error
+                else:
+                    return
             yield chunk
 
-    import threading
 
-    _queue = queue.Queue()
+def iter_throttled(
+    content: bytes | Iterable[bytes], throttle: Throttle, piece: int = 64 * 1024
+) -> Iterator[bytes]:
+    """切分为不大于piece的数据块, 每一块之前调用throttle, 使速度平滑"""
+    if isinstance(content, bytes):
+        content = (content,)
+    for chunk in content:
+        for i in range(0, len(chunk), piece):
+            _piece = chunk[i : i + piece]
+            throttle(len(_piece))
+            yield _piece
+
 
-    threading.Thread(target=put_stream).start()
-    print("启动线程")
-    return target_path.client.put(
+def iter_file(file: Path, chunk_size: int = 1024 * 1024) -> Iterator[bytes]:
+    """分块读取文件"""
+    with file.open("rb") as _f:
+        while chunk := _f.read(chunk_size):
+            yield chunk
+
+
+def put_stream(
+    target_path: AlistPath,
+    content,
+    size: int,
+    modified: int,
+    throttle: Throttle | None = None,
+):
+    """流式上传到target_path, 总是携带Content-Length"""
+    if throttle is not None:
+        content = iter_throttled(content, throttle)
+    res = target_path.client.verify_request(
+        "PUT",
         "/api/fs/put",
-        timeout=0,
         headers={
             "As-Task": "false",
             "Content-Type": "application/octet-stream",
-            "Last-Modified": str(int(time.time() * 1000)),
-            "File-Path": urllib.parse.quote_plus(str(target_path.as_posix())),
+            "Content-Length": str(size),
+            "Last-Modified": str(modified),
+            "File-Path": urllib.parse.quote(str(target_path.as_posix())),
         },
-        # content=open("/Users/lcq/Movies/志愿军-雄军出击-含广告.mp4", "rb"),
-        content=get_chunk(),
+        content=content,
+        timeout=Timeout(300, read=300, write=300, connect=300),
     )
+    if res.code != 200:
+        raise AssertionError(f"上传失败: {target_path} [{res.code}]{res.message}")
+    return res
+
+
+def upload_stream(
+    download_url: str,
+    targets: list[AlistPath],
+    size: int,
+    modified: int,
+    client: Client,
+    chunk_size: int = 1024 * 1024,
+    max_chunks: int = 8,
+    throttle: Throttle | None = None,
+    target_throttle: Callable[[AlistPath], Throttle | None] | None = None,
+) -> dict[str, BaseException | None]:
+    """下载一次, 同时流式上传到全部的targets
+
+    每个目标使用一个上传线程和一个ChunkPipe, 最慢的目标决定下载速度;
+    一个目标失败不影响其他目标。
+    throttle 限制下载的速度, target_throttle 返回每个目标的上传限速。
+
+    :return: {target_uri: None(成功) 或 异常}
+    """
+    pipes = {t.as_uri(): ChunkPipe(max_chunks) for t in targets}
+    results: dict[str, BaseException | None] = {}
+
+    def _upload(_target: AlistPath):
+        _pipe = pipes[_target.as_uri()]
+        try:
+            put_stream(
+                _target,
+                iter(_pipe),
+                size,
+                modified,
+                throttle=target_throttle(_target) if target_throttle else None,
+            )
+            results[_target.as_uri()] = None
+        except BaseException as _e:
+            results[_target.as_uri()] = _e
+            _pipe.abort(_e)
+
+    threads = [
+        threading.Thread(target=_upload, args=(t,), name=f"upload_stream_{t.name}")
+        for t in targets
+    ]
+    for _t in threads:
+        _t.start()
+
+    error = None
+    try:
+        total = 0
+        with client.stream("GET", download_url, follow_redirects=True) as _res:
+            check_response(_res)
+            _res.raise_for_status()
+            _chunks = _res.iter_bytes(chunk_size=chunk_size)
+            if throttle is not None:
+                _chunks = iter_throttled(_chunks, throttle)
+            for chunk in _chunks:
+                total += len(chunk)
+                for _pipe in pipes.values():
+                    if _pipe.aborted is None:
+                        try:
+                            _pipe.put(chunk)
+                        except PipeAborted:
+                            pass
+                if all(p.aborted is not None for p in pipes.values()):
+                    break
+        if total != size:
+            raise AssertionError(f"下载大小不一致: {total} != {size}")
+    except BaseException as _e:
+        error = _e
+        logger.warning(f"流式下载失败: {download_url}: {type(_e)} - {_e}")
+    finally:
+        for _pipe in pipes.values():
+            _pipe.close(error)
+        for _t in threads:
+            _t.join()
+    return results
+
+
+def split_ranges(size: int, count: int) -> list[tuple[int, int]]:
+    """将 [0, size) 切分为count段, 返回 [(start, end), ...], 不包含end"""
+    count = max(1, min(count, size))
+    step, rest = divmod(size, count)
+    ranges, start = [], 0
+    for i in range(count):
+        end = start + step + (1 if i < rest else 0)
+        ranges.append((start, end))
+        start = end
+    return ranges
+
+
+def download_ranges(
+    download_url: str,
+    file: Path,
+    ranges: list[tuple[int, int]],
+    client: Client,
+    progress: list[int],
+    checkpoint: Callable[[list[int]], None] | None = None,
+    checkpoint_size: int = 64 * 1024 * 1024,
+    chunk_size: int = 1024 * 1024,
+    throttle: Throttle | None = None,
+):
+    """使用多个连接并行下载, 每一段写入到file的对应位置
 
+    file必须已经预分配为完整的大小;
+    progress[i]为第i段已经下载的字节数, 下载时原地更新, 从中断的位置继续下载;
+    每下载checkpoint_size字节, 使用progress的副本调用一次checkpoint。
+    """
+    lock = threading.Lock()
+    errors: list[BaseException] = []
+    _checkpoint = [sum(progress)]
 
+    def _download(i: int):
+        start, end = ranges[i]
+        if start + progress[i] >= end:
+            return
+        try:
+            with client.stream(
+                "GET",
+                download_url,
+                headers={"Range": f"bytes={start + progress[i]}-{end - 1}"},
+                follow_redirects=True,
+            ) as _res:
+                check_response(_res)
+                if _res.status_code == 200:
+                    raise RangeNotSupported(download_url)
+                assert _res.status_code == 206, f"下载失败: {_res.status_code}"
+                # 不使用缓冲, checkpoint中的进度总是已经写入文件
+                _chunks = _res.iter_bytes(chunk_size=chunk_size)
+                if throttle is not None:
+                    _chunks = iter_throttled(_chunks, throttle)
+                with file.open("r+b", buffering=0) as _f:
+                    _f.seek(start + progress[i])
+                    for chunk in _chunks:
+                        chunk = chunk[: end - start - progress[i]]
+                        _f.write(chunk)
+                        with lock:
+                            progress[i] += len(chunk)
+                            if (
+                                checkpoint is not None
+                                and sum(progress) - _checkpoint[0] >= checkpoint_size
+                            ):
+                                _checkpoint[0] = sum(progress)
+                                checkpoint(list(progress))
+            assert start + progress[i] == end, f"分段下载不完整: {ranges[i]}"
+        except BaseException as _e:
+            errors.append(_e)
 
+    threads = [
+        threading.Thread(target=_download, args=(i,), name=f"download_range_{i}")
+        for i in range(len(ranges))
+    ]
+    for _t in threads:
+        _t.start()
+    for _t in threads:
+        _t.join()
+    if errors:
+        raise errors[0]
 
-if __name__ == "__main__":
-    from alist_sync.config import create_config, AlistServer
-    from alist_sdk import login_server
 
-    import logging
+class MemoryBudget:
+    """全局内存预算, 申请的字节数超过剩余的预算时等待其他的传输释放,
+    超过全部的预算时抛出ValueError, 调用者应该使用磁盘"""
 
-    logging.basicConfig(level=logging.DEBUG)
+    def __init__(self, size: int):
+        self.size = size
+        self.used = 0
+        self._cond = threading.Condition()
 
-    sync_config = create_config()
-    for _ in sync_config.alist_servers:
-        _: AlistServer
-        login_server(**_.dump_for_alist_path())
+    @contextlib.contextmanager
+    def reserve(self, size: int):
+        if size > self.size:
+            raise ValueError(f"超过内存预算: {size} > {self.size}")
+        with self._cond:
+            self._cond.wait_for(lambda: self.used + size <= self.size)
+            self.used += size
+        try:
+            yield
+        finally:
+            with self._cond:
+                self.used -= size
+                self._cond.notify_all()
 
-    source = AlistPath("https://alist.leecq.cn/local/Country.mmdb")
-    target = AlistPath("http://localhost:5244/local/Country.mmdb")
 
-    print(source.stat())
-    # a = upload_stream_thread(source, target)
-    a = upload_big_file(target)
-    print(a.text)
+def download_bytes(
+    download_url: str, size: int, client: Client, throttle: Throttle | None = None
+) -> bytes:
+    """下载到内存"""
+    with client.stream("GET", download_url, follow_redirects=True) as _res:
+        check_response(_res)
+        assert _res.status_code == 200, f"下载失败: {_res.status_code}"
+        _chunks = _res.iter_bytes()
+        if throttle is not None:
+            _chunks = iter_throttled(_chunks, throttle)
+        content = b"".join(_chunks)
+    assert len(content) == size, f"下载大小不一致: {len(content)} != {size}"
+    return content
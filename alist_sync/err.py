@@ -38,3 +38,16 @@ class UploadError(WorkerError):
 
 class RecheckError(WorkerError):
     pass
+
+
+class CopyTaskError(WorkerError):
+    pass
+
+
+class ServerBusyError(WorkerError):
+    """服务器返回 429/5xx"""
+
+    def __init__(self, *args, status_code: int = None, retry_after: float = None):
+        super().__init__(*args)
+        self.status_code = status_code
+        self.retry_after = retry_after
@@ -0,0 +1,221 @@
+# coding: utf8
+"""全局共享的列目录缓存
+
+扫描器、检查器与复查共用一个缓存, 键为 (服务器, 目录):
+
+1. 缓存的结果在 ttl 秒后过期, daemon 模式下不会一直使用旧的结果;
+2. 全部结果估算的内存不超过 budget, 超过时淘汰最久没有使用的目录 (LRU);
+3. 同一个目录同时只发出一个请求, 其他线程与协程等待同一个结果;
+4. 复查需要上传之后的结果, 使用 since 只接受在该时间之后开始的请求;
+5. Worker完成后, 目标所在目录的缓存失效。
+
+返回的列表被多个使用者共享, 不能修改。
+"""
+import asyncio
+import logging
+import sys
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Awaitable, Callable, NamedTuple
+
+from alist_sdk import AlistPath, Item
+
+from alist_sync.config import create_config
+
+logger = logging.getLogger("alist-sync.listing-cache")
+sync_config = create_config()
+
+__all__ = ["ListingCache", "get_listing_cache"]
+
+# (服务器的base_url, 目录)
+CacheKey = tuple[str, str]
+
+# 一个Item除名称之外占用的内存的估算值
+_ITEM_SIZE = 512
+
+
+class _Entry(NamedTuple):
+    items: list[Item]
+    fetched: float  # 请求开始的时间
+    size: int
+
+
+class ListingCache:
+    """列目录缓存
+
+    :param ttl: 缓存的有效期(秒), 0 不缓存, 但同时的请求仍然合并
+    :param budget: 缓存占用内存的上限(字节, 估算值)
+    """
+
+    def __init__(self, ttl: float = 60, budget: int = 64 * 1024 * 1024):
+        self.ttl = ttl
+        self.budget = budget
+
+        self._entries: OrderedDict[CacheKey, _Entry] = OrderedDict()
+        # {key: (Future, 请求开始的时间)}
+        self._inflight: dict[CacheKey, tuple[Future, float]] = {}
+        self._size = 0
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+
+    @staticmethod
+    def key(path: AlistPath) -> CacheKey:
+        return sync_config.get_server(path.as_uri()).base_url, path.as_posix()
+
+    @staticmethod
+    def size_of(items: list[Item]) -> int:
+        return sum(_ITEM_SIZE + sys.getsizeof(i.name) for i in items)
+
+    def _lookup(self, key: CacheKey, since: float | None) -> _Entry | None:
+        """在锁中调用: 没有过期且在since之后的缓存"""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if time.monotonic() - entry.fetched >= self.ttl:
+            self._remove(key)
+            return None
+        if since is not None and entry.fetched < since:
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def _remove(self, key: CacheKey):
+        """在锁中调用"""
+        if (entry := self._entries.pop(key, None)) is not None:
+            self._size -= entry.size
+
+    def _put(self, key: CacheKey, items: list[Item], fetched: float):
+        """在锁中调用: 保存结果, 然后淘汰最久没有使用的目录直到不超过预算"""
+        if self.ttl <= 0:
+            return
+        entry = _Entry(items, fetched, self.size_of(items))
+        if entry.size > self.budget:
+            return
+        if (_old := self._entries.get(key)) is not None and _old.fetched > fetched:
+            return
+        self._remove(key)
+        self._entries[key] = entry
+        self._size += entry.size
+        while self._size > self.budget:
+            _key, _entry = self._entries.popitem(last=False)
+            self._size -= _entry.size
+            self.evictions += 1
+
+    def _begin(
+        self, key: CacheKey, since: float | None
+    ) -> tuple[list[Item] | None, Future | None, float | None]:
+        """返回 (缓存的结果, Future, 当前调用者发出请求的开始时间, 不需要请求时为None)"""
+        with self._lock:
+            if (entry := self._lookup(key, since)) is not None:
+                self.hits += 1
+                return entry.items, None, None
+            inflight = self._inflight.get(key)
+            if inflight is not None and (since is None or inflight[1] >= since):
+                self.coalesced += 1
+                return None, inflight[0], None
+            self.misses += 1
+            future, started = Future(), time.monotonic()
+            self._inflight[key] = (future, started)
+            return None, future, started
+
+    def _finish(
+        self,
+        key: CacheKey,
+        future: Future,
+        started: float,
+        items: list[Item] | None = None,
+        error: BaseException | None = None,
+    ):
+        """请求结束, 结果按该请求自己的开始时间保存"""
+        with self._lock:
+            _inflight = self._inflight.get(key)
+            if _inflight is not None and _inflight[0] is future:
+                del self._inflight[key]
+            if error is None:
+                self._put(key, items, started)
+        if error is None:
+            future.set_result(items)
+        else:
+            future.set_exception(error)
+
+    def get(
+        self,
+        path: AlistPath,
+        fetch: Callable[[], list[Item]],
+        since: float | None = None,
+    ) -> list[Item]:
+        """目录path中的项目, 没有缓存时调用fetch列出目录
+
+        :param since: time.monotonic() 的时间, 只使用在此之后开始的请求的结果
+        """
+        key = self.key(path)
+        items, future, started = self._begin(key, since)
+        if items is not None:
+            return items
+        if started is None:
+            return future.result()
+        try:
+            items = fetch()
+        except BaseException as _e:
+            self._finish(key, future, started, error=_e)
+            raise
+        self._finish(key, future, started, items)
+        return items
+
+    async def get_async(
+        self,
+        path: AlistPath,
+        fetch: Callable[[], Awaitable[list[Item]]],
+        since: float | None = None,
+    ) -> list[Item]:
+        """协程中使用的get, 与线程中的请求共享缓存与合并"""
+        key = self.key(path)
+        items, future, started = self._begin(key, since)
+        if items is not None:
+            return items
+        if started is None:
+            return await asyncio.wrap_future(future)
+        try:
+            items = await fetch()
+        except BaseException as _e:
+            self._finish(key, future, started, error=_e)
+            raise
+        self._finish(key, future, started, items)
+        return items
+
+    def invalidate(self, *paths: AlistPath):
+        """目录的内容已经改变, 删除其缓存"""
+        with self._lock:
+            for path in paths:
+                self._remove(self.key(path))
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "size": self._size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "evictions": self.evictions,
+        }
+
+
+_listing_cache: ListingCache | None = None
+_listing_cache_lock = threading.Lock()
+
+
+def get_listing_cache() -> ListingCache:
+    """全局唯一的ListingCache"""
+    global _listing_cache
+    with _listing_cache_lock:
+        if _listing_cache is None:
+            _listing_cache = ListingCache(
+                sync_config.listing_cache_ttl, sync_config.listing_cache_size
+            )
+        return _listing_cache
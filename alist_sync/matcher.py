@@ -0,0 +1,93 @@
+# coding: utf8
+"""黑名单/白名单匹配器
+
+全部的模式被编译为一个正则表达式(fnmatch.fnmatchcase 语义), 每个SyncGroup只构建一次。
+目录可以被整体剪枝, 扫描器不需要再列出被忽略的目录。
+"""
+import fnmatch
+import logging
+import re
+from typing import Iterable
+
+logger = logging.getLogger("alist-sync.matcher")
+
+__all__ = ["PathMatcher"]
+
+_WILDCARDS = re.compile(r"[*?\[]")
+
+
+def _compile(patterns: Iterable[str]) -> re.Pattern | None:
+    patterns = list(patterns)
+    if not patterns:
+        return None
+    return re.compile("|".join(f"(?:{fnmatch.translate(p)})" for p in patterns))
+
+
+class PathMatcher:
+    """路径匹配器, 路径为相对于同步目录的相对路径
+
+    1. 匹配黑名单的文件被忽略;
+    2. 白名单不为空时, 没有匹配白名单的文件被忽略;
+    3. 目录本身匹配黑名单, 或者目录下的全部路径都会匹配黑名单, 或者目录下的路径
+       都不可能匹配白名单时, 整个目录被忽略。
+    """
+
+    def __init__(self, blacklist: Iterable[str] = (), whitelist: Iterable[str] = ()):
+        self.blacklist = sorted(set(blacklist))
+        self.whitelist = sorted(set(whitelist))
+
+        self._black = _compile(self.blacklist)
+        # 以 * 结尾的模式, 如果能匹配 "dir/", 则能匹配 dir 下的全部路径
+        self._black_tree = _compile(p for p in self.blacklist if p.endswith("*"))
+        self._white = _compile(self.whitelist)
+        # 白名单模式中第一个通配符之前的固定前缀
+        self._white_prefixes = [_WILDCARDS.split(p, 1)[0] for p in self.whitelist]
+
+    def __repr__(self):
+        return f"<PathMatcher black={self.blacklist} white={self.whitelist}>"
+
+    def _log_matched(self, relative_path: str, patterns: list[str]):
+        if logger.isEnabledFor(logging.DEBUG):
+            _matched = [p for p in patterns if fnmatch.fnmatchcase(relative_path, p)]
+            logger.debug("Ignore: %s, [matched: %s]", relative_path, _matched)
+
+    def match_blacklist(self, relative_path: str) -> bool:
+        if self._black is not None and self._black.match(relative_path):
+            self._log_matched(relative_path, self.blacklist)
+            return True
+        return False
+
+    def match_whitelist(self, relative_path: str) -> bool:
+        return self._white is None or bool(self._white.match(relative_path))
+
+    def maybe_whitelist(self, relative_dir: str) -> bool:
+        """目录下是否可能存在匹配白名单的路径"""
+        if self._white is None:
+            return True
+        _dir = relative_dir + "/"
+        return any(_dir.startswith(p) or p.startswith(_dir) for p in self._white_prefixes)
+
+    def is_ignore(self, relative_path: str, is_dir: bool = False) -> bool:
+        """是否忽略该路径, is_dir为True时判断是否剪枝整个目录"""
+        if relative_path in ("", "."):
+            return False
+
+        if is_dir:
+            if self.match_blacklist(relative_path):
+                return True
+            if self._black_tree is not None and self._black_tree.match(
+                relative_path + "/"
+            ):
+                logger.debug("Ignore Dir: %s, [blacklist]", relative_path)
+                return True
+            if not self.maybe_whitelist(relative_path):
+                logger.debug("Ignore Dir: %s, [whitelist]", relative_path)
+                return True
+            return False
+
+        if self.match_blacklist(relative_path):
+            return True
+        if not self.match_whitelist(relative_path):
+            logger.debug("Ignore: %s, [not in whitelist]", relative_path)
+            return True
+        return False
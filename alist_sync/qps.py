@@ -0,0 +1,83 @@
+# coding: utf8
+"""元数据请求的QPS限制
+
+扫描器、检查器与复查的列目录请求共享令牌桶, 每个请求消耗一个令牌:
+
+1. 每个服务器一个桶, 速率为 max_qps;
+2. 每个配置了 mount_max_qps 的挂载点一个桶, 使用最长匹配的前缀,
+   同一个服务器中的本地磁盘不受限流网盘的限制。
+
+令牌不足时预约后等待, 请求按到达的顺序平滑地发出, 不会同时涌入。
+"""
+import asyncio
+import logging
+import threading
+import time
+
+from alist_sdk import AlistPath
+
+from alist_sync.bandwidth import TokenBucket
+from alist_sync.common import longest_prefix
+from alist_sync.config import create_config
+
+logger = logging.getLogger("alist-sync.qps")
+sync_config = create_config()
+
+__all__ = ["QPSLimiter", "get_qps"]
+
+
+class QPSLimiter:
+    """每个服务器与挂载点的QPS限制"""
+
+    def __init__(self):
+        self._buckets: dict[tuple[str, str], TokenBucket] = {}
+        self._lock = threading.Lock()
+        self.waited = 0.0  # 累计等待的秒数
+
+    def _bucket(self, base_url: str, mount: str, qps: float) -> TokenBucket:
+        key = (base_url, mount)
+        with self._lock:
+            if key not in self._buckets:
+                self._buckets[key] = TokenBucket(f"{base_url}{mount} qps", lambda: qps)
+            return self._buckets[key]
+
+    def buckets(self, path: AlistPath) -> list[TokenBucket]:
+        server = sync_config.get_server(path.as_uri())
+        _buckets = []
+        if server.max_qps:
+            _buckets.append(self._bucket(server.base_url, "", server.max_qps))
+        _mount = longest_prefix(path.as_posix(), server.mount_max_qps)
+        if _mount is not None and server.mount_max_qps[_mount]:
+            _buckets.append(
+                self._bucket(server.base_url, _mount, server.mount_max_qps[_mount])
+            )
+        return _buckets
+
+    def reserve(self, path: AlistPath) -> float:
+        """为path的一个请求预约令牌, 返回需要等待的秒数"""
+        _wait = max((b.reserve(1) for b in self.buckets(path)), default=0)
+        if _wait > 0:
+            self.waited += _wait
+            logger.debug(f"QPS: {path} 等待 {_wait:.2f}s")
+        return _wait
+
+    def acquire(self, path: AlistPath):
+        if (_wait := self.reserve(path)) > 0:
+            time.sleep(_wait)
+
+    async def acquire_async(self, path: AlistPath):
+        if (_wait := self.reserve(path)) > 0:
+            await asyncio.sleep(_wait)
+
+
+_qps: QPSLimiter | None = None
+_qps_lock = threading.Lock()
+
+
+def get_qps() -> QPSLimiter:
+    """全局唯一的QPSLimiter"""
+    global _qps
+    with _qps_lock:
+        if _qps is None:
+            _qps = QPSLimiter()
+        return _qps
@@ -0,0 +1,262 @@
+# coding: utf8
+"""按服务器的重试策略与熔断器
+
+1. 失败后按指数退避等待, 并加入随机抖动, 避免全部的线程同时重试;
+2. 服务器返回 429/5xx 时, 遵守响应中的 Retry-After;
+3. 一个服务器连续失败达到阈值时熔断, 在冷却时间内不再向其调度新的Worker,
+   其他服务器不受影响; 冷却结束后进入半开状态, 只放行一个探测的Worker,
+   探测成功恢复, 失败再次熔断;
+4. 只有服务器的错误(超时、连接错误、429/5xx)计入熔断器,
+   404/403、大小不一致等单个文件的错误仍然重试, 但不会熔断整个服务器。
+
+熔断器的状态在变化时写入缓存目录中的 circuit_breakers.json,
+可以使用 `alist-sync breakers` 查看。
+"""
+import datetime
+import json
+import logging
+import random
+import threading
+import time
+from typing import Callable, Literal, Type, TypeVar
+
+import httpx
+
+from alist_sync.concurrency import get_concurrency, is_overload
+from alist_sync.config import create_config
+from alist_sync.err import RetryError, ServerBusyError
+
+logger = logging.getLogger("alist-sync.retry")
+sync_config = create_config()
+
+__all__ = [
+    "CircuitBreaker",
+    "RetryPolicy",
+    "get_retry_policy",
+    "is_server_error",
+]
+
+BreakerState = Literal["closed", "open", "half-open"]
+
+_T = TypeVar("_T")
+
+# 计入熔断器的错误, TimeoutException 是 TransportError 的子类
+SERVER_ERRORS = (httpx.TransportError, ServerBusyError)
+
+
+def is_server_error(error: BaseException) -> bool:
+    """服务器的错误, 而不是单个文件的错误"""
+    return isinstance(error, SERVER_ERRORS)
+
+
+class CircuitBreaker:
+    """一个服务器的熔断器"""
+
+    def __init__(
+        self,
+        server: str,
+        threshold: int,
+        cooldown: float,
+        on_change: Callable[["CircuitBreaker"], None] | None = None,
+    ):
+        self.server = server
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.on_change = on_change
+
+        self.state: BreakerState = "closed"
+        self.failures = 0
+        self.total_failures = 0
+        self.open_until = 0.0
+        self.last_error: str | None = None
+        self.probing = False  # 半开状态下, 探测是否已经放行
+        self._lock = threading.Lock()
+
+    def _set_state(self, state: BreakerState):
+        if state == self.state:
+            return
+        logger.warning(f"熔断器 [{self.server}]: {self.state} -> {state}")
+        self.state = state
+        if self.on_change is not None:
+            self.on_change(self)
+
+    def available(self) -> bool:
+        """是否可以调度新的任务, 不占用半开状态的探测"""
+        with self._lock:
+            if self.state == "open":
+                return time.time() >= self.open_until
+            return self.state == "closed" or not self.probing
+
+    def allow(self) -> bool:
+        """调度一个新的任务, 半开状态下只放行一个探测"""
+        with self._lock:
+            if self.state == "open" and time.time() >= self.open_until:
+                self._set_state("half-open")
+            if self.state == "closed":
+                return True
+            if self.state == "half-open" and not self.probing:
+                self.probing = True
+                return True
+            return False
+
+    def release_probe(self):
+        """探测的任务结束, 但没有得到服务器是否恢复的结果, 允许下一个探测"""
+        with self._lock:
+            self.probing = False
+
+    def remaining(self) -> float:
+        """熔断剩余的秒数"""
+        return max(self.open_until - time.time(), 0) if self.state == "open" else 0
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.probing = False
+            self._set_state("closed")
+
+    def record_failure(self, error: BaseException, retry_after: float | None = None):
+        with self._lock:
+            self.failures += 1
+            self.total_failures += 1
+            self.last_error = f"{type(error).__name__}: {error}"
+            if self.state == "half-open" or self.failures >= self.threshold:
+                self.open_until = time.time() + max(self.cooldown, retry_after or 0)
+                self.probing = False
+                self._set_state("open")
+
+    def to_dict(self) -> dict:
+        return {
+            "server": self.server,
+            "state": self.state,
+            "failures": self.failures,
+            "total_failures": self.total_failures,
+            "open_until": (
+                datetime.datetime.fromtimestamp(self.open_until).isoformat()
+                if self.open_until
+                else None
+            ),
+            "last_error": self.last_error,
+        }
+
+
+class RetryPolicy:
+    """按服务器的重试策略
+
+    :param retry: 最大的重试次数
+    :param base_delay: 第一次重试的基础等待时间(秒), 之后每次翻倍
+    :param max_delay: 单次等待时间的上限(秒)
+    :param threshold: 连续失败多少次后熔断
+    :param cooldown: 熔断的冷却时间(秒)
+    """
+
+    def __init__(
+        self,
+        retry: int = 5,
+        base_delay: float = 1,
+        max_delay: float = 60,
+        threshold: int = 5,
+        cooldown: float = 60,
+    ):
+        self.retry = retry
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.threshold = threshold
+        self.cooldown = cooldown
+
+        self.state_file = sync_config.cache_dir.joinpath("circuit_breakers.json")
+        self._breakers: dict[str, CircuitBreaker] = {}
+        self._listeners: list[Callable[[CircuitBreaker], None]] = []
+        self._lock = threading.Lock()
+
+    def add_listener(self, listener: Callable[[CircuitBreaker], None]):
+        """熔断器状态变化时调用listener, 例如调度器在熔断结束时重新调度"""
+        self._listeners.append(listener)
+
+    def breaker(self, server: str) -> CircuitBreaker:
+        with self._lock:
+            if server not in self._breakers:
+                self._breakers[server] = CircuitBreaker(
+                    server, self.threshold, self.cooldown, self._on_change
+                )
+            return self._breakers[server]
+
+    def states(self) -> dict[str, dict]:
+        return {k: v.to_dict() for k, v in self._breakers.items()}
+
+    def _on_change(self, breaker: CircuitBreaker):
+        try:
+            self.state_file.write_text(json.dumps(self.states(), indent=2))
+        except OSError as _e:
+            logger.warning(f"保存熔断器状态失败: {_e}")
+        for _listener in self._listeners:
+            _listener(breaker)
+
+    def record_failure(self, server: str, error: BaseException):
+        """记录一次失败: 服务器的错误计入熔断器, 服务器过载时同时减少该服务器的并发"""
+        if not is_server_error(error):
+            return
+        self.breaker(server).record_failure(error, getattr(error, "retry_after", None))
+        if is_overload(error):
+            get_concurrency().overloaded(server, error)
+
+    def delay(self, attempt: int, retry_after: float | None = None) -> float:
+        """指数退避 + 全抖动, 服务器指定了Retry-After时不少于Retry-After"""
+        _delay = random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+        return max(_delay, retry_after or 0)
+
+    def call(
+        self,
+        server: str,
+        func: Callable[..., _T],
+        *args,
+        excepts: tuple[Type[BaseException], ...] = (
+            httpx.TimeoutException,
+            httpx.TransportError,
+            AssertionError,
+            ServerBusyError,
+        ),
+        retry: int | None = None,
+        **kwargs,
+    ) -> _T:
+        """调用func, 失败时按服务器退避重试, 重试全部失败后抛出RetryError"""
+        retry = self.retry if retry is None else retry
+        breaker = self.breaker(server)
+        for attempt in range(retry + 1):
+            try:
+                result = func(*args, **kwargs)
+            except excepts as _e:
+                retry_after = getattr(_e, "retry_after", None)
+                self.record_failure(server, _e)
+                if attempt >= retry:
+                    logger.error(
+                        f"Retry Error [{server}] [{func.__name__}]: {type(_e)} - {_e}"
+                    )
+                    raise RetryError(f"Retry {func.__name__} Error.") from _e
+                _delay = max(self.delay(attempt, retry_after), breaker.remaining())
+                logger.warning(
+                    f"Retry [{server}] [{func.__name__}] {attempt + 1}/{retry}, "
+                    f"{_delay:.1f}秒后重试: {type(_e)} - {_e}"
+                )
+                time.sleep(_delay)
+            else:
+                breaker.record_success()
+                return result
+
+
+_policy: RetryPolicy | None = None
+_policy_lock = threading.Lock()
+
+
+def get_retry_policy() -> RetryPolicy:
+    """全局唯一的RetryPolicy"""
+    global _policy
+    with _policy_lock:
+        if _policy is None:
+            _policy = RetryPolicy(
+                retry=sync_config.retry_max,
+                base_delay=sync_config.retry_base_delay,
+                max_delay=sync_config.retry_max_delay,
+                threshold=sync_config.breaker_threshold,
+                cooldown=sync_config.breaker_cooldown,
+            )
+        return _policy
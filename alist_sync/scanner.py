@@ -1,101 +1,321 @@
 # coding: utf8
+"""异步扫描器
+
+使用 asyncio 遍历 Alist 中的目录树:
+
+1. 目录放入待扫描队列, 由固定数量的协程同时列出, 即每个服务器同时进行的列目录请求数量可配置;
+2. 使用 asyncio.Queue 的 task_done/join 精确判断扫描完成, 不需要 sleep 轮询;
+3. 扫描结果以异步迭代器的方式流式输出, 可以直接被 Checker 消费;
+4. 可选的目录快照: 子目录的修改时间与上次快照一致时, 使用快照中的列表, 不再列出该目录,
+   其中的子目录仍然逐个检查; 快照由Checker在该目录的Worker全部完成后保存,
+   同时记录目标目录的修改时间, 目标目录也没有变化时Checker跳过该目录的对比;
+5. 被黑名单/白名单忽略的目录在列出之前就被剪枝。
+"""
 import asyncio
+import contextlib
+import datetime
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import PurePosixPath
+from typing import AsyncIterator, NamedTuple, TYPE_CHECKING
 
 from alist_sdk import Item, AlistPath
-from pydantic import BaseModel
+from pydantic import BaseModel, ValidationError
 
 from alist_sync.alist_client import AlistClient
-from alist_sync.common import get_alist_client
+from alist_sync.common import get_alist_client, busy_error, is_not_found
+from alist_sync.err import ServerBusyError
+from alist_sync.matcher import PathMatcher
+from alist_sync.retry import get_retry_policy
+
+if TYPE_CHECKING:
+    from alist_sync.concurrency import AIMDLimiter
+    from alist_sync.data_handle import HandleBase
+    from alist_sync.listing_cache import ListingCache
+    from alist_sync.qps import QPSLimiter
 
 
 logger = logging.getLogger("alist-sync.scan-dir")
 
-__all__ = ["scan_dirs", "Scanner"]
+__all__ = ["scan_dirs", "Scanner", "ScanDir", "DirSnapshot"]
+
+
+class ScanDir(NamedTuple):
+    """一个已经被列出的目录"""
+
+    path: AlistPath
+    items: list[Item]
+    relative: str = ""  # 相对于扫描根目录的路径
+    # 目录的快照, 由Checker确认目录已经同步后保存; 不使用快照时为None
+    snapshot: "DirSnapshot | None" = None
+    # items 来自修改时间没有变化的快照, 而不是列出目录
+    reused: bool = False
+
+    def files(self) -> list[AlistPath]:
+        """目录中的文件, 已经设置好了stat"""
+        return [self.path_of(i) for i in self.items if not i.is_dir]
+
+    def dirs(self) -> list[AlistPath]:
+        """目录中的子目录, 已经设置好了stat"""
+        return [self.path_of(i) for i in self.items if i.is_dir]
+
+    def path_of(self, item: Item) -> AlistPath:
+        _path = self.path.joinpath(item.name)
+        _path.set_stat(item)
+        return _path
 
 
-class Scanner(BaseModel):
-    # scan_path: list[item]
-    queue: asyncio.Queue = asyncio.Queue(30)
-    items: dict[str | PurePosixPath, list[Item]]
+class DirSnapshot(BaseModel):
+    """目录快照, 目录自身的修改时间及列出的全部项目,
+    以及确认同步时各个目标目录的修改时间 {目标目录uri: 修改时间}"""
 
-    model_config = {"arbitrary_types_allowed": True}
+    path: str
+    modified: datetime.datetime | None = None
+    scan_time: datetime.datetime
+    items: list[Item] = []
+    targets: dict[str, datetime.datetime] = {}
 
     @classmethod
-    async def scans(cls, *scan_path, client: AlistClient = None):
-        """扫描目录"""
-        client = client or get_alist_client()
+    def from_items(cls, path: AlistPath, items: list[Item]) -> "DirSnapshot":
+        _stat = getattr(path, "_stat", None)
         return cls(
-            items={
-                k: v
-                for k, v in await asyncio.gather(
-                    *[cls.scan(path, client) for path in scan_path]
-                )
-            }
+            path=path.as_uri(),
+            modified=_stat.modified if _stat is not None else None,
+            scan_time=datetime.datetime.now(),
+            items=items,
         )
 
-    @classmethod
-    async def retry(cls, client, _path, _rt=5) -> list[Item]:
-        __res = await client.list_files(_path, refresh=True)
-        if __res.code != 200:
-            logger.warning(f"扫描目录异常: {_path=} {__res.code=} {__res.message=}")
-            if _rt:
-                return await cls.retry(client, _path, _rt=_rt - 1)
-            exit(1)
-        return __res.data.content or []
+    def is_fresh(self, stat: Item, ttl: int) -> bool:
+        """目录的修改时间没有变化, 且快照没有过期"""
+        return (
+            self.modified is not None
+            and self.modified == stat.modified
+            and (datetime.datetime.now() - self.scan_time).total_seconds() < ttl
+        )
 
-    @classmethod
-    async def get_files(cls, client, _path, output):
-        _path = PurePosixPath(_path)
-        if _path.name == ".alist-sync-data":
-            logger.debug("跳过 .alist-sync-data ...")
-            return
-
-        __res = await cls.retry(client, _path)
-        for _item in __res:
-            _item: Item
-            _item.parent = _path
-            if _item.is_dir:
-                # noinspection PyAsyncCall
-                asyncio.create_task(
-                    cls.get_files(client, _item.full_name, output),
-                    name=f"scan_{_item.full_name}",
-                )
-            else:
-                # _list.append(_item)
-                await cls.queue.put(_item)
-                logger.debug("find: %s", _item.full_name)
-                return _item
 
-    @classmethod
-    async def scan(
-        cls,
-        path: str | PurePosixPath,
-        client: AlistClient,
-        output: list | asyncio.Queue = None,
-    ) -> tuple[str, list[Item]]:
-        """扫描目录"""
-        if output is None:
-            output: list[Item] = []
-
-        logger.info("扫描目录 %s 中的文件.", path)
-        await cls.get_files(client, path, output)
-        await cls.lock()
-        return path, output
+class Scanner:
+    """异步扫描器
+
+    :param client: AlistClient, 全部请求受其 max_connect 信号量的限制
+    :param max_listing: 同时进行的列目录请求数量
+    :param limiter: 自适应并发限制器, 实际的并发数由其决定, 不超过max_listing
+    :param qps: 列目录请求的QPS限制, None 不限制
+    :param cache: 共享的列目录缓存, None 不使用缓存
+    :param matcher: 黑名单/白名单, 被忽略的文件不会输出, 被忽略的目录不会被列出
+    :param retry: 列目录失败时的重试次数
+    :param output_size: 输出队列的长度, 消费者过慢时扫描器会等待
+    :param snapshot: 读取目录快照的 HandleBase, None 不使用快照
+    :param snapshot_ttl: 快照的有效期(秒), 过期后重新列出该目录
+    """
+
+    def __init__(
+        self,
+        client: AlistClient = None,
+        max_listing: int = 10,
+        matcher: PathMatcher | None = None,
+        retry: int = 5,
+        output_size: int = 30,
+        snapshot: "HandleBase | None" = None,
+        snapshot_ttl: int = 0,
+        limiter: "AIMDLimiter | None" = None,
+        qps: "QPSLimiter | None" = None,
+        cache: "ListingCache | None" = None,
+    ):
+        self.client = client or get_alist_client()
+        self.max_listing = max(1, max_listing)
+        self.matcher = matcher
+        self.retry = retry
+        self.output_size = output_size
+        self.snapshot = snapshot if snapshot_ttl > 0 else None
+        self.snapshot_ttl = snapshot_ttl
+        self.limiter = limiter
+        self.qps = qps
+        self.cache = cache
+        self._snapshot_executor: ThreadPoolExecutor | None = None
+
+        self.listed_dirs = 0
+        self.skipped_dirs = 0
+        self.found_files = 0
+        self.failed_dirs: list[AlistPath] = []
+
+    def to_alist_path(self, path: AlistPath | str | PurePosixPath) -> AlistPath:
+        if isinstance(path, AlistPath) and path.is_absolute():
+            return path
+        return AlistPath(self.client.base_url.join(str(path)).__str__())
 
     @staticmethod
-    async def lock():
-        pre = f"scan"
+    def join_relative(relative: str, name: str) -> str:
+        return f"{relative}/{name}" if relative else name
+
+    def is_ignore(self, relative: str, item: Item) -> bool:
+        return self.matcher is not None and self.matcher.is_ignore(
+            self.join_relative(relative, item.name), item.is_dir
+        )
+
+    async def list_dir(self, path: AlistPath) -> list[Item]:
+        """列出目录, 使用缓存时, 与检查器和复查共享结果"""
+        if self.cache is None:
+            return await self._list_dir(path)
+        return await self.cache.get_async(path, lambda: self._list_dir(path))
+
+    async def _list_once(self, path: AlistPath):
+        """列出一次目录, 429/5xx 在并发位置中抛出ServerBusyError, 计入自适应并发"""
+        if self.qps is not None:
+            await self.qps.acquire_async(path)
+        async with (
+            self.limiter.async_slot()
+            if self.limiter is not None
+            else contextlib.nullcontext()
+        ):
+            _res = await self.client.list_files(path.as_posix(), refresh=True)
+            if (_e := busy_error(_res, str(self.client.base_url))) is not None:
+                raise _e
+        return _res
+
+    async def _list_dir(self, path: AlistPath) -> list[Item]:
+        """列出目录, 失败时按指数退避重试, 服务器指定了Retry-After时遵守"""
+        for attempt in range(self.retry + 1):
+            _retry_after = None
+            try:
+                _res = await self._list_once(path)
+                if _res.code == 200:
+                    return _res.data.content or []
+                if is_not_found(_res):
+                    break
+                _error = f"{_res.code=} {_res.message=}"
+            except ServerBusyError as _e:
+                _retry_after, _error = _e.retry_after, str(_e)
+            if attempt >= self.retry:
+                break
+            _delay = get_retry_policy().delay(attempt, _retry_after)
+            logger.warning(
+                f"扫描目录异常: {path} {_error}, "
+                f"剩余重试: {self.retry - attempt}, {_delay:.1f}秒后重试"
+            )
+            await asyncio.sleep(_delay)
+        raise FileNotFoundError(f"扫描目录失败: {path}")
+
+    async def _snapshot_io(self, func, *args):
+        """快照的读写在单独的线程中串行执行, 不阻塞事件循环"""
+        return await asyncio.get_running_loop().run_in_executor(
+            self._snapshot_executor, func, *args
+        )
+
+    async def fresh_snapshots(self, scan_dir: ScanDir) -> dict[str, DirSnapshot]:
+        """子目录中修改时间与快照一致的, 返回 {uri: DirSnapshot}"""
+        _dirs = scan_dir.dirs()
+        if self.snapshot is None or not _dirs:
+            return {}
+
+        _fresh = {}
+        _snapshots = await self._snapshot_io(self.snapshot.get_file_items, _dirs)
+        for _dir in _dirs:
+            if (_snapshot := _snapshots.get(_dir.as_uri())) is None:
+                continue
+            try:
+                _snapshot = DirSnapshot.model_validate(_snapshot)
+            except ValidationError:
+                continue
+            if _snapshot.is_fresh(_dir.stat(), self.snapshot_ttl):
+                _fresh[_dir.as_uri()] = _snapshot
+        return _fresh
+
+    async def _walker(self, dir_queue: asyncio.Queue, output: asyncio.Queue):
+        """从dir_queue中取出目录并列出, 子目录放回dir_queue, 结果放入output"""
         while True:
-            await asyncio.sleep(1)
-            names = [i.get_name() for i in asyncio.all_tasks() if pre in i.get_name()]
-            logger.debug("lock: %s: %s", pre, names)
-            if not names:
-                return
+            path, relative, snapshot = await dir_queue.get()
+            try:
+                logger.debug(f"Scaner: {path}")
+                reused = snapshot is not None
+                if reused:
+                    logger.debug(f"Snapshot: 目录未变化, 使用快照: {path}")
+                    self.skipped_dirs += 1
+                    _listed = snapshot.items
+                else:
+                    _listed = await self.list_dir(path)
+                    self.listed_dirs += 1
+                    if self.snapshot is not None:
+                        snapshot = DirSnapshot.from_items(path, _listed)
+                _items = [i for i in _listed if not self.is_ignore(relative, i)]
+                scan_dir = ScanDir(path, _items, relative, snapshot, reused)
+                _fresh = await self.fresh_snapshots(scan_dir)
+                for _dir in scan_dir.dirs():
+                    dir_queue.put_nowait(
+                        (
+                            _dir,
+                            self.join_relative(relative, _dir.name),
+                            _fresh.get(_dir.as_uri()),
+                        )
+                    )
+                await output.put(scan_dir)
+            except Exception as _e:
+                self.failed_dirs.append(path)
+                logger.error("Scaner Error: %s, %s", path, _e, exc_info=_e)
+            finally:
+                dir_queue.task_done()
+
+    async def _producer(self, paths: list[AlistPath], output: asyncio.Queue):
+        dir_queue = asyncio.Queue()
+        for path in paths:
+            dir_queue.put_nowait((path, "", None))
+
+        if self.snapshot is not None:
+            self._snapshot_executor = ThreadPoolExecutor(1, "scaner_snapshot")
+        walkers = [
+            asyncio.create_task(
+                self._walker(dir_queue, output), name=f"scan_walker_{i}"
+            )
+            for i in range(self.max_listing)
+        ]
+        try:
+            await dir_queue.join()
+        finally:
+            for _w in walkers:
+                _w.cancel()
+            await asyncio.gather(*walkers, return_exceptions=True)
+            if self._snapshot_executor is not None:
+                self._snapshot_executor.shutdown()
+
+        await output.put(None)
+        logger.info(
+            f"扫描完成: {[str(p) for p in paths]}, 目录: {self.listed_dirs}, "
+            f"使用快照: {self.skipped_dirs}, 失败目录: {len(self.failed_dirs)}"
+        )
+
+    async def iter_dirs(self, *paths: AlistPath | str) -> AsyncIterator[ScanDir]:
+        """流式输出扫描到的目录 (包括其中的文件列表)"""
+        output = asyncio.Queue(self.output_size)
+        producer = asyncio.create_task(
+            self._producer([self.to_alist_path(p) for p in paths], output),
+            name="scan_producer",
+        )
+        try:
+            while (scan_dir := await output.get()) is not None:
+                self.found_files += sum(1 for i in scan_dir.items if not i.is_dir)
+                yield scan_dir
+            await producer
+        finally:
+            if not producer.done():
+                producer.cancel()
+
+    async def iter_files(self, *paths: AlistPath | str) -> AsyncIterator[AlistPath]:
+        """流式输出扫描到的文件"""
+        async for scan_dir in self.iter_dirs(*paths):
+            for _file in scan_dir.files():
+                logger.debug(f"Find File: {_file}")
+                yield _file
+
+    async def scans(self, *paths: AlistPath | str) -> dict[str, list[Item]]:
+        """扫描目录, 返回 {扫描路径: [全部文件]}"""
+        result = {}
+        for path in paths:
+            result[str(path)] = [
+                _file.stat() async for _file in self.iter_files(path)
+            ]
+        return result
 
 
-async def scan_dirs(*scan_path, client: AlistClient = None) -> Scanner:
+async def scan_dirs(*scan_path, client: AlistClient = None) -> dict[str, list[Item]]:
     """扫描目录"""
-    client = client or get_alist_client()
-    return await Scanner.scans(*scan_path, client=client)
+    return await Scanner(client).scans(*scan_path)
@@ -0,0 +1,298 @@
+# coding: utf8
+"""Worker调度器
+
+每个目标挂载点一个队列, 同时执行的Worker数量受目标服务器的 max_connect
+与挂载点的 mount_max_connect 限制, 一个缓慢的挂载点不会占用全部的线程。
+
+调度完全由事件驱动: 提交Worker与Worker完成时, 轮流从各个队列中取出可以执行的Worker,
+不需要轮询与sleep。
+
+按文件大小调度, 文件大小来自Checker列目录的结果, 不需要额外的请求:
+
+1. 小文件通道: 每个挂载点保留 small_file_slots 个只能执行小文件的位置,
+   大文件不会占用全部的位置;
+2. 大文件优先执行最大的文件(最长作业优先), 避免最后剩下一个大文件单独传输;
+3. 预算模式(非daemon模式): 在 timeout 截止之前, 尽可能多地完成文件数量(files)
+   或字节数(bytes), 根据已完成的Worker估算每个服务器的传输速度。
+
+源服务器或目标服务器熔断时, 其Worker留在队列中, 冷却结束后只调度一个探测的Worker,
+探测完成后根据结果恢复调度或者再次熔断。
+"""
+import logging
+import threading
+import time
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING
+
+from alist_sdk import AlistPath
+
+from alist_sync.common import longest_prefix
+from alist_sync.concurrency import get_concurrency
+from alist_sync.config import create_config
+from alist_sync.retry import CircuitBreaker, get_retry_policy
+
+if TYPE_CHECKING:
+    from alist_sync.d_worker import Worker
+
+logger = logging.getLogger("alist-sync.scheduler")
+sync_config = create_config()
+
+__all__ = ["Scheduler"]
+
+# (服务器的base_url, 挂载点)
+QueueKey = tuple[str, str]
+
+
+def queue_key(path: AlistPath) -> QueueKey:
+    """path所在的服务器与挂载点, 挂载点为配置中最长的匹配前缀, 没有配置时为第一级目录"""
+    server = sync_config.get_server(path.as_uri())
+    _posix = path.as_posix()
+    _mount = longest_prefix(_posix, server.mount_max_connect)
+    if _mount is not None:
+        return server.base_url, _mount
+    return server.base_url, "/" + _posix.strip("/").split("/")[0]
+
+
+class Scheduler:
+    """按目标服务器与挂载点调度Worker
+
+    :param max_queued: 排队中的Worker的最大数量, 达到后submit阻塞, 直到有Worker开始执行
+    """
+
+    def __init__(self, max_queued: int = 1000):
+        self.max_queued = max_queued
+
+        # 有序字典, 每次从一个队列中取出Worker后, 该队列移动到最后, 实现轮流调度
+        # 每个挂载点两个通道: (小文件, 大文件)
+        self._queues: OrderedDict[
+            QueueKey, tuple[list["Worker"], list["Worker"]]
+        ] = OrderedDict()
+        self._running_servers: Counter[str] = Counter()
+        self._running_mounts: Counter[QueueKey] = Counter()
+        self._running_large: Counter[QueueKey] = Counter()
+        # 每个服务器的传输速度估算(字节/秒)
+        self._rates: dict[str, float] = {}
+        # 位置不足, 减少了小文件保留位置的挂载点, 只警告一次
+        self._clamped: set[QueueKey] = set()
+        self._queued = 0
+        self._running = 0
+        self._cond = threading.Condition()
+
+        self.pool = ThreadPoolExecutor(
+            sync_config.thread_pool_max_size.workers
+            or max(sum(s.max_connect for s in sync_config.alist_servers), 1),
+            "worker_",
+        )
+        get_retry_policy().add_listener(self._on_breaker)
+
+    def qsize(self) -> int:
+        return self._queued
+
+    @staticmethod
+    def size_of(worker: "Worker") -> int:
+        return worker.file_size or 0
+
+    def is_small(self, worker: "Worker") -> bool:
+        return self.size_of(worker) < sync_config.small_file_size
+
+    @staticmethod
+    def worker_keys(worker: "Worker") -> set[QueueKey]:
+        return {queue_key(t) for t in worker.all_targets}
+
+    @staticmethod
+    def server_limit(base_url: str) -> int:
+        """目标服务器当前的并发数, 由自适应并发调整, 不超过 max_connect"""
+        return get_concurrency().limiter(base_url, "worker").current
+
+    @staticmethod
+    def mount_limit(key: QueueKey) -> int:
+        server = sync_config.get_server(key[0])
+        return server.mount_max_connect.get(key[1], server.max_connect)
+
+    def _can_run(self, keys: set[QueueKey]) -> bool:
+        return all(
+            self._running_mounts[k] < self.mount_limit(k)
+            and self._running_servers[k[0]] < self.server_limit(k[0])
+            for k in keys
+        )
+
+    @staticmethod
+    def _breakers(worker: "Worker", keys: set[QueueKey]) -> list[CircuitBreaker]:
+        """源服务器与目标服务器的熔断器"""
+        _policy = get_retry_policy()
+        servers = {k[0] for k in keys}
+        if worker.source_path is not None:
+            servers.add(sync_config.get_server(worker.source_path.as_uri()).base_url)
+        return [_policy.breaker(s) for s in servers]
+
+    def _breakers_allow(self, worker: "Worker", keys: set[QueueKey]) -> bool:
+        """源服务器与目标服务器都可以调度; 全部可以调度时才占用半开状态的探测"""
+        breakers = self._breakers(worker, keys)
+        if not all(b.available() for b in breakers):
+            return False
+        allowed = [b for b in breakers if b.allow()]
+        if len(allowed) == len(breakers):
+            return True
+        # 检查之后状态发生了变化, 释放已经占用的探测
+        for _breaker in allowed:
+            if _breaker.state == "half-open":
+                _breaker.release_probe()
+        return False
+
+    def _settle_breakers(self, worker: "Worker", keys: set[QueueKey]):
+        """Worker完成时恢复其服务器的熔断器, 失败时只释放探测,
+        服务器的错误已经在重试时计入熔断器"""
+        for _breaker in self._breakers(worker, keys):
+            if worker.status == "done":
+                _breaker.record_success()
+            else:
+                _breaker.release_probe()
+
+    def _on_breaker(self, breaker: CircuitBreaker):
+        """熔断后, 在冷却结束时重新调度; 此时持有熔断器的锁, 不能获取调度器的锁"""
+        if breaker.state == "open":
+            _timer = threading.Timer(breaker.remaining() + 0.05, self.wakeup)
+            _timer.daemon = True
+            _timer.start()
+
+    def wakeup(self):
+        with self._cond:
+            self._dispatch()
+
+    def _acquire(self, keys: set[QueueKey], value: int = 1):
+        for k in keys:
+            self._running_mounts[k] += value
+            self._running_servers[k[0]] += value
+
+    def large_limit(self, key: QueueKey) -> int:
+        """挂载点同时执行的大文件的上限
+
+        可用的位置为挂载点与服务器当前的并发数中较小的一个, 其中保留 small_file_slots 个给小文件;
+        small_file_slots 不小于可用的位置时, 减少为可用的位置减1, 只有1个位置时不保留。
+        """
+        limit = min(self.mount_limit(key), self.server_limit(key[0]))
+        reserved = min(sync_config.small_file_slots, limit - 1)
+        if reserved < sync_config.small_file_slots and key not in self._clamped:
+            self._clamped.add(key)
+            logger.warning(
+                f"挂载点 {key} 只有 {limit} 个位置, "
+                f"small_file_slots={sync_config.small_file_slots} 减少为 {reserved}"
+            )
+        return max(limit - reserved, 1)
+
+    def _large_can_run(self, key: QueueKey) -> bool:
+        """大文件不能占用为小文件保留的位置"""
+        return self._running_large[key] < self.large_limit(key)
+
+    def _remaining(self) -> float | None:
+        """预算模式下距离截止时间的秒数, 不使用预算模式时为None"""
+        if not sync_config.schedule_budget or sync_config.daemon:
+            return None
+        return sync_config.start_time + sync_config.timeout - time.time()
+
+    def _order(self, lane: list["Worker"], large: bool, key: QueueKey) -> list[int]:
+        """通道中Worker的执行顺序, 返回下标的列表"""
+        sizes = [self.size_of(w) for w in lane]
+        remaining = self._remaining()
+        if remaining is None:
+            # 小文件按到达顺序, 大文件最长作业优先
+            if not large:
+                return list(range(len(lane)))
+            return sorted(range(len(lane)), key=lambda i: -sizes[i])
+
+        if sync_config.schedule_budget == "files":
+            # 最短作业优先, 截止之前完成的文件数量最多
+            return sorted(range(len(lane)), key=lambda i: sizes[i])
+
+        # bytes: 截止之前能够完成的文件中最大的优先, 然后是不能完成的文件, 最长作业优先
+        rate = self._rates.get(key[0])
+        return sorted(
+            range(len(lane)),
+            key=lambda i: (rate is not None and sizes[i] / rate > remaining, -sizes[i]),
+        )
+
+    def _find(self, lane: list["Worker"], large: bool, key: QueueKey):
+        """按执行顺序找到第一个可以执行的Worker, 返回 (下标, 目标挂载点);
+        前面的Worker的其他目标已满或服务器熔断时, 不阻塞后面的Worker"""
+        for index in self._order(lane, large, key):
+            keys = self.worker_keys(lane[index])
+            if self._can_run(keys) and self._breakers_allow(lane[index], keys):
+                return index, keys
+        return None, None
+
+    def _dispatch(self):
+        """在锁中调用: 轮流从各个队列中取出可以执行的Worker, 直到没有可以执行的Worker"""
+        progressed = True
+        while progressed:
+            progressed = False
+            for key in list(self._queues):
+                for large, lane in enumerate(self._queues[key]):
+                    if not lane or (large and not self._large_can_run(key)):
+                        continue
+                    index, keys = self._find(lane, bool(large), key)
+                    if index is None:
+                        continue
+                    worker = lane.pop(index)
+                    self._queued -= 1
+                    self._running += 1
+                    self._running_large[key] += large
+                    self._acquire(keys)
+                    self._queues.move_to_end(key)
+                    self.pool.submit(self._run, worker, keys, key, large)
+                    progressed = True
+                    self._cond.notify_all()
+                    break
+
+    def _update_rate(self, worker: "Worker", seconds: float):
+        size = self.size_of(worker)
+        if size < sync_config.small_file_size or seconds <= 0:
+            return
+        server = sync_config.get_server(worker.target_path.as_uri()).base_url
+        rate = size / seconds
+        _old = self._rates.get(server)
+        self._rates[server] = rate if _old is None else _old * 0.7 + rate * 0.3
+
+    @staticmethod
+    def _record(worker: "Worker", seconds: float):
+        """完成的Worker计入目标服务器的自适应并发, 延迟为每MiB的时间, 小文件按1MiB计算;
+        超时与429/5xx已经在重试时计入"""
+        if worker.status != "done":
+            return
+        _mib = max(Scheduler.size_of(worker) / 1024 / 1024, 1)
+        for _target in worker.all_targets:
+            get_concurrency().limiter(_target.as_uri(), "worker").record(seconds / _mib)
+
+    def _run(self, worker: "Worker", keys: set[QueueKey], key: QueueKey, large: int):
+        _start = time.time()
+        try:
+            worker.run()
+        except Exception as _e:
+            logger.error(f"Worker[{worker.short_id}] Error: {_e}", exc_info=_e)
+        finally:
+            with self._cond:
+                self._update_rate(worker, time.time() - _start)
+                self._record(worker, time.time() - _start)
+                self._settle_breakers(worker, keys)
+                self._running -= 1
+                self._running_large[key] -= large
+                self._acquire(keys, -1)
+                self._dispatch()
+                self._cond.notify_all()
+
+    def submit(self, worker: "Worker"):
+        """添加到目标挂载点的队列, 排队数量达到max_queued时阻塞"""
+        key = queue_key(worker.target_path)
+        with self._cond:
+            self._cond.wait_for(lambda: self._queued < self.max_queued)
+            self._queues.setdefault(key, ([], []))[
+                not self.is_small(worker)
+            ].append(worker)
+            self._queued += 1
+            self._dispatch()
+
+    def join(self):
+        """等待全部的Worker执行完成"""
+        with self._cond:
+            self._cond.wait_for(lambda: self._queued == 0 and self._running == 0)
+        self.pool.shutdown(wait=True)
@@ -0,0 +1,258 @@
+# coding: utf8
+"""服务端复制
+
+数据不经过本机, 由Alist服务器完成复制:
+
+1. 源文件与目标在同一个Alist服务器时, 使用 /api/fs/copy 复制,
+   同一个源目录复制到同一个目标目录的文件, 合并为一个复制请求;
+2. 源文件与目标在不同的服务器时, 目标服务器使用离线下载拉取源文件的签名下载链接;
+3. 提交后通过任务API轮询, 直到全部的任务结束; 同一个存储中的复制是同步完成的, 没有任务,
+   找不到任务时刷新目标目录, 大小与源文件一致即完成;
+4. 全部的请求在一个后台事件循环中执行, Worker线程等待返回的Future。
+"""
+import asyncio
+import logging
+import threading
+import time
+import urllib.parse
+from concurrent.futures import Future
+
+from alist_sdk import AlistPath, Task
+
+from alist_sync.alist_client import (
+    AlistClient,
+    create_async_client,
+    get_copy_tasks,
+    find_tasks,
+    find_transfer_tasks,
+)
+from alist_sync.config import create_config
+from alist_sync.err import CopyTaskError
+
+logger = logging.getLogger("alist-sync.server-copy")
+sync_config = create_config()
+
+__all__ = ["ServerCopier", "get_server_copier", "signed_download_url"]
+
+# 提交后, 任务列表中一直找不到该任务的最长时间(秒)
+TASK_MISSING_TIMEOUT = 60
+
+
+def signed_download_url(path: AlistPath) -> str:
+    """Alist的签名下载链接: {base_url}/d/{path}?sign={sign}"""
+    _server = sync_config.get_server(path.as_uri())
+    _url = f"{_server.base_url.rstrip('/')}/d{urllib.parse.quote(path.as_posix())}"
+    _sign = path.stat().sign
+    return f"{_url}?sign={_sign}" if _sign else _url
+
+
+class ServerCopier:
+    """服务端复制
+
+    :param batch_wait: 第一个文件到达后, 等待同目录的其他文件加入同一个请求的时间(秒)
+    :param poll_interval: 轮询任务状态的间隔(秒)
+    """
+
+    def __init__(self, batch_wait: float = 1, poll_interval: float = 5):
+        self.batch_wait = batch_wait
+        self.poll_interval = poll_interval
+
+        self._clients: dict[str, AlistClient] = {}
+        # {(base_url, src_dir, dst_dir): {name: (Future, 源文件大小)}}
+        self._batches: dict[
+            tuple[str, str, str], dict[str, tuple[asyncio.Future, int]]
+        ] = {}
+
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(
+            target=self.loop.run_forever, name="server_copier", daemon=True
+        )
+        self._thread.start()
+
+    def copy(
+        self, source: AlistPath, target: AlistPath, size: int | None = None
+    ) -> Future:
+        """提交一个复制, 返回的Future在任务成功后得到Task, 没有任务(同步完成)时得到None,
+        失败时得到异常
+
+        :param size: 源文件的大小, None 时获取源文件的信息
+        """
+        if size is None:
+            size = source.stat().size
+        return asyncio.run_coroutine_threadsafe(
+            self._copy(source, target, size), self.loop
+        )
+
+    def fetch(self, source: AlistPath, target: AlistPath) -> Future:
+        """提交一个离线下载, 由target所在的服务器拉取source, 完成后Future得到None"""
+        return asyncio.run_coroutine_threadsafe(
+            self._fetch(source, signed_download_url(source), target),
+            self.loop,
+        )
+
+    def _client(self, path: AlistPath) -> tuple[str, AlistClient]:
+        base_url = sync_config.get_server(path.as_uri()).base_url
+        if base_url not in self._clients:
+            self._clients[base_url] = create_async_client(path.client)
+        return base_url, self._clients[base_url]
+
+    async def _copy(
+        self, source: AlistPath, target: AlistPath, size: int
+    ) -> Task | None:
+        if not sync_config.is_same_server(source, target):
+            raise CopyTaskError(f"源文件与目标不在同一个服务器: {source} -> {target}")
+        if source.name != target.name:
+            raise CopyTaskError(f"服务端复制不能重命名: {source} -> {target}")
+
+        base_url, _ = self._client(source)
+        key = (base_url, source.parent.as_posix(), target.parent.as_posix())
+        if key not in self._batches:
+            self._batches[key] = {}
+            self.loop.call_later(
+                self.batch_wait, lambda: self.loop.create_task(self._submit(key))
+            )
+        _batch = self._batches[key]
+        if source.name not in _batch:
+            _batch[source.name] = (self.loop.create_future(), size)
+        return await asyncio.shield(_batch[source.name][0])
+
+    async def _submit(self, key: tuple[str, str, str]):
+        """提交一个目录的复制请求, 并等待全部的任务结束"""
+        base_url, src_dir, dst_dir = key
+        batch = self._batches.pop(key)
+        client = self._clients[base_url]
+        try:
+            # 之前已经存在的同名任务不属于本次复制
+            _done, _ = await get_copy_tasks(dst_dir, client)
+            known_ids = {t.id for t in _done.values()}
+
+            res = await client.copy(src_dir, dst_dir, list(batch))
+            if res.code != 200:
+                raise CopyTaskError(
+                    f"提交复制任务失败: {src_dir} -> {dst_dir} [{res.code}]{res.message}"
+                )
+            logger.info(f"提交复制任务: {src_dir} -> {dst_dir}, 文件数量: {len(batch)}")
+
+            pending = {f"{src_dir.rstrip('/')}/{n}": v for n, v in batch.items()}
+            submit_time = time.time()
+            while pending:
+                await asyncio.sleep(self.poll_interval)
+                _done, _undone = await get_copy_tasks(dst_dir, client)
+                _missing = []
+                for _src, (_future, _) in list(pending.items()):
+                    if _src in _undone:
+                        logger.debug(
+                            f"复制任务进行中: {_src} {_undone[_src].status} "
+                            f"{_undone[_src].progress}"
+                        )
+                        continue
+                    _task = _done.get(_src)
+                    if _task is None or _task.id in known_ids:
+                        _missing.append(_src)
+                        continue
+
+                    if _task.state == 2 or _task.status == "success":
+                        logger.info(f"复制任务完成: {_src} -> {dst_dir}")
+                        _future.set_result(_task)
+                    else:
+                        _future.set_exception(
+                            CopyTaskError(f"复制任务失败: {_src} {_task.error}")
+                        )
+                    pending.pop(_src)
+                if _missing:
+                    await self._resolve_missing(client, dst_dir, pending, _missing)
+                    if time.time() - submit_time > TASK_MISSING_TIMEOUT:
+                        for _src in _missing:
+                            if (_item := pending.pop(_src, None)) is not None:
+                                _item[0].set_exception(
+                                    CopyTaskError(f"找不到复制任务: {_src}")
+                                )
+        except Exception as _e:
+            logger.warning(f"服务端复制失败: {src_dir} -> {dst_dir}: {type(_e)} - {_e}")
+            for _future, _ in batch.values():
+                if not _future.done():
+                    _future.set_exception(_e)
+
+    async def _resolve_missing(
+        self,
+        client: AlistClient,
+        dst_dir: str,
+        pending: dict[str, tuple[asyncio.Future, int]],
+        missing: list[str],
+    ):
+        """没有任务的文件: 同一个存储中的复制已经同步完成,
+        刷新目标目录, 大小与源文件一致的文件完成"""
+        _sizes = await self._file_sizes(client, dst_dir)
+        for _src in missing:
+            _future, _size = pending[_src]
+            if _sizes.get(_src.rpartition("/")[2]) == _size:
+                logger.info(f"复制完成(没有任务): {_src} -> {dst_dir}")
+                _future.set_result(None)
+                pending.pop(_src)
+
+    async def _fetch(self, source: AlistPath, url: str, target: AlistPath):
+        """目标服务器离线下载url, 轮询任务状态, 任务结束后刷新目标目录,
+        直到目标文件的大小与源文件一致"""
+        tool = sync_config.get_server(target.as_uri()).offline_download_tool
+        if not tool:
+            raise CopyTaskError(f"目标服务器没有配置离线下载工具: {target}")
+        if source.name != target.name:
+            raise CopyTaskError(f"离线下载不能重命名: {source} -> {target}")
+
+        _, client = self._client(target)
+        size = source.stat().size
+        res = await client.verify_request(
+            "POST",
+            "/api/fs/add_offline_download",
+            json={
+                "urls": [url],
+                "path": target.parent.as_posix(),
+                "tool": tool,
+                "delete_policy": "delete_on_upload_succeed",
+            },
+        )
+        if res.code != 200:
+            raise CopyTaskError(f"提交离线下载失败: {target} [{res.code}]{res.message}")
+        logger.info(f"提交离线下载: {source} -> {target}, tool: {tool}")
+
+        last_active = time.time()
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            _done, _undone = await find_tasks("offline_download", url, client)
+            _, _transfer = await find_transfer_tasks(target.as_posix(), client)
+            if _undone or _transfer:
+                last_active = time.time()
+                continue
+            # 任务已经结束, 刷新目标目录, 不使用服务器缓存的列表
+            _sizes = await self._file_sizes(client, target.parent.as_posix())
+            if _sizes.get(target.name) == size:
+                logger.info(f"离线下载完成: {target}")
+                return
+            for _task in _done:
+                if _task.state != 2 and _task.status != "success":
+                    raise CopyTaskError(f"离线下载失败: {target} {_task.error}")
+            if time.time() - last_active > TASK_MISSING_TIMEOUT:
+                raise CopyTaskError(
+                    f"离线下载超时, 目标文件不存在或大小不一致: {target}"
+                )
+
+    @staticmethod
+    async def _file_sizes(client: AlistClient, path: str) -> dict[str, int]:
+        """刷新目录path, 不使用服务器缓存的列表, 返回其中文件的 {名称: 大小}"""
+        _res = await client.list_files(path, refresh=True)
+        if _res.code != 200:
+            return {}
+        return {i.name: i.size for i in _res.data.content or [] if not i.is_dir}
+
+
+_copier: ServerCopier | None = None
+_copier_lock = threading.Lock()
+
+
+def get_server_copier() -> ServerCopier:
+    """全局唯一的ServerCopier"""
+    global _copier
+    with _copier_lock:
+        if _copier is None:
+            _copier = ServerCopier()
+        return _copier
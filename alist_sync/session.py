@@ -0,0 +1,129 @@
+# coding: utf8
+"""会话管理
+
+每个AlistServer一个共享的、已经登陆的客户端, 连接池的大小由 max_connect 决定,
+扫描器、检查器与Worker使用同一个客户端, 保持长连接, 不再重复登陆。
+
+登陆得到的token保存在缓存目录中, 下一次运行时验证token有效后直接使用。
+"""
+import json
+import logging
+import threading
+
+import httpx
+from alist_sdk import Client, login_server
+
+from alist_sync.common import record_retry_after
+from alist_sync.config import create_config, AlistServer
+from alist_sync.version import __version__
+
+logger = logging.getLogger("alist-sync.session")
+sync_config = create_config()
+
+__all__ = ["SessionManager", "get_session"]
+
+
+def http2_available() -> bool:
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+class SessionManager:
+    """会话管理器"""
+
+    def __init__(self):
+        self.token_file = sync_config.cache_dir.joinpath("alist_tokens.json")
+        self._clients: dict[str, Client] = {}
+        self._lock = threading.Lock()
+        self._tokens: dict[str, dict[str, str]] = self._load_tokens()
+
+    def _load_tokens(self) -> dict[str, dict[str, str]]:
+        try:
+            return json.loads(self.token_file.read_text())
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def _save_token(self, server: AlistServer, token: str):
+        self._tokens[server.base_url] = {"username": server.username, "token": token}
+        self.token_file.write_text(json.dumps(self._tokens, indent=2))
+        self.token_file.chmod(0o600)
+
+    def saved_token(self, server: AlistServer) -> str | None:
+        """配置中的token, 或者之前保存的同一个用户的token"""
+        if server.token:
+            return server.token
+        _saved = self._tokens.get(server.base_url, {})
+        if _saved.get("username") == server.username:
+            return _saved.get("token")
+        return None
+
+    @staticmethod
+    def use_http2(server: AlistServer) -> bool:
+        if server.http2 and not http2_available():
+            logger.warning(f"没有安装h2, {server.base_url} 不使用HTTP/2.")
+            return False
+        return server.http2
+
+    def client_kwargs(self, server: AlistServer) -> dict:
+        """创建同步与异步客户端共同使用的参数"""
+        return dict(
+            max_connect=server.max_connect,
+            verify=server.verify,
+            headers=server.headers,
+            http2=self.use_http2(server),
+            limits=httpx.Limits(
+                max_connections=server.max_connect,
+                max_keepalive_connections=server.max_connect,
+            ),
+        )
+
+    def client(self, server: AlistServer) -> Client:
+        """已经登陆的同步客户端, 同时注册到alist_sdk, AlistPath使用同一个客户端"""
+        with self._lock:
+            if server.base_url in self._clients:
+                return self._clients[server.base_url]
+
+            _client = Client(
+                server.base_url,
+                **self.client_kwargs(server),
+                event_hooks={"response": [record_retry_after]},
+            )
+            _token = self.saved_token(server)
+            if not (_token and _client.set_token(_token)):
+                if not _client.login(server.username, server.password, server.has_opt):
+                    raise PermissionError(f"登陆失败: {server.base_url}")
+                self._save_token(server, _client.get_token())
+
+            login_server(_client)
+            self._clients[server.base_url] = _client
+            logger.info(f"Login: {server.base_url}[{server.username}] Success.")
+            return _client
+
+    def headers(self, server: AlistServer) -> httpx.Headers:
+        """已经登陆的请求头, 包含token"""
+        return self.client(server).headers
+
+    def download_client(self) -> httpx.Client:
+        """下载使用的客户端, 下载链接可能在任意的主机上"""
+        _max = max(sum(s.max_connect for s in sync_config.alist_servers), 10)
+        return httpx.Client(
+            headers={"User-Agent": sync_config.ua or f"alist-sync/{__version__}"},
+            http2=any(self.use_http2(s) for s in sync_config.alist_servers),
+            limits=httpx.Limits(max_connections=_max, max_keepalive_connections=_max),
+        )
+
+
+_session: SessionManager | None = None
+_session_lock = threading.Lock()
+
+
+def get_session() -> SessionManager:
+    """全局唯一的SessionManager"""
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = SessionManager()
+        return _session
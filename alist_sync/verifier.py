@@ -0,0 +1,189 @@
+# coding: utf8
+"""传输完成后的批量检查
+
+完成的Worker按目标目录收集, 每个窗口中每个目录只刷新列出一次,
+然后使用同一次列目录的结果确认该目录下全部等待中的文件。
+列目录的结果写入共享的缓存, 但只使用在上传完成之后开始的请求的结果。
+没有通过的文件在之后的窗口中再次检查, 超过重试次数后失败。
+
+每个服务器一个线程池检查目录, 大小为检查阶段的并发上限, 列目录受检查阶段的自适应并发限制,
+限流的服务器不会阻塞其他服务器的检查。
+"""
+import logging
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable
+
+from alist_sdk import AlistPath, Item
+
+from alist_sync.common import busy_error, is_not_found
+from alist_sync.concurrency import get_concurrency
+from alist_sync.config import create_config
+from alist_sync.err import RecheckError
+from alist_sync.listing_cache import get_listing_cache
+from alist_sync.qps import get_qps
+
+logger = logging.getLogger("alist-sync.verifier")
+sync_config = create_config()
+
+__all__ = ["Verifier", "get_verifier"]
+
+ExpectType = Callable[[Item | None], bool]
+
+
+class _Pending:
+    __slots__ = ("name", "expect", "future", "retry", "since")
+
+    def __init__(self, name: str, expect: ExpectType, future: Future, retry: int):
+        self.name = name
+        self.expect = expect
+        self.future = future
+        self.retry = retry
+        # 只接受在此之后开始的列目录请求的结果
+        self.since = time.monotonic()
+
+
+class Verifier:
+    """批量检查
+
+    :param window: 收集同一个目录的检查请求的时间(秒), 也是重试的间隔
+    :param retry: 检查没有通过时的重试次数, 用于等待存储的最终一致
+    """
+
+    def __init__(self, window: float = 2, retry: int = 5):
+        self.window = window
+        self.retry = retry
+
+        self.listed_dirs = 0
+        self.verified = 0
+
+        # {目录uri: (目录, [_Pending])}
+        self._pending: dict[str, tuple[AlistPath, list[_Pending]]] = {}
+        self._cond = threading.Condition()
+        # {服务器的base_url: 检查目录的线程池}
+        self._pools: dict[str, ThreadPoolExecutor] = {}
+        self._thread = threading.Thread(target=self._run, name="verifier", daemon=True)
+        self._thread.start()
+
+    def verify(self, path: AlistPath, expect: ExpectType) -> Future:
+        """检查path, expect接收列目录得到的Item(不存在时为None)
+
+        :return: Future, expect返回True时得到True, 重试全部失败后得到False
+        """
+        future = Future()
+        self._add(path.parent, _Pending(path.name, expect, future, self.retry))
+        return future
+
+    def _add(self, parent: AlistPath, *pending: _Pending):
+        with self._cond:
+            self._pending.setdefault(parent.as_uri(), (parent, []))[1].extend(pending)
+            self._cond.notify_all()
+
+    def _list_dir(self, path: AlistPath) -> list[Item]:
+        # 控制QPS, 同时限制并发; 429/5xx 在并发位置中抛出, 计入自适应并发
+        get_qps().acquire(path)
+        with get_concurrency().limiter(path.as_uri(), "check").slot():
+            with self._cond:
+                self.listed_dirs += 1
+            _res = path.client.list_files(path.as_posix(), refresh=True)
+            if (_e := busy_error(_res, path.as_uri())) is not None:
+                raise _e
+        if _res.code == 200:
+            return _res.data.content or []
+        if is_not_found(_res):
+            return []
+        raise RecheckError(f"{path} [{_res.code}]{_res.message}")
+
+    def list_dir(self, path: AlistPath, since: float | None = None) -> dict[str, Item]:
+        """刷新列出目录, 目录不存在时返回空字典
+
+        :param since: 只使用在此之后开始的请求的结果, 时间为 time.monotonic()
+        """
+        return {
+            i.name: i
+            for i in get_listing_cache().get(path, lambda: self._list_dir(path), since)
+        }
+
+    def check_dir(self, parent: AlistPath, pending: list[_Pending]):
+        """使用一次列目录的结果检查parent中全部等待中的文件"""
+        try:
+            items = self.list_dir(parent, since=max(p.since for p in pending))
+        except Exception as _e:
+            logger.warning(f"Verifier: 列出目录失败: {parent}: {type(_e)} - {_e}")
+            items = None
+
+        _retry = []
+        for _p in pending:
+            try:
+                passed = items is not None and _p.expect(items.get(_p.name))
+            except Exception as _e:
+                # expect出错时只影响这一个文件, 不能让检查线程退出
+                logger.error(f"Verifier: 检查出错: {parent.joinpath(_p.name)}: {_e}")
+                _p.future.set_exception(_e)
+                continue
+            if passed:
+                with self._cond:
+                    self.verified += 1
+                _p.future.set_result(True)
+            elif _p.retry > 0:
+                _p.retry -= 1
+                _p.since = time.monotonic()
+                _retry.append(_p)
+            else:
+                logger.error(f"Verifier: 检查失败: {parent.joinpath(_p.name)}")
+                _p.future.set_result(False)
+        if _retry:
+            self._add(parent, *_retry)
+
+    def _pool(self, parent: AlistPath) -> ThreadPoolExecutor:
+        """parent所在服务器的线程池"""
+        base_url = sync_config.get_server(parent.as_uri()).base_url
+        if base_url not in self._pools:
+            self._pools[base_url] = ThreadPoolExecutor(
+                get_concurrency().limiter(base_url, "check").max_limit,
+                f"verifier_{len(self._pools)}",
+            )
+        return self._pools[base_url]
+
+    def _check(self, parent: AlistPath, pending: list[_Pending]):
+        try:
+            self.check_dir(parent, pending)
+        except Exception as _e:
+            logger.error(f"Verifier: 检查目录出错: {parent}", exc_info=_e)
+            for _p in pending:
+                if not _p.future.done():
+                    _p.future.set_exception(_e)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._pending)
+            # 等待一个窗口, 收集同一个目录的其他检查请求
+            time.sleep(self.window)
+            with self._cond:
+                batch, self._pending = self._pending, {}
+
+            logger.debug(
+                f"Verifier: 检查目录: {len(batch)}, "
+                f"文件: {sum(len(p) for _, p in batch.values())}"
+            )
+            for parent, pending in batch.values():
+                try:
+                    self._pool(parent).submit(self._check, parent, pending)
+                except Exception as _e:
+                    logger.error(f"Verifier: 提交检查出错: {parent}", exc_info=_e)
+                    for _p in pending:
+                        _p.future.set_exception(_e)
+
+_verifier: Verifier | None = None
+_verifier_lock = threading.Lock()
+
+
+def get_verifier() -> Verifier:
+    """全局唯一的Verifier"""
+    global _verifier
+    with _verifier_lock:
+        if _verifier is None:
+            _verifier = Verifier()
+        return _verifier
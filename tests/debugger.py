@@ -145,7 +145,7 @@ for i in items_2:
 
 
 if __name__ == "__main__":
-    from alist_sync.scanner import scan_dirs, Scanner
+    from alist_sync.scanner import scan_dirs
 
     client = AlistClient(
         base_url="http://localhost:5244",
@@ -154,7 +154,5 @@ if __name__ == "__main__":
         password="123456",
     )
 
-    d: Scanner = asyncio.run(scan_dirs("/local", "/local_dst", client=client))
-    rich.print(
-        d.items,
-    )
+    d = asyncio.run(scan_dirs("/local", "/local_dst", client=client))
+    rich.print(d)
@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@File Name  : test_bandwidth.py
+"""
+import datetime
+
+from alist_sync.bandwidth import TokenBucket, BandwidthLimiter
+from alist_sync.config import BandwidthProfile, active_rate
+
+
+def test_bandwidth_profile():
+    night = BandwidthProfile(start="22:00", end="07:00", limit="10Mbit")
+    assert night.limit == 1_250_000
+    assert night.contains(datetime.time(23, 0)) and night.contains(datetime.time(6, 59))
+    assert not night.contains(datetime.time(12, 0))
+
+
+def test_active_rate():
+    """在时间段内时使用时间段的限制, 否则使用默认的限制"""
+    now = datetime.datetime.now().time()
+    _start = (datetime.datetime.now() - datetime.timedelta(hours=1)).time()
+    _end = (datetime.datetime.now() + datetime.timedelta(hours=1)).time()
+    active = BandwidthProfile(
+        start=_start.strftime("%H:%M"), end=_end.strftime("%H:%M"), limit="1MB/s"
+    )
+    assert active.contains(now)
+    assert active_rate(100, [active]) == 1_000_000
+    assert active_rate(100, []) == 100 and active_rate(None, []) is None
+
+
+def test_token_bucket():
+    """令牌不足时记为欠款, 等待的时间按欠款计算; 不限速时不等待"""
+    rates = [1000]
+    bucket = TokenBucket("test", lambda: rates[0])
+    assert 0.9 < bucket.reserve(1000) <= 1
+    assert 1.4 < bucket.reserve(500) <= 1.5
+
+    rates[0] = None
+    bucket._next_refresh = 0
+    assert bucket.reserve(1000) == 0
+
+
+def test_no_limit():
+    assert BandwidthLimiter().throttle("http://localhost:5244/") is None
@@ -3,6 +3,8 @@ import fnmatch
 
 import pytest
 
+from alist_sync.matcher import PathMatcher
+
 
 @pytest.mark.parametrize(
     "path, match, result",
@@ -26,3 +28,41 @@ import pytest
 )
 def test_check(path, match, result):
     assert fnmatch.fnmatchcase(path, match) == result
+    assert PathMatcher([match]).is_ignore(path) == result
+
+
+@pytest.mark.parametrize(
+    "path, is_dir, result",
+    [
+        ["a/b.bfstm", False, True],
+        ["a/b.txt", False, False],
+        ["base", True, True],
+        ["base/a/b.txt", False, True],
+        ["basement", True, False],
+        ["testa/b", True, True],
+        ["testa", True, False],
+        [".alist-sync-data", True, True],
+        ["", True, False],
+    ],
+)
+def test_matcher_blacklist(path, is_dir, result):
+    matcher = PathMatcher(["*.bfstm", "base/*", "testa/b/*", ".alist-sync*"])
+    assert matcher.is_ignore(path, is_dir) == result
+
+
+@pytest.mark.parametrize(
+    "path, is_dir, result",
+    [
+        ["photos", True, False],
+        ["photos/2024", True, False],
+        ["photos/2024/a.jpg", False, False],
+        ["photos/2024/a.tmp", False, True],
+        ["music", True, True],
+        ["docs", True, False],
+        ["docs/a/b.pdf", False, False],
+        ["docs/a/b.doc", False, True],
+    ],
+)
+def test_matcher_whitelist(path, is_dir, result):
+    matcher = PathMatcher(["*.tmp"], ["photos/*", "docs/*.pdf"])
+    assert matcher.is_ignore(path, is_dir) == result
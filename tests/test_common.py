@@ -29,10 +29,65 @@ def test_asyncio_all_task_name():
         pytest.param({"name": Task(status="success")}, True, "dict-success"),
         pytest.param([], True, "list-[]"),
         pytest.param(
-            [Task(status="success"), Task(status="running")], False, "list-running",
+            [Task(status="success"), Task(status="running")],
+            False,
+            "list-running",
         ),
         pytest.param([Task()], False, "list-[init]"),
     ],
 )
 def test_is_task_all_success(tasks, status, desc):
     assert common.is_task_all_success(tasks) == status, desc
+
+
+@pytest.mark.parametrize(
+    "left, right, result",
+    [
+        pytest.param(
+            ["a", "b", "d"],
+            ["b", "c", "d", "e"],
+            [("a", None), ("b", "b"), (None, "c"), ("d", "d"), (None, "e")],
+            id="mixed",
+        ),
+        pytest.param(["b", "a"], [], [("a", None), ("b", None)], id="right-empty"),
+        pytest.param([], ["a"], [(None, "a")], id="left-empty"),
+    ],
+)
+def test_merge_join(left, right, result):
+    assert list(common.merge_join(left, right, key=lambda x: x)) == result
+
+
+@pytest.mark.parametrize(
+    "value, result",
+    [("3", 3), ("-1", 0), ("", None), (None, None), ("abc", None)],
+)
+def test_parse_retry_after(value, result):
+    assert common.parse_retry_after(value) == result
+
+
+@pytest.mark.parametrize(
+    "value, result",
+    [
+        ("20Mbit", 2_500_000),
+        ("2.5MB/s", 2_500_000),
+        ("512KiB/s", 512 * 1024),
+        (1000, 1000),
+        (0, None),
+        (None, None),
+    ],
+)
+def test_parse_rate(value, result):
+    assert common.parse_rate(value) == result
+
+
+@pytest.mark.parametrize(
+    "path, result",
+    [
+        ("/baidu", "/baidu"),
+        ("/baidu/a/b", "/baidu/a"),
+        ("/baidu2/a", None),
+        ("/local/a", None),
+    ],
+)
+def test_longest_prefix(path, result):
+    assert common.longest_prefix(path, ["/baidu", "/baidu/a"]) == result
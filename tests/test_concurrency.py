@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@File Name  : test_concurrency.py
+"""
+import pytest
+from httpx import TimeoutException
+
+from alist_sync.concurrency import AIMDLimiter, ConcurrencyManager
+from alist_sync.err import ServerBusyError
+
+
+def test_aimd_limiter():
+    limiter = AIMDLimiter("test", 1, 4, initial=2)
+    for _ in range(10):
+        limiter.record(0.1)
+    assert limiter.current == 4
+
+    limiter.record(error=TimeoutException("timeout"))
+    assert limiter.current == 2
+    # 一个窗口内最多减少一次
+    limiter.record(error=TimeoutException("timeout"))
+    assert limiter.current == 2
+
+    assert limiter.try_acquire() and limiter.try_acquire()
+    assert not limiter.try_acquire()
+    limiter.release()
+    assert limiter.try_acquire()
+
+
+def test_concurrency_manager():
+    """每个服务器每个阶段一个限制器, 服务器过载时全部阶段都减少并发"""
+    manager = ConcurrencyManager()
+    check = manager.limiter("http://localhost:5244/local/a", "check")
+    worker = manager.limiter("http://localhost:5244/", "worker")
+    assert manager.limiter("http://localhost:5244/local/b", "check") is check
+    assert check is not worker
+
+    _before = check.current, worker.current
+    manager.overloaded("http://localhost:5244/x", ServerBusyError("429"))
+    assert check.overloads == worker.overloads == 1
+    assert (check.current, worker.current) <= _before
+
+    # slot 记录其中的错误
+    with pytest.raises(TimeoutException):
+        with worker.slot():
+            raise TimeoutException("timeout")
+    assert worker.overloads == 2 and worker.inflight == 0
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@File Name  : test_data_handle.py
+"""
+from alist_sdk import AlistPath
+
+from alist_sync.data_handle import MongoHandle, SQLiteHandle
+
+
+def create_worker(name: str):
+    from alist_sync.d_worker import Worker
+
+    return Worker(
+        type="copy",
+        need_backup=False,
+        file_size=1,
+        file_modified="2024-01-01T00:00:00",
+        source_path=AlistPath(f"http://localhost:5244/local/{name}"),
+        target_path=AlistPath(f"http://localhost:5244/dst/{name}"),
+        extra_targets=[AlistPath(f"http://localhost:5244/dst2/{name}")],
+    )
+
+
+def test_sqlite_worker(tmp_path):
+    handle = SQLiteHandle(tmp_path)
+    worker = create_worker("a.txt")
+    handle.update_worker(worker)
+    worker.status = "downloaded"
+    handle.update_worker(worker, "status")
+
+    assert handle.get_worker(worker.id)["status"] == "downloaded"
+    assert [w["id"] for w in handle.get_workers({"status": "downloaded"})] == [
+        worker.id
+    ]
+    assert handle.path_in_workers(AlistPath("http://localhost:5244/dst2/a.txt"))
+    assert len(handle.load_locker()) == 3
+
+    handle.delete_worker(worker.id)
+    assert handle.get_worker(worker.id) is None
+    assert not handle.path_in_workers(worker.source_path)
+
+
+def test_sqlite_file_item(tmp_path):
+    handle = SQLiteHandle(tmp_path)
+    path = AlistPath("http://localhost:5244/local/dir")
+    handle.update_file_item(path, {"name": "dir"})
+    assert handle.get_file_item(path) == {"name": "dir"}
+    assert handle.get_file_items([path, path.joinpath("none")]) == {
+        path.as_uri(): {"name": "dir"}
+    }
+
+
+def test_write_behind(tmp_path):
+    from alist_sync.data_handle import WriteBehindHandle
+
+    handle = SQLiteHandle(tmp_path)
+    batches = []
+    _write_batch = handle.write_batch
+    handle.write_batch = lambda *args: batches.append(args) or _write_batch(*args)
+    write_behind = WriteBehindHandle(handle, interval=60)
+
+    worker = create_worker("b.txt")
+    write_behind.update_worker(worker)
+    worker.status = "downloaded"
+    write_behind.update_worker(worker, "status")
+    assert batches == [] and handle.get_worker(worker.id) is None
+    # 读取之前写入, 两次更新合并为一次
+    assert write_behind.get_worker(worker.id)["status"] == "downloaded"
+    assert len(batches) == 1 and len(batches[0][0]) == 1
+
+    # 结束时立即写入
+    write_behind.create_log(worker)
+    write_behind.delete_worker(worker.id)
+    assert len(batches) == 2
+    assert handle.get_worker(worker.id) is None
+
+
+def test_write_behind_file_items(tmp_path):
+    from alist_sync.data_handle import WriteBehindHandle
+
+    handle = SQLiteHandle(tmp_path)
+    writes = []
+    _update_file_items = handle.update_file_items
+    handle.update_file_items = lambda items: writes.append(items) or _update_file_items(
+        items
+    )
+    write_behind = WriteBehindHandle(handle, interval=60)
+
+    paths = [AlistPath(f"http://localhost:5244/local/d{i}") for i in range(3)]
+    for i, path in enumerate(paths):
+        write_behind.update_file_item(path, {"n": i})
+    # 缓冲中的FileItem可以读取, 还没有写入
+    assert writes == [] and write_behind.get_file_item(paths[1]) == {"n": 1}
+    assert len(write_behind.get_file_items(paths)) == 3
+
+    write_behind.flush()
+    assert len(writes) == 1 and len(writes[0]) == 3
+    assert handle.get_file_items(paths)[paths[2].as_uri()] == {"n": 2}
+
+
+class FakeCollection:
+    """记录调用的集合"""
+
+    def __init__(self, name):
+        self.name = name
+        self.calls = []
+
+    def __getattr__(self, method):
+        return lambda *args, **kwargs: self.calls.append((method, args, kwargs))
+
+
+class FakeDatabase:
+    def __init__(self):
+        self.workers = FakeCollection("workers")
+        self.items = FakeCollection("items")
+        self.logs = FakeCollection("logs")
+
+
+def test_mongo_indexes_and_bulk():
+    db = FakeDatabase()
+    handle = MongoHandle(db, log_ttl=3600)
+    assert [c[1][0] for c in db.workers.calls] == [
+        "source_path",
+        "target_path",
+        "extra_targets",
+        [("owner", 1), ("status", 1)],
+    ]
+    assert (
+        "create_index",
+        ("done_at",),
+        {"name": "done_at_ttl", "expireAfterSeconds": 3600},
+    ) in db.logs.calls
+
+    db.workers.calls.clear()
+    db.logs.calls.clear()
+    worker = create_worker("a.txt")
+    handle.write_batch([(worker, ()), (worker, ("status",))], ["x"], [worker])
+    ((method, (ops,), kwargs),) = db.workers.calls
+    assert method == "bulk_write" and kwargs == {"ordered": False} and len(ops) == 3
+    ((method, (docs,), kwargs),) = db.logs.calls
+    assert method == "insert_many" and kwargs == {"ordered": False}
+    assert docs[0]["done_at"] is not None and not isinstance(docs[0]["done_at"], str)
+
+    # 目录快照批量写入
+    handle.update_file_items(
+        {AlistPath(f"http://localhost:5244/local/d{i}"): worker for i in range(2)}
+    )
+    ((method, (ops,), kwargs),) = db.items.calls
+    assert method == "bulk_write" and kwargs == {"ordered": False} and len(ops) == 2
+
+
+def test_stable_worker_id(tmp_path):
+    worker = create_worker("a.txt")
+    same = create_worker("a.txt")
+    assert worker.id == same.id
+    assert worker.id != create_worker("b.txt").id
+
+    handle = SQLiteHandle(tmp_path)
+    handle.update_worker(worker)
+    (doc,) = handle.get_workers({"owner": worker.owner})
+    assert type(worker).model_validate(doc).id == worker.id
+    assert list(handle.get_workers({"owner": "other"})) == []
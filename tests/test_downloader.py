@@ -0,0 +1,70 @@
+import threading
+
+import pytest
+
+from alist_sync.downloader import ChunkPipe, PipeAborted, split_ranges, MemoryBudget
+
+
+def test_chunk_pipe():
+    pipe = ChunkPipe(max_chunks=2)
+    chunks = [bytes([i]) * 10 for i in range(20)]
+
+    def _producer():
+        for chunk in chunks:
+            pipe.put(chunk)
+            assert len(pipe._chunks) <= 2
+        pipe.close()
+
+    threading.Thread(target=_producer).start()
+    assert list(pipe) == chunks
+
+
+def test_chunk_pipe_error():
+    pipe = ChunkPipe()
+    pipe.put(b"a")
+    pipe.close(ValueError("download error"))
+    with pytest.raises(ValueError):
+        list(pipe)
+
+
+def test_chunk_pipe_abort():
+    pipe = ChunkPipe(max_chunks=1)
+    pipe.put(b"a")
+    threading.Timer(0.1, pipe.abort, args=(ValueError("upload error"),)).start()
+    with pytest.raises(PipeAborted):
+        pipe.put(b"b")
+
+
+@pytest.mark.parametrize(
+    "size, count, ranges",
+    [
+        (10, 3, [(0, 4), (4, 7), (7, 10)]),
+        (9, 3, [(0, 3), (3, 6), (6, 9)]),
+        (2, 4, [(0, 1), (1, 2)]),
+        (5, 1, [(0, 5)]),
+    ],
+)
+def test_split_ranges(size, count, ranges):
+    assert split_ranges(size, count) == ranges
+
+
+def test_memory_budget():
+    budget = MemoryBudget(10)
+    entered = threading.Event()
+
+    def _reserve():
+        with budget.reserve(6):
+            entered.set()
+
+    with budget.reserve(6):
+        _t = threading.Thread(target=_reserve)
+        _t.start()
+        assert not entered.wait(0.1)
+    _t.join(1)
+    assert entered.is_set() and budget.used == 0
+
+    # 不能超过全部的预算
+    with pytest.raises(ValueError):
+        with budget.reserve(100):
+            pass
+    assert budget.used == 0
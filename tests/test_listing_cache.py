@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@File Name  : test_listing_cache.py
+"""
+import asyncio
+import threading
+import time
+
+import pytest
+from alist_sdk import AlistPath, Item
+
+from alist_sync.listing_cache import ListingCache
+
+
+def test_listing_cache():
+    calls = []
+    started = threading.Event()
+
+    def fetch(items, wait=0.0):
+        def _fetch():
+            calls.append(1)
+            started.set()
+            time.sleep(wait)
+            return items
+
+        return _fetch
+
+    def item(name):
+        return Item.model_construct(name=name, size=1, is_dir=False)
+
+    path_a = AlistPath("http://localhost:5244/local/a")
+    path_b = AlistPath("http://localhost:5244/local/b")
+    cache = ListingCache(ttl=60, budget=ListingCache.size_of([item("x")]) * 2)
+
+    # 同时的请求合并为一次
+    _t = threading.Thread(target=cache.get, args=(path_a, fetch([item("x")], 0.2)))
+    _t.start()
+    started.wait()
+    assert cache.get(path_a, fetch([])) == [item("x")]
+    _t.join()
+    assert len(calls) == 1 and cache.coalesced == 1
+
+    assert cache.get(path_a, fetch([])) == [item("x")] and cache.hits == 1
+    # since 之前开始的请求的结果不再使用
+    assert cache.get(path_a, fetch([]), since=time.monotonic()) == []
+
+    # 超过预算时淘汰最久没有使用的目录
+    cache.get(path_a, fetch([item("x")]), since=time.monotonic())
+    cache.get(path_b, fetch([item("y"), item("z")]))
+    assert cache.stats()["entries"] == 1 and cache.evictions == 1
+
+    cache.invalidate(path_b)
+    cache.ttl = 0
+    assert cache.get(path_b, fetch([])) == [] and cache.stats()["entries"] == 0
+
+
+def test_listing_cache_slow_stale_request():
+    """since之前开始的慢请求在新请求进行中结束时, 结果按其自己的开始时间保存"""
+    path = AlistPath("http://localhost:5244/local/a")
+    cache = ListingCache(ttl=60)
+    slow_started, fresh_started, release = (threading.Event() for _ in range(3))
+
+    def slow():
+        slow_started.set()
+        release.wait()
+        return [Item.model_construct(name="stale")]
+
+    def fresh():
+        fresh_started.set()
+        time.sleep(0.2)
+        return [Item.model_construct(name="fresh")]
+
+    _slow = threading.Thread(target=cache.get, args=(path, slow))
+    _slow.start()
+    slow_started.wait()
+    since = time.monotonic()
+    result = []
+    _fresh = threading.Thread(
+        target=lambda: result.extend(cache.get(path, fresh, since=since))
+    )
+    _fresh.start()
+    fresh_started.wait()
+    release.set()
+    _slow.join()
+    assert [i.name for i in cache.get(path, fresh, since=since)] == ["fresh"]
+    _fresh.join()
+    assert [i.name for i in result] == ["fresh"]
+
+
+def test_listing_cache_async():
+    """协程中的请求与线程共享缓存, 同时的请求合并为一次, 失败的结果不保存"""
+    path = AlistPath("http://localhost:5244/local/a")
+    cache = ListingCache(ttl=60)
+    calls = []
+
+    async def fetch():
+        calls.append(1)
+        await asyncio.sleep(0.1)
+        return [Item.model_construct(name="x")]
+
+    async def failing():
+        raise RuntimeError("list error")
+
+    async def _run():
+        with pytest.raises(RuntimeError):
+            await cache.get_async(path, failing)
+        return await asyncio.gather(
+            cache.get_async(path, fetch), cache.get_async(path, fetch)
+        )
+
+    first, second = asyncio.run(_run())
+    assert first == second and len(calls) == 1 and cache.coalesced == 1
+    assert [i.name for i in cache.get(path, lambda: [])] == ["x"]
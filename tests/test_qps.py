@@ -0,0 +1,32 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@File Name  : test_qps.py
+"""
+from alist_sdk import AlistPath
+
+from alist_sync import qps
+from alist_sync.qps import QPSLimiter
+
+BASE = "http://localhost:5244"
+
+
+def test_mount_qps(monkeypatch):
+    """每个服务器一个桶, 挂载点使用最长匹配前缀的桶, 没有限制的挂载点不等待"""
+    server = qps.sync_config.get_server(BASE)
+    monkeypatch.setattr(server, "max_qps", None)
+    monkeypatch.setattr(server, "mount_max_qps", {"/baidu": 1, "/baidu/a": 0})
+    limiter = QPSLimiter()
+
+    assert limiter.buckets(AlistPath(BASE + "/local/d")) == []
+    assert limiter.buckets(AlistPath(BASE + "/baidu/a/d")) == []
+    _baidu = limiter.buckets(AlistPath(BASE + "/baidu/d"))
+    assert len(_baidu) == 1 and _baidu == limiter.buckets(AlistPath(BASE + "/baidu"))
+
+    # 1 QPS: 桶中没有积累的令牌, 请求等待约1秒, 不影响其他挂载点
+    assert limiter.reserve(AlistPath(BASE + "/baidu/d")) > 0.9
+    assert limiter.reserve(AlistPath(BASE + "/local/d")) == 0
+    assert limiter.waited > 0.9
+
+    monkeypatch.setattr(server, "max_qps", 10)
+    assert len(limiter.buckets(AlistPath(BASE + "/baidu/d"))) == 2
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@File Name  : test_retry.py
+"""
+import httpx
+import pytest
+
+from alist_sync.err import ServerBusyError, RetryError
+from alist_sync.retry import CircuitBreaker, RetryPolicy
+
+
+def test_circuit_breaker():
+    changes = []
+    breaker = CircuitBreaker(
+        "http://a", 2, 0, on_change=lambda b: changes.append(b.state)
+    )
+    breaker.record_failure(TimeoutError())
+    assert breaker.allow()
+    breaker.record_failure(TimeoutError(), retry_after=60)
+    assert breaker.state == "open" and not breaker.allow()
+
+    breaker.open_until = 0
+    assert breaker.available()
+    assert breaker.allow() and breaker.state == "half-open"
+    # 半开状态只放行一个探测
+    assert not breaker.allow() and not breaker.available()
+    breaker.release_probe()
+    assert breaker.allow()
+    breaker.record_success()
+    assert changes == ["open", "half-open", "closed"]
+
+
+def test_retry_policy_breaker_errors():
+    server = "http://localhost:5244/"
+    policy = RetryPolicy(retry=0, threshold=2)
+    # 单个文件的错误不计入熔断器
+    for _ in range(5):
+        policy.record_failure(server, AssertionError("404"))
+    assert policy.breaker(server).state == "closed"
+    policy.record_failure(server, httpx.ConnectError("refused"))
+    policy.record_failure(server, ServerBusyError("503", status_code=503))
+    assert policy.breaker(server).state == "open"
+
+
+def test_retry_policy_call():
+    """失败时重试, 成功后清除连续失败的次数, 全部失败时抛出RetryError"""
+    server = "http://localhost:5244/"
+    policy = RetryPolicy(retry=2, base_delay=0, threshold=5)
+    errors = [httpx.ConnectError("refused")] * 2
+
+    def func():
+        if errors:
+            raise errors.pop()
+        return "ok"
+
+    assert policy.call(server, func) == "ok"
+    _breaker = policy.breaker(server)
+    assert _breaker.failures == 0 and _breaker.total_failures == 2
+
+    errors.extend([AssertionError("404")] * 3)
+    with pytest.raises(RetryError):
+        policy.call(server, func)
+    # 单个文件的错误不计入熔断器
+    assert _breaker.total_failures == 2 and not errors
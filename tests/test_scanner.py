@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@File Name  : test_scanner.py
+"""
+import asyncio
+import datetime
+import json
+import time
+from queue import Queue
+from types import SimpleNamespace
+
+import httpx
+import pytest
+from alist_sdk import AlistPath, Item
+
+from alist_sync.alist_client import AlistClient
+from alist_sync.concurrency import AIMDLimiter
+from alist_sync.config import SyncGroup
+from alist_sync.d_checker import CheckerCopy, sync_config
+from alist_sync.scanner import Scanner, ScanDir, DirSnapshot
+
+BASE = "http://localhost:5244"
+
+
+def fake_item(name: str, is_dir=False, size=1, modified="2024-01-01T00:00:00Z"):
+    return {
+        "name": name,
+        "size": size,
+        "is_dir": is_dir,
+        "modified": modified,
+        "sign": "",
+        "thumb": "",
+        "type": 1 if is_dir else 0,
+    }
+
+
+def fake_alist(tree: dict[str, list[dict]], calls: list):
+    """按tree返回列目录结果的MockTransport, tree为 {目录: [项目]}, 其他目录返回500"""
+
+    def handler(request: httpx.Request):
+        path = json.loads(request.content)["path"]
+        calls.append(path)
+        if path not in tree:
+            return httpx.Response(
+                200, json={"code": 500, "message": "object not found", "data": None}
+            )
+        data = {
+            "content": tree[path],
+            "total": len(tree[path]),
+            "readme": "",
+            "write": True,
+            "provider": "Local",
+        }
+        return httpx.Response(
+            200, json={"code": 200, "message": "success", "data": data}
+        )
+
+    return httpx.MockTransport(handler)
+
+
+class FakeSnapshotHandle:
+    """只保存目录快照的HandleBase"""
+
+    def __init__(self):
+        self.items = {}
+
+    def get_file_items(self, paths):
+        return {
+            p.as_uri(): self.items[p.as_uri()]
+            for p in paths
+            if p.as_uri() in self.items
+        }
+
+    def update_file_item(self, path, item, *field):
+        self.items[path.as_uri()] = item.model_dump(mode="json")
+
+
+@pytest.fixture()
+def checker(monkeypatch):
+    """/local 复制到 /remote 的Checker, 列目录使用 tree, 记录在 calls 中"""
+    handle = FakeSnapshotHandle()
+    monkeypatch.setitem(sync_config.__dict__, "handle", handle)
+    group = SyncGroup(
+        name="test", type="copy", group=[f"{BASE}/local", f"{BASE}/remote"]
+    )
+    _checker = CheckerCopy(group, Queue(), Queue())
+    _checker.tree, _checker.calls, _checker.handle = {}, [], handle
+
+    def list_dir(path: AlistPath, since=None):
+        _checker.calls.append(path.as_posix())
+        return [Item.model_validate(i) for i in _checker.tree.get(path.as_posix(), [])]
+
+    monkeypatch.setattr(_checker, "list_dir", list_dir)
+    yield _checker
+    _checker.pool.shutdown()
+
+
+def test_scanner_busy_backoff():
+    """429在并发位置中计入自适应并发, 遵守Retry-After后重试"""
+    calls = []
+
+    def handler(request: httpx.Request):
+        calls.append(json.loads(request.content)["path"])
+        if len(calls) == 1:
+            return httpx.Response(429, headers={"Retry-After": "0.3"}, text="busy")
+        return httpx.Response(
+            200,
+            json={
+                "code": 200,
+                "message": "success",
+                "data": {"content": [], "total": 0, "readme": "", "write": True},
+            },
+        )
+
+    client = AlistClient(BASE, transport=httpx.MockTransport(handler))
+    limiter = AIMDLimiter("test", 1, 4, initial=4)
+    scanner = Scanner(client, max_listing=1, limiter=limiter, retry=2)
+
+    _start = time.time()
+    assert asyncio.run(scanner.scans("/local")) == {"/local": []}
+    assert time.time() - _start >= 0.3
+    assert calls == ["/local", "/local"]
+    assert limiter.overloads == 1 and limiter.current < 4
+
+
+def test_scanner_empty_and_failing_tree():
+    """空目录与列出失败的目录不会使扫描挂起, 失败的目录被记录"""
+    tree = {
+        "/empty": [],
+        "/local": [fake_item("bad", is_dir=True), fake_item("a.txt")],
+    }
+    calls = []
+    client = AlistClient(BASE, transport=fake_alist(tree, calls))
+
+    async def _scan(scanner, path):
+        return await asyncio.wait_for(scanner.scans(path), 5)
+
+    scanner = Scanner(client, retry=0)
+    assert asyncio.run(_scan(scanner, "/empty")) == {"/empty": []}
+
+    scanner = Scanner(client, retry=0)
+    result = asyncio.run(_scan(scanner, "/local"))
+    assert [i.name for i in result["/local"]] == ["a.txt"]
+    assert [p.as_posix() for p in scanner.failed_dirs] == ["/local/bad"]
+
+    scanner = Scanner(client, retry=0)
+    assert asyncio.run(_scan(scanner, "/missing")) == {"/missing": []}
+    assert [p.as_posix() for p in scanner.failed_dirs] == ["/missing"]
+
+
+def test_scanner_snapshot():
+    """修改时间不变的目录使用快照中的列表, 其子目录仍然被列出"""
+    tree = {
+        "/local": [fake_item("d", is_dir=True)],
+        "/local/d": [fake_item("sub", is_dir=True), fake_item("a.txt")],
+        "/local/d/sub": [fake_item("b.txt"), fake_item("new.txt")],
+    }
+    handle = FakeSnapshotHandle()
+    _d = AlistPath(f"{BASE}/local/d")
+    _d.set_stat(Item.model_validate(tree["/local"][0]))
+    handle.update_file_item(
+        _d,
+        DirSnapshot.from_items(_d, [Item.model_validate(i) for i in tree["/local/d"]]),
+    )
+
+    calls = []
+    client = AlistClient(BASE, transport=fake_alist(tree, calls))
+    scanner = Scanner(client, snapshot=handle, snapshot_ttl=60)
+
+    async def _scan():
+        return {d.path.as_posix(): d async for d in scanner.iter_dirs("/local")}
+
+    dirs = asyncio.run(_scan())
+    assert sorted(calls) == ["/local", "/local/d/sub"]
+    assert scanner.skipped_dirs == 1 and scanner.listed_dirs == 2
+    # 使用快照的目录带着原来的快照, 由Checker比较目标目录
+    assert dirs["/local/d"].reused and not dirs["/local/d/sub"].reused
+    assert [i.name for i in dirs["/local/d"].items] == ["sub", "a.txt"]
+    assert [i.name for i in dirs["/local/d/sub"].snapshot.items] == ["b.txt", "new.txt"]
+
+    # 修改时间变化后重新列出
+    tree["/local"] = [fake_item("d", is_dir=True, modified="2024-02-01T00:00:00Z")]
+    calls.clear()
+    asyncio.run(_scan())
+    assert sorted(calls) == ["/local", "/local/d", "/local/d/sub"]
+
+
+def test_confirm_snapshot(checker):
+    """目录的Worker全部成功后才保存快照, 同时记录目标目录的修改时间"""
+    handle = checker.handle
+    checker.tree["/remote"] = [
+        fake_item(n, is_dir=True) for n in ("empty", "ok", "failed")
+    ]
+
+    def scan_dir(name):
+        path = AlistPath(f"{BASE}/local/{name}")
+        return ScanDir(path, [], name, DirSnapshot.from_items(path, []))
+
+    _modified = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+    checker.confirm_snapshot(scan_dir("empty"), [], {"x": _modified})
+    assert list(handle.items) == [f"{BASE}/local/empty"]
+    assert handle.items[f"{BASE}/local/empty"]["targets"] == {
+        "x": "2024-01-01T00:00:00Z"
+    }
+
+    workers = [SimpleNamespace(id=i, status="init", on_finish=None) for i in "ab"]
+    checker.confirm_snapshot(scan_dir("ok"), workers, {})
+    for _w in workers:
+        assert f"{BASE}/local/ok" not in handle.items
+        _w.status = "done"
+        _w.on_finish(_w)
+    # Worker完成后重新取得目标目录的修改时间
+    assert handle.items[f"{BASE}/local/ok"]["targets"] == {
+        f"{BASE}/remote/ok": "2024-01-01T00:00:00Z"
+    }
+
+    workers = [SimpleNamespace(id=i, status="done", on_finish=None) for i in "ab"]
+    checker.confirm_snapshot(scan_dir("failed"), workers, {})
+    workers[0].status = "failed"
+    for _w in workers:
+        _w.on_finish(_w)
+    assert f"{BASE}/local/failed" not in handle.items
+
+
+def test_checker_skips_unchanged_targets(checker):
+    """源目录来自快照且目标目录的修改时间没有变化时, 不再列出目标目录"""
+    checker.tree = {
+        "/remote": [fake_item("d", is_dir=True)],
+        "/remote/d": [fake_item("a.txt")],
+    }
+    _d = AlistPath(f"{BASE}/local/d")
+    items = [Item.model_validate(fake_item("a.txt"))]
+
+    def scan_dir():
+        _saved = checker.handle.items.get(_d.as_uri())
+        if _saved is None:
+            return ScanDir(_d, items, "d", DirSnapshot.from_items(_d, items))
+        return ScanDir(_d, items, "d", DirSnapshot.model_validate(_saved), True)
+
+    # 第一次: 对比目标目录, 保存快照和目标目录的修改时间
+    checker._t_checker(scan_dir())
+    assert checker.calls == ["/remote", "/remote/d"]
+    assert list(checker.handle.items[_d.as_uri()]["targets"]) == [f"{BASE}/remote/d"]
+
+    # 源和目标都没有变化: 只列出目标的父目录
+    checker.calls.clear()
+    checker._t_checker(scan_dir())
+    assert checker.calls == ["/remote"]
+    assert checker.worker_queue.empty()
+
+    # 目标目录变化后重新对比
+    checker.tree["/remote"] = [
+        fake_item("d", is_dir=True, modified="2024-02-01T00:00:00Z")
+    ]
+    checker.calls.clear()
+    checker._t_checker(scan_dir())
+    assert checker.calls == ["/remote", "/remote/d"]
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@File Name  : test_scheduler.py
+"""
+import time
+from types import SimpleNamespace
+
+import pytest
+from alist_sdk import AlistPath
+
+from alist_sync.scheduler import Scheduler, queue_key
+
+BASE = "http://localhost:5244"
+
+
+def fake_worker(size: int, *targets: str, source: str = "/src/f"):
+    return SimpleNamespace(
+        file_size=size,
+        source_path=AlistPath(BASE + source),
+        target_path=AlistPath(BASE + targets[0]),
+        all_targets=[AlistPath(BASE + t) for t in targets],
+        status="init",
+        short_id="fake",
+    )
+
+
+@pytest.fixture()
+def scheduler():
+    _scheduler = Scheduler()
+    yield _scheduler
+    _scheduler.pool.shutdown()
+
+
+def test_mount_limit(scheduler, monkeypatch):
+    """挂载点按最长的配置前缀划分队列, 挂载点与服务器的并发分别限制"""
+    from alist_sync import scheduler as scheduler_module
+
+    server = scheduler_module.sync_config.get_server(BASE)
+    monkeypatch.setattr(server, "mount_max_connect", {"/baidu": 1, "/baidu/a": 2})
+    monkeypatch.setattr(scheduler, "server_limit", lambda base_url: 3)
+
+    baidu_a = queue_key(AlistPath(BASE + "/baidu/a/b/f"))
+    baidu = queue_key(AlistPath(BASE + "/baidu/f"))
+    local = queue_key(AlistPath(BASE + "/local/d/f"))
+    assert [baidu_a[1], baidu[1], local[1]] == ["/baidu/a", "/baidu", "/local"]
+    assert scheduler.mount_limit(baidu) == 1
+    assert scheduler.mount_limit(local) == server.max_connect
+
+    scheduler._acquire({baidu})
+    assert not scheduler._can_run({baidu}) and scheduler._can_run({baidu_a})
+    # 扇出的Worker需要全部目标都有位置
+    assert not scheduler._can_run({baidu_a, baidu})
+    scheduler._acquire({baidu_a, local})
+    # 服务器的位置已满
+    assert not scheduler._can_run({local})
+    scheduler._acquire({baidu_a, local}, -1)
+    assert scheduler._can_run({local})
+
+
+def test_find_skips_blocked_head(scheduler):
+    """排在前面的扇出Worker的另一个目标已满时, 不阻塞后面的Worker"""
+    full = queue_key(AlistPath(BASE + "/full/f"))
+    scheduler._running_mounts[full] = scheduler.mount_limit(full)
+    lane = [fake_worker(10, "/a/1", "/full/1"), fake_worker(10, "/a/2")]
+
+    index, keys = scheduler._find(lane, False, queue_key(lane[0].target_path))
+    assert index == 1 and keys == {queue_key(lane[1].target_path)}
+
+
+def test_small_file_slots(scheduler, monkeypatch):
+    key = queue_key(AlistPath(BASE + "/a/f"))
+    monkeypatch.setattr(scheduler, "server_limit", lambda base_url: 30)
+    monkeypatch.setattr(scheduler, "mount_limit", lambda k: 4)
+    assert scheduler.large_limit(key) == 4 - 2
+
+    # 位置不多于 small_file_slots 时, 至少为小文件保留一个位置
+    monkeypatch.setattr(scheduler, "mount_limit", lambda k: 2)
+    assert scheduler.large_limit(key) == 1
+    scheduler._running_large[key] = 1
+    assert not scheduler._large_can_run(key)
+    monkeypatch.setattr(scheduler, "mount_limit", lambda k: 1)
+    assert scheduler.large_limit(key) == 1
+    # 自适应并发减少后, 按当前的并发数保留
+    monkeypatch.setattr(scheduler, "mount_limit", lambda k: 30)
+    monkeypatch.setattr(scheduler, "server_limit", lambda base_url: 3)
+    assert scheduler.large_limit(key) == 1
+
+
+def test_order(scheduler, monkeypatch):
+    from alist_sync import scheduler as scheduler_module
+
+    key = queue_key(AlistPath(BASE + "/a/f"))
+    lane = [fake_worker(size, f"/a/{size}") for size in (30, 10, 50, 20)]
+    # 小文件按到达顺序, 大文件最长作业优先
+    assert scheduler._order(lane, False, key) == [0, 1, 2, 3]
+    assert scheduler._order(lane, True, key) == [2, 0, 3, 1]
+
+    _config = scheduler_module.sync_config
+    monkeypatch.setattr(_config, "daemon", False)
+    monkeypatch.setattr(_config, "start_time", time.time())
+    monkeypatch.setattr(_config, "timeout", 2.5)
+    monkeypatch.setattr(_config, "schedule_budget", "files")
+    assert scheduler._order(lane, True, key) == [1, 3, 0, 2]
+
+    # bytes: 截止之前能完成的最大的文件优先 (10字节/秒, 剩余约2.5秒)
+    monkeypatch.setattr(_config, "schedule_budget", "bytes")
+    scheduler._rates[key[0]] = 10
+    assert scheduler._order(lane, True, key) == [3, 1, 2, 0]
@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@File Name  : test_server_copy.py
+"""
+import asyncio
+import json
+import time
+from itertools import count
+from types import SimpleNamespace
+
+import httpx
+import pytest
+from alist_sdk import AlistPath
+
+from alist_sync import alist_client
+from alist_sync.alist_client import AlistClient
+from alist_sync.server_copy import ServerCopier
+
+# 任务的缓存在多个测试的事件循环之间共享
+pytestmark = pytest.mark.filterwarnings("ignore:alru_cache detected event loop change")
+
+
+@pytest.mark.parametrize(
+    "name, result",
+    [
+        (
+            "copy [/local](/test.txt) to [/local_dst](/)",
+            ("/local/test.txt", "/local_dst"),
+        ),
+        ("copy [/](/a/b c.txt) to [/x](/y/z)", ("/a/b c.txt", "/x/y/z")),
+        ("upload test.txt to [/local](/)", None),
+    ],
+)
+def test_parse_copy_task(name, result):
+    assert alist_client.parse_copy_task(name) == result
+
+
+@pytest.mark.parametrize(
+    "name, result",
+    [
+        ("transfer [/tmp](/a/b.txt) to [/dst](/x)", ("/tmp/a/b.txt", "/dst/x")),
+        (
+            "transfer /data/temp/aria2/b.txt to [/dst](/)",
+            ("/data/temp/aria2/b.txt", "/dst"),
+        ),
+        ("download http://a/b.txt to [/dst](/)", None),
+    ],
+)
+def test_parse_transfer_task(name, result):
+    assert alist_client.parse_transfer_task(name) == result
+
+
+def fake_file(name: str, size: int):
+    return {
+        "name": name,
+        "size": size,
+        "is_dir": False,
+        "modified": "2024-01-01T00:00:00Z",
+        "sign": "",
+        "thumb": "",
+        "type": 0,
+    }
+
+
+def fresh_task_cache(monkeypatch):
+    """每次获取任务都使用新的缓存"""
+    _now = count()
+    monkeypatch.setattr(
+        alist_client, "time", SimpleNamespace(time=lambda: next(_now) * 5)
+    )
+
+
+def fake_copier(transport) -> ServerCopier:
+    copier = ServerCopier(batch_wait=0.1, poll_interval=0.05)
+    copier._clients["http://localhost:5244/"] = AlistClient(
+        "http://localhost:5244", transport=transport
+    )
+    return copier
+
+
+def fake_task_api(tasks: dict[str, list[dict]], calls: list, listing=None):
+    """任务API与复制请求, tasks为 {"copy/done": [任务], ...}, 复制请求追加到calls,
+    listing为列目录的结果 {目录: [文件]}"""
+
+    def handler(request: httpx.Request):
+        if request.url.path == "/api/fs/list":
+            _content = (listing or {}).get(json.loads(request.content)["path"], [])
+            _data = {
+                "content": _content,
+                "total": len(_content),
+                "readme": "",
+                "write": True,
+                "provider": "Local",
+            }
+            return httpx.Response(
+                200, json={"code": 200, "message": "success", "data": _data}
+            )
+        if request.url.path == "/api/fs/copy":
+            calls.append(json.loads(request.content))
+            return httpx.Response(
+                200, json={"code": 200, "message": "success", "data": None}
+            )
+        _type = request.url.path.removeprefix("/api/admin/task/")
+        return httpx.Response(
+            200, json={"code": 200, "message": "success", "data": tasks.get(_type, [])}
+        )
+
+    return httpx.MockTransport(handler)
+
+
+def fake_task(id_: str, name: str, state=2, status="success", error=""):
+    return {
+        "id": id_,
+        "name": name,
+        "state": state,
+        "status": status,
+        "progress": 100,
+        "error": error,
+    }
+
+
+def test_server_copy_round_trip(monkeypatch):
+    """同目录的文件合并为一个复制请求, 按任务名称中的源文件与目标目录找到各自的任务"""
+    fresh_task_cache(monkeypatch)
+
+    _name = "copy [/local](/d/{}) to [/dst](/d)"
+    tasks = {
+        # 之前已经完成的同名任务不属于本次复制
+        "copy/done": [fake_task("old", _name.format("b.txt"), 7, "failed", "old")],
+    }
+    calls = []
+
+    copier = fake_copier(fake_task_api(tasks, calls))
+    futures = {
+        n: copier.copy(
+            AlistPath(f"http://localhost:5244/local/d/{n}"),
+            AlistPath(f"http://localhost:5244/dst/d/{n}"),
+            1,
+        )
+        for n in ["a.txt", "b.txt", "c.txt"]
+    }
+    while not calls:
+        time.sleep(0.05)
+    tasks["copy/undone"] = [fake_task("c", _name.format("c.txt"), 1, "running")]
+    tasks["copy/done"] = tasks["copy/done"] + [
+        fake_task("a", _name.format("a.txt")),
+        fake_task("b", _name.format("b.txt"), 7, "failed", "disk full"),
+        # 复制到其他目录的同名文件
+        fake_task("x", "copy [/local](/d/c.txt) to [/dst](/other)"),
+    ]
+
+    assert futures["a.txt"].result(timeout=5).id == "a"
+    with pytest.raises(Exception, match="disk full"):
+        futures["b.txt"].result(timeout=5)
+    assert not futures["c.txt"].done()
+    tasks["copy/undone"] = []
+    tasks["copy/done"].append(fake_task("c", _name.format("c.txt")))
+    assert futures["c.txt"].result(timeout=5).id == "c"
+    assert calls == [
+        {
+            "src_dir": "/local/d",
+            "dst_dir": "/dst/d",
+            "names": ["a.txt", "b.txt", "c.txt"],
+        }
+    ]
+
+
+def test_server_copy_without_task(monkeypatch):
+    """同一个存储中的复制同步完成, 没有任务: 目标文件的大小与源文件一致即完成"""
+    fresh_task_cache(monkeypatch)
+    monkeypatch.setattr("alist_sync.server_copy.TASK_MISSING_TIMEOUT", 0.5)
+    calls = []
+    listing = {"/dst/d": [fake_file("a.txt", 10), fake_file("b.txt", 3)]}
+    copier = fake_copier(fake_task_api({}, calls, listing))
+
+    futures = {
+        n: copier.copy(
+            AlistPath(f"http://localhost:5244/local/d/{n}"),
+            AlistPath(f"http://localhost:5244/dst/d/{n}"),
+            10,
+        )
+        for n in ["a.txt", "b.txt"]
+    }
+    assert futures["a.txt"].result(timeout=5) is None
+    # 大小不一致的文件在超时后失败
+    with pytest.raises(Exception, match="找不到复制任务"):
+        futures["b.txt"].result(timeout=5)
+    assert len(calls) == 1
+
+
+def test_find_transfer_tasks():
+    """离线下载的转存任务按完整的目标路径匹配"""
+    tasks = {
+        "offline_download_transfer/done": [
+            fake_task("1", "transfer [/tmp](/x/a.txt) to [/dst](/sub)"),
+            fake_task("2", "transfer /data/temp/aria2/a.txt to [/dst](/)"),
+            fake_task("3", "transfer [/tmp](/x/aa.txt) to [/dst](/)"),
+        ],
+        "offline_download_transfer/undone": [
+            fake_task("4", "transfer [/tmp](/y/a.txt) to [/dst](/)", 1, "running"),
+        ],
+    }
+    client = AlistClient("http://localhost:5244", transport=fake_task_api(tasks, []))
+    done, undone = asyncio.run(alist_client.find_transfer_tasks("/dst/a.txt", client))
+    assert [t.id for t in done] == ["2"] and [t.id for t in undone] == ["4"]
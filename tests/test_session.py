@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@File Name  : test_session.py
+"""
+import json
+
+import httpx
+from alist_sdk import path_lib
+
+from alist_sync import session
+from alist_sync.config import AlistServer
+
+
+def test_session_token_persistence(tmp_path, monkeypatch):
+    """登陆得到的token保存在缓存目录中, 下一次运行时验证有效后直接使用"""
+    calls = []
+
+    def handler(request: httpx.Request):
+        calls.append(request.url.path)
+        if request.url.path == "/api/auth/login":
+            _user = json.loads(request.content)["username"]
+            _data = {"token": f"token-{_user}"}
+            return httpx.Response(200, json={"code": 200, "message": "", "data": _data})
+        if request.headers.get("Authorization", "").startswith("token-"):
+            _data = {"username": request.headers["Authorization"][6:]}
+            return httpx.Response(200, json={"code": 200, "message": "", "data": _data})
+        return httpx.Response(
+            200, json={"code": 401, "message": "invalid", "data": None}
+        )
+
+    _kwargs = session.SessionManager.client_kwargs
+    monkeypatch.setattr(
+        session.SessionManager,
+        "client_kwargs",
+        lambda self, s: {**_kwargs(self, s), "transport": httpx.MockTransport(handler)},
+    )
+    monkeypatch.setattr(session.sync_config, "cache_dir", tmp_path)
+    monkeypatch.setattr(path_lib, "ALIST_SERVER_INFO", {})
+    admin = AlistServer(
+        base_url="http://localhost:5244/", username="admin", password="pw"
+    )
+
+    _client = session.SessionManager().client(admin)
+    assert calls == ["/api/auth/login", "/api/me"]
+    assert _client.get_token() == "token-admin"
+    _saved = json.loads(tmp_path.joinpath("alist_tokens.json").read_text())
+    assert _saved == {admin.base_url: {"username": "admin", "token": "token-admin"}}
+
+    # 下一次运行: 验证保存的token后直接使用, 不再登陆
+    calls.clear()
+    _manager = session.SessionManager()
+    assert _manager.client(admin).get_token() == "token-admin"
+    assert _manager.client(admin) is _manager.client(admin)
+    assert calls == ["/api/me"]
+
+    # 其他用户不使用保存的token
+    calls.clear()
+    other = admin.model_copy(update={"username": "other"})
+    assert session.SessionManager().client(other).get_token() == "token-other"
+    assert calls == ["/api/auth/login", "/api/me"]
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@File Name  : test_verifier.py
+"""
+import json
+import threading
+
+import httpx
+import pytest
+from alist_sdk import AlistPath, Client
+from alist_sdk.path_lib import ALIST_SERVER_INFO
+
+from alist_sync.concurrency import get_concurrency
+from alist_sync.err import RecheckError, ServerBusyError
+from alist_sync.verifier import Verifier
+
+
+def test_verifier_expect_error():
+    """expect出错时只有该文件的Future失败, 检查线程继续工作"""
+    verifier = Verifier(window=0.01, retry=0)
+    verifier.list_dir = lambda path, since=None: {"a": 1}
+
+    def bad(item):
+        raise KeyError("hash")
+
+    bad_future = verifier.verify(AlistPath("http://localhost:5244/d/a"), bad)
+    with pytest.raises(KeyError):
+        bad_future.result(timeout=5)
+    good = verifier.verify(AlistPath("http://localhost:5244/d/a"), lambda i: i == 1)
+    assert good.result(timeout=5) is True and verifier._thread.is_alive()
+
+
+def test_verifier_dirs_in_parallel():
+    """一个目录的检查阻塞时, 其他目录的检查不受影响"""
+    verifier = Verifier(window=0.01, retry=0)
+    blocked = threading.Event()
+
+    def list_dir(path, since=None):
+        if path.name == "slow":
+            blocked.wait(5)
+        return {"a": 1}
+
+    verifier.list_dir = list_dir
+    slow = verifier.verify(AlistPath("http://localhost:5244/slow/a"), bool)
+    fast = verifier.verify(AlistPath("http://localhost:5244/fast/a"), bool)
+    assert fast.result(timeout=2) is True and not slow.done()
+    blocked.set()
+    assert slow.result(timeout=2) is True
+
+
+def test_verifier_list_dir(monkeypatch):
+    """不存在的目录为空, 429在检查阶段的并发位置中计入过载, 其他错误抛出RecheckError"""
+    responses = {
+        "/missing": httpx.Response(
+            200, json={"code": 500, "message": "object not found", "data": None}
+        ),
+        "/busy": httpx.Response(429, text="busy"),
+        "/denied": httpx.Response(
+            200, json={"code": 403, "message": "permission denied", "data": None}
+        ),
+    }
+
+    def handler(request: httpx.Request):
+        return responses[json.loads(request.content)["path"]]
+
+    _client = Client("http://localhost:5244", transport=httpx.MockTransport(handler))
+    monkeypatch.setitem(ALIST_SERVER_INFO, _client.server_info, _client)
+
+    verifier = Verifier()
+    assert verifier._list_dir(AlistPath("http://localhost:5244/missing")) == []
+
+    limiter = get_concurrency().limiter("http://localhost:5244/", "check")
+    _overloads = limiter.overloads
+    with pytest.raises(ServerBusyError):
+        verifier._list_dir(AlistPath("http://localhost:5244/busy"))
+    assert limiter.overloads == _overloads + 1
+
+    with pytest.raises(RecheckError):
+        verifier._list_dir(AlistPath("http://localhost:5244/denied"))
@@ -38,3 +38,317 @@ def test_worker_copy():
     )
     worker = Worker(**docs)
     worker.run()
+
+
+DATA = bytes(range(100)) * 3
+
+
+class FakeAlist:
+    """模拟的Alist服务器, 下载返回DATA, 上传的内容保存在files中
+
+    :param support_range: 下载是否支持Range
+    :param fail_put: 上传失败的目标路径
+    """
+
+    def __init__(self, support_range=True, fail_put=(), fail_download=False):
+        self.support_range = support_range
+        self.fail_put = set(fail_put)
+        self.fail_download = fail_download
+        self.ranges: list[str | None] = []
+        self.files: dict[str, bytes] = {}
+        self.mkdirs: list[str] = []
+
+    def handler(self, request):
+        import json
+        import httpx
+        import urllib.parse
+
+        if request.url.path == "/api/fs/put":
+            path = urllib.parse.unquote(request.headers["File-Path"])
+            content = request.read()
+            if path in self.fail_put:
+                return httpx.Response(
+                    200, json={"code": 500, "message": "put error", "data": None}
+                )
+            self.files[path] = content
+            return httpx.Response(
+                200, json={"code": 200, "message": "success", "data": None}
+            )
+        if request.url.path == "/api/fs/mkdir":
+            self.mkdirs.append(json.loads(request.content)["path"])
+        if request.url.path.startswith("/api/fs/"):
+            return httpx.Response(
+                200, json={"code": 200, "message": "success", "data": None}
+            )
+
+        _range = request.headers.get("Range")
+        self.ranges.append(_range)
+        if self.fail_download:
+            return httpx.Response(404, text="not found")
+        if not self.support_range or _range is None:
+            return httpx.Response(200, content=DATA)
+        start, end = _range.removeprefix("bytes=").split("-")
+        end = int(end) + 1 if end else len(DATA)
+        return httpx.Response(206, content=DATA[int(start) : end])
+
+
+@pytest.fixture()
+def fake_worker(tmp_path, monkeypatch):
+    """不连接真实服务器与数据库的Worker, 下载与上传都由FakeAlist处理
+
+    返回 create(alist, *targets), Worker的全部update记录在worker.updates中
+    """
+    import httpx
+    from alist_sdk import AlistPath, Client, login_server
+    from alist_sdk.path_lib import ALIST_SERVER_INFO
+    from alist_sync import d_worker
+    from alist_sync.d_worker import Worker
+
+    def _update(self, **field):
+        self.__dict__.setdefault("updates", []).append(field)
+        self.__dict__.update(field)
+
+    monkeypatch.setattr(Worker, "update", _update)
+    monkeypatch.setattr(Worker, "throttle", lambda self, path: None)
+    monkeypatch.setattr(AlistPath, "get_download_uri", lambda self: "http://dl/f")
+    monkeypatch.setattr(d_worker.sync_config, "cache_dir", tmp_path)
+
+    def create(alist: FakeAlist, *targets: str) -> Worker:
+        transport = httpx.MockTransport(alist.handler)
+        _client = Client("http://localhost:5244", transport=transport)
+        monkeypatch.setitem(ALIST_SERVER_INFO, _client.server_info, _client)
+        login_server(_client)
+        monkeypatch.setattr(
+            d_worker, "downloader_client", httpx.Client(transport=transport)
+        )
+        targets = targets or ("/dst/f.bin",)
+        return Worker(
+            type="copy",
+            need_backup=False,
+            file_size=len(DATA),
+            file_modified="2024-01-01T00:00:00",
+            source_path=AlistPath("http://localhost:5244/local/f.bin"),
+            target_path=AlistPath(f"http://localhost:5244{targets[0]}"),
+            extra_targets=[AlistPath(f"http://localhost:5244{t}") for t in targets[1:]],
+        )
+
+    return create
+
+
+def test_segment_resume(fake_worker):
+    """分段下载从每一段保存的进度继续"""
+    from alist_sync.downloader import split_ranges
+
+    alist = FakeAlist()
+    worker = fake_worker(alist)
+    ranges = split_ranges(len(DATA), 4)
+    seg_file = worker.tmp_file.with_name(worker.tmp_file.name + ".seg")
+    # 每一段已经下载了10字节, 其余部分是预分配的0
+    with seg_file.open("wb") as _f:
+        _f.truncate(len(DATA))
+        for start, _ in ranges:
+            _f.seek(start)
+            _f.write(DATA[start : start + 10])
+    worker.download_segments = [10] * 4
+
+    worker.segment_downloader()
+
+    assert sorted(alist.ranges) == sorted(f"bytes={s + 10}-{e - 1}" for s, e in ranges)
+    assert worker.tmp_file.read_bytes() == DATA and not seg_file.exists()
+    assert worker.status == "downloaded" and worker.download_segments == []
+
+
+def test_segment_fallback(fake_worker):
+    """服务端不支持Range时改为单连接下载, 之后不再写回分段的进度"""
+    worker = fake_worker(FakeAlist(support_range=False))
+    worker.segment_downloader()
+
+    assert worker.tmp_file.read_bytes() == DATA
+    assert worker.status == "downloaded" and worker.download_segments == []
+    assert all(u.get("download_segments", []) == [] for u in worker.updates)
+
+
+def test_segment_incomplete(fake_worker):
+    """某一段的数据不完整时不能确认下载完成, 保存已经下载的进度"""
+    import httpx
+
+    alist = FakeAlist()
+    _handler = alist.handler
+
+    def short_handler(request: httpx.Request):
+        _res = _handler(request)
+        if request.headers["Range"].startswith("bytes=0-"):
+            return httpx.Response(206, content=_res.content[:5])
+        return _res
+
+    alist.handler = short_handler
+    worker = fake_worker(alist)
+    with pytest.raises(AssertionError):
+        worker.segment_downloader()
+    assert worker.status == "init" and not worker.tmp_file.exists()
+    assert worker.download_segments == [5, 75, 75, 75]
+
+
+def test_download_resume(fake_worker):
+    """单连接下载从临时文件的末尾继续, 完成后记录下载的字节数"""
+    alist = FakeAlist()
+    worker = fake_worker(alist)
+    worker.tmp_file.write_bytes(DATA[:100])
+
+    worker.downloader()
+
+    assert alist.ranges == ["bytes=100-"]
+    assert worker.tmp_file.read_bytes() == DATA
+    assert worker.status == "downloaded" and worker.download_offset == len(DATA)
+
+
+def test_download_checkpoint(fake_worker, monkeypatch):
+    """下载过程中每download_checkpoint字节保存一次进度, 完成后标记为downloaded"""
+    from alist_sync import d_worker
+
+    monkeypatch.setattr(d_worker.sync_config, "download_checkpoint", 1)
+    worker = fake_worker(FakeAlist())
+    worker.downloader()
+
+    assert worker.updates == [
+        {"download_offset": len(DATA)},
+        {"status": "downloaded", "download_offset": len(DATA)},
+    ]
+
+    # 临时文件已经完整时不再下载
+    alist = FakeAlist()
+    worker = fake_worker(alist)
+    worker.tmp_file.write_bytes(DATA)
+    worker.downloader()
+    assert alist.ranges == [] and worker.status == "downloaded"
+
+
+def test_stream_copy(fake_worker):
+    """流式复制下载一次, 上传到全部目标, 失败的目标留给临时文件重试"""
+    alist = FakeAlist(fail_put={"/dst2/f.bin"})
+    worker = fake_worker(alist, "/dst/f.bin", "/dst2/f.bin")
+
+    worker.stream_copy()
+
+    assert alist.ranges == [None] and alist.files == {"/dst/f.bin": DATA}
+    assert worker.targets_status == {
+        "http://localhost:5244/dst/f.bin": "uploaded",
+        "http://localhost:5244/dst2/f.bin": "failed",
+    }
+    assert worker.status == "init" and not worker.tmp_file.exists()
+
+
+def test_memory_copy(fake_worker):
+    """内存传输下载到内存后上传到全部目标, 下载失败时不改变状态"""
+    alist = FakeAlist()
+    worker = fake_worker(alist, "/dst/f.bin", "/dst2/f.bin")
+    worker.memory_copy()
+    assert alist.files == {"/dst/f.bin": DATA, "/dst2/f.bin": DATA}
+    assert worker.status == "uploaded" and not worker.tmp_file.exists()
+
+    worker = fake_worker(FakeAlist(fail_download=True))
+    worker.memory_copy()
+    assert worker.status == "init" and worker.targets_status == {}
+
+
+def test_fanout(fake_worker):
+    """相同源文件的copy Worker合并为一个, 重复的目标只保留一个"""
+    from types import SimpleNamespace
+    from alist_sync.d_checker import Checker
+
+    alist = FakeAlist()
+    first, second, duplicate = (
+        fake_worker(alist, t) for t in ("/dst/f.bin", "/dst2/f.bin", "/dst/f.bin")
+    )
+    delete = SimpleNamespace(type="delete")
+
+    workers = Checker.fanout([first, None, second, delete, duplicate])
+
+    assert len(workers) == 2 and workers[0] is first and workers[1] is delete
+    assert [t.as_posix() for t in first.all_targets] == ["/dst/f.bin", "/dst2/f.bin"]
+
+
+def test_upload_all(fake_worker, monkeypatch):
+    """上传到全部目标, 失败的目标在重试时单独上传"""
+    from alist_sync import d_worker
+    from alist_sync.err import UploadError
+    from alist_sync.retry import RetryPolicy
+
+    policy = RetryPolicy(retry=0)
+    monkeypatch.setattr(d_worker, "get_retry_policy", lambda: policy)
+
+    alist = FakeAlist(fail_put={"/dst2/f.bin"})
+    worker = fake_worker(alist, "/dst/f.bin", "/dst2/f.bin")
+    worker.tmp_file.write_bytes(DATA)
+
+    with pytest.raises(UploadError):
+        worker.upload_all()
+    assert alist.files == {"/dst/f.bin": DATA}
+    assert worker.targets_status == {
+        "http://localhost:5244/dst/f.bin": "uploaded",
+        "http://localhost:5244/dst2/f.bin": "failed",
+    }
+
+    alist.fail_put.clear()
+    alist.files.clear()
+    worker.upload_all()
+    assert alist.files == {"/dst2/f.bin": DATA} and worker.status == "uploaded"
+
+
+def test_made_dirs(fake_worker):
+    """有效期内同一个目录只创建一次, 过期或上传失败后重新创建"""
+    import time
+    from alist_sync.d_worker import Workers
+
+    alist = FakeAlist()
+    workers = Workers()
+    worker = fake_worker(alist, "/dst/f.bin", "/dst/g.bin")
+    worker.workers = workers
+    dst = "http://localhost:5244/dst"
+
+    for _target in worker.all_targets:
+        worker.prepare_target(_target)
+    assert alist.mkdirs == ["/dst"] and workers.is_dir_made(dst)
+
+    workers.made_dirs[dst] -= workers.made_dir_ttl
+    worker.prepare_target(worker.target_path)
+    assert alist.mkdirs == ["/dst", "/dst"]
+
+    worker.forget_target_dir(worker.target_path)
+    assert not workers.is_dir_made(dst)
+
+    # 过期的记录在下一次添加时被清理
+    _expired = time.monotonic() - workers.made_dir_ttl
+    workers.made_dirs = {"http://localhost:5244/old": _expired}
+    workers._made_dirs_purged -= workers.made_dir_ttl
+    worker.prepare_target(worker.target_path)
+    assert list(workers.made_dirs) == [dst]
+
+
+def test_timeout_charges_request_server(fake_worker, monkeypatch):
+    """超时计入请求所在的服务器, 而不是目标所在的服务器"""
+    import httpx
+    from alist_sync import d_worker
+    from alist_sync.d_worker import Worker
+    from alist_sync.retry import RetryPolicy
+
+    policy = RetryPolicy(retry=0, base_delay=0)
+    monkeypatch.setattr(d_worker, "get_retry_policy", lambda: policy)
+    server = "http://localhost:5244/"
+
+    def timeout(url):
+        def _copy(self):
+            raise httpx.ReadTimeout("timeout", request=httpx.Request("GET", url))
+
+        return _copy
+
+    # 下载地址不是Alist服务器, 不计入任何服务器
+    monkeypatch.setattr(Worker, "copy_type", timeout("http://dl/f"))
+    worker = fake_worker(FakeAlist())
+    worker.run()
+    assert worker.status == "failed" and policy.breaker(server).total_failures == 0
+
+    monkeypatch.setattr(Worker, "copy_type", timeout(server + "api/fs/put"))
+    worker = fake_worker(FakeAlist())
+    worker.run()
+    assert worker.status == "failed" and policy.breaker(server).total_failures == 1